@@ -0,0 +1,77 @@
+#
+# Benchmark for the effect of archiving posted tweets on polling and
+# importing.
+#
+# Builds a store with a large posted history, then times polling for due
+# tweets and importing a batch of new tweets against a copy of it as is
+# and against a copy compacted by archiving the history and vacuuming.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.compaction --rows 5000000
+#
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from benchmarks.poll_latency import build_store, time_poll
+from schtweet.storage import TweetStore
+
+
+def time_import(storage_name, num_rows):
+    first = pytz.utc.localize(datetime.utcnow() + timedelta(days=1))
+    start = time.perf_counter()
+    with TweetStore(storage_name) as ts:
+        ts.schedule_tweets((first + timedelta(minutes=i), 'Imported tweet {}'.format(i), None)
+                           for i in range(num_rows))
+    return time.perf_counter() - start
+
+
+def time_compaction(storage_name, archive_name):
+    start = time.perf_counter()
+    with TweetStore(storage_name) as ts:
+        ts.archive_posted(datetime.now(), archive_name)
+        ts.vacuum()
+    return time.perf_counter() - start
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        original_name = os.path.join(directory, 'original.db')
+        build_store(original_name, args.rows)
+        compacted_name = os.path.join(directory, 'compacted.db')
+        shutil.copyfile(original_name, compacted_name)
+        archive_name = None if args.in_place else os.path.join(directory, 'archive.db')
+        print('Compacted {} rows in {:.2f}s'.format(args.rows, time_compaction(compacted_name, archive_name)))
+
+        print('{:>10}  {:>10}  {:>10}  {:>12}'.format('store', 'size (MB)', 'poll (ms)', 'import (s)'))
+        for label, storage_name in (('before', original_name), ('after', compacted_name)):
+            size = os.path.getsize(storage_name)
+            poll = time_poll(storage_name, args.repeats)
+            imported = time_import(storage_name, args.import_rows)
+            print('{:>10}  {:>10.1f}  {:>10.3f}  {:>12.2f}'.format(label, size / 1e6, poll * 1000, imported))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--rows',
+                                 help='Number of rows of posted history to build the store with.',
+                                 type=int,
+                                 default=5000000)
+    cli_main_parser.add_argument('--import-rows',
+                                 help='Number of new tweets to import into each store.',
+                                 type=int,
+                                 default=100000)
+    cli_main_parser.add_argument('--repeats',
+                                 help='Number of polls to run per store. The best time is reported.',
+                                 type=int,
+                                 default=20)
+    cli_main_parser.add_argument('--in-place',
+                                 help='Archive to a table in the store rather than a separate file.',
+                                 action='store_true')
+    main(cli_main_parser.parse_args())
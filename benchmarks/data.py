@@ -0,0 +1,75 @@
+#
+# Synthetic data generators shared by the benchmarks.
+#
+# Can also be run from the repository root to write data files, e.g.
+#
+#   python -m benchmarks.data csv 100000 campaign.csv
+#   python -m benchmarks.data lines 100000 lines.txt
+#
+import argparse
+import io
+from datetime import datetime, timedelta
+
+# Wall clock slots used for generated schedules, mimicking schedule-lines.py
+# output where a few times of day repeat for many days.
+SLOT_TIMES = ((9, 0), (12, 30), (18, 0), (21, 0))
+
+
+# Every minute of the day, for generating many rows over a shorter period
+EVERY_MINUTE = tuple((hour, minute) for hour in range(24) for minute in range(60))
+
+
+def scheduled_dates(num_rows, first_day=datetime(2030, 1, 1), slot_times=SLOT_TIMES):
+    """Generator of num_rows naive datetimes, cycling through slot_times."""
+    day = first_day
+    slot = 0
+    for _ in range(num_rows):
+        hour, minute = slot_times[slot]
+        yield day.replace(hour=hour, minute=minute)
+        slot += 1
+        if slot >= len(slot_times):
+            slot = 0
+            day += timedelta(days=1)
+
+
+def write_csv(filename, num_rows, first_day=datetime(2030, 1, 1), slot_times=SLOT_TIMES):
+    """Writes a CSV in the import-tweets.py format with num_rows rows,
+       scheduled from first_day. Every third row has a URL and every fifth
+       contains a quoted comma."""
+    with io.open(filename, 'w', encoding='utf8') as output:
+        for i, date in enumerate(scheduled_dates(num_rows, first_day, slot_times)):
+            text = 'Generated tweet number {}'.format(i)
+            if i % 5 == 0:
+                text = '"{}, with a comma"'.format(text)
+            url = 'example.com/{}'.format(i) if i % 3 == 0 else ''
+            output.write('{},{},{}\n'.format(date.strftime('%d/%m/%Y %H:%M'), text, url))
+
+
+def write_lines(filename, num_lines):
+    """Writes a lines file in the schedule-lines.py format with num_lines
+       lines. Every hundredth line is a comment and every fiftieth is empty."""
+    with io.open(filename, 'w', encoding='utf8') as output:
+        for i in range(num_lines):
+            if i % 100 == 0:
+                output.write('// Comment line {}\n'.format(i))
+            elif i % 50 == 0:
+                output.write('\n')
+            elif i % 7 == 0:
+                output.write('Generated line {}, with a "quoted" comma\n'.format(i))
+            else:
+                output.write('Generated line {}\n'.format(i))
+
+
+if __name__ == '__main__':
+    writers = {'csv': write_csv, 'lines': write_lines}
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('kind',
+                                 help='The kind of file to generate.',
+                                 choices=sorted(writers))
+    cli_main_parser.add_argument('rows',
+                                 help='The number of rows or lines to generate.',
+                                 type=int)
+    cli_main_parser.add_argument('filename',
+                                 help='The file to write. Will be overwritten.')
+    args = cli_main_parser.parse_args()
+    writers[args.kind](args.filename, args.rows)
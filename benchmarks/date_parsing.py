@@ -0,0 +1,93 @@
+#
+# Microbenchmark for parsing imported dates.
+#
+# Compares the original per row dateutil parse and pytz localisation with
+# schtweet.dates.DateParser and its UtcConverter, both with and without the
+# parser's cache, over dates in the format written by schedule-lines.py.
+# Then compares normalising the parsed dates into UTC insert values by
+# localising each with pytz against a UtcConverter, which caches each day's
+# UTC offset.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.date_parsing --rows 100000
+#
+import argparse
+import time
+
+import pytz
+from dateutil import parser
+
+from benchmarks.data import scheduled_dates
+from schtweet.dates import DateParser, UtcConverter
+from schtweet.storage import tweet_values
+
+
+def parse_with_dateutil(date_strings, timezone):
+    for date_string in date_strings:
+        date = parser.parse(date_string, dayfirst=True)
+        if date.tzinfo is None:
+            timezone.localize(date)
+
+
+def parse_with_date_parser(date_strings, timezone, cache_size):
+    date_parser = DateParser(cache_size=cache_size)
+    converter = date_parser.converter(timezone)
+    for date_string in date_strings:
+        converter.utc(date_parser.parse_local(date_string))
+
+
+def normalise_with_pytz(dates, timezone):
+    for date in dates:
+        tweet_values(timezone.localize(date), 'Tweet', None)
+
+
+def normalise_with_converter(dates, timezone):
+    converter = UtcConverter(timezone)
+    for date in dates:
+        converter.tweet_values(date, 'Tweet', None)
+
+
+def report(name, num_rows, elapsed):
+    print('{:<32}  {:>10.2f} us/row  {:>12.0f} rows/sec'.format(name, elapsed * 1e6 / num_rows, num_rows / elapsed))
+
+
+def main(args):
+    timezone = pytz.timezone('Europe/London')
+    date_strings = [date.strftime('%d/%m/%Y %H:%M') for date in scheduled_dates(args.rows)]
+
+    start = time.perf_counter()
+    parse_with_dateutil(date_strings, timezone)
+    report('dateutil', args.rows, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    parse_with_date_parser(date_strings, timezone, 0)
+    report('DateParser (no cache)', args.rows, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    parse_with_date_parser(date_strings, timezone, None)
+    report('DateParser (unbounded cache)', args.rows, time.perf_counter() - start)
+
+    # Repeat the same few slots, as a short campaign re-imported many times would
+    repeated = date_strings[:16] * (args.rows // 16)
+    start = time.perf_counter()
+    parse_with_date_parser(repeated, timezone, 4096)
+    report('DateParser (repeated strings)', len(repeated), time.perf_counter() - start)
+
+    dates = list(scheduled_dates(args.rows))
+    start = time.perf_counter()
+    normalise_with_pytz(dates, timezone)
+    report('normalise (pytz localize)', args.rows, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    normalise_with_converter(dates, timezone)
+    report('normalise (UtcConverter)', args.rows, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--rows',
+                                 help='Number of dates to parse.',
+                                 type=int,
+                                 default=100000)
+    main(cli_main_parser.parse_args())
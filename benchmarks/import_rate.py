@@ -0,0 +1,101 @@
+#
+# Benchmark for the rate at which tweets can be imported.
+#
+# Times inserting pre-parsed rows one at a time through
+# TweetStore.schedule_tweet against the batched
+# TweetStore.schedule_tweets, with and without dedup, then times a full
+# run of import-tweets.py over a generated CSV. Results are reported in
+# rows/sec.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.import_rate --rows 1000000
+#
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytz
+
+from benchmarks.data import scheduled_dates, write_csv
+from schtweet.storage import TweetStore
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generated_rows(num_rows):
+    timezone = pytz.timezone('Europe/London')
+    for i, date in enumerate(scheduled_dates(num_rows)):
+        yield timezone.localize(date), 'Generated tweet number {}'.format(i), 'example.com/{}'.format(i)
+
+
+def time_schedule_tweet(storage_name, num_rows):
+    with TweetStore(storage_name) as ts:
+        start = time.perf_counter()
+        for date, text, url in generated_rows(num_rows):
+            ts.schedule_tweet(date, text, url)
+        ts._connection.commit()
+        return time.perf_counter() - start
+
+
+def time_schedule_tweets(storage_name, num_rows, journal_mode, synchronous):
+    with TweetStore(storage_name) as ts:
+        start = time.perf_counter()
+        with ts.bulk_load(journal_mode=journal_mode, synchronous=synchronous):
+            ts.schedule_tweets(generated_rows(num_rows))
+        return time.perf_counter() - start
+
+
+def time_dedup(storage_name, num_rows):
+    """Times importing the rows with dedup into an empty store, then again
+       when every row is a duplicate."""
+    elapsed = []
+    for _ in range(2):
+        with TweetStore(storage_name) as ts:
+            start = time.perf_counter()
+            ts.schedule_tweets(generated_rows(num_rows), dedup=True)
+            elapsed.append(time.perf_counter() - start)
+    return elapsed
+
+
+def time_import_script(storage_name, csv_name):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, os.path.join(REPOSITORY_ROOT, 'import-tweets.py'),
+                           '--output', storage_name, '--journal-mode', 'MEMORY', '--synchronous', 'OFF',
+                           'csv', csv_name],
+                          cwd=REPOSITORY_ROOT, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def report(name, num_rows, elapsed):
+    print('{:<44}  {:>12.0f} rows/sec'.format(name, num_rows / elapsed))
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        report('schedule_tweet (per row)', args.rows,
+               time_schedule_tweet(os.path.join(directory, 'single.db'), args.rows))
+        report('schedule_tweets', args.rows,
+               time_schedule_tweets(os.path.join(directory, 'bulk.db'), args.rows, None, None))
+        report('schedule_tweets (MEMORY journal, sync OFF)', args.rows,
+               time_schedule_tweets(os.path.join(directory, 'bulk-pragmas.db'), args.rows, 'MEMORY', 'OFF'))
+        first, again = time_dedup(os.path.join(directory, 'dedup.db'), args.rows)
+        report('schedule_tweets (dedup)', args.rows, first)
+        report('schedule_tweets (dedup, all duplicates)', args.rows, again)
+
+        csv_name = os.path.join(directory, 'import.csv')
+        write_csv(csv_name, args.rows)
+        report('import-tweets.py csv', args.rows,
+               time_import_script(os.path.join(directory, 'script.db'), csv_name))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--rows',
+                                 help='Number of rows to import.',
+                                 type=int,
+                                 default=100000)
+    main(cli_main_parser.parse_args())
@@ -0,0 +1,165 @@
+#
+# Benchmark comparing scheduling tweets through serve-tweets.py with running
+# import-tweets.py string for each one, as a CMS shelling out to the script
+# would.
+#
+# Times the script path one tweet per run, then starts serve-tweets.py on a
+# free local port and times clients posting single tweets, and batches of
+# tweets, over keep-alive connections. Every path writes to its own empty
+# storage file, and the number of tweets stored is checked at the end.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.ingest_service --requests 5000 --clients 8
+#
+import argparse
+import http.client
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_DATE = datetime(2030, 1, 1)
+
+
+def tweet_date(number):
+    return (FIRST_DATE + timedelta(minutes=number)).strftime('%d/%m/%Y %H:%M')
+
+
+def time_script(storage_name, num_tweets):
+    """Returns the seconds taken to schedule num_tweets tweets, running
+       import-tweets.py string for each."""
+    start = time.perf_counter()
+    for number in range(num_tweets):
+        subprocess.run([sys.executable, 'import-tweets.py', '-o', storage_name, 'string',
+                        '{},Script tweet {}'.format(tweet_date(number), number)],
+                       cwd=REPOSITORY_ROOT, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+class ServiceProcess(object):
+    """Runs serve-tweets.py on a free local port for the body of a with
+       statement, stopping it at the end."""
+
+    def __init__(self, storage_name, commit_interval):
+        self._arguments = [sys.executable, 'serve-tweets.py', '--port', '0', '--commit-interval', str(commit_interval),
+                           storage_name]
+        self._process = None
+        self.port = None
+
+    def __enter__(self):
+        self._process = subprocess.Popen(self._arguments, cwd=REPOSITORY_ROOT, stdout=subprocess.PIPE,
+                                         universal_newlines=True)
+        line = self._process.stdout.readline()
+        match = re.search(r':(\d+)$', line.strip())
+        if match is None:
+            self._process.kill()
+            raise RuntimeError('serve-tweets.py did not start: {}'.format(line))
+        self.port = int(match.group(1))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._process.terminate()
+        self._process.communicate()
+
+
+def post_tweets(port, first_number, num_requests, batch_size, failures):
+    """Posts num_requests requests of batch_size tweets each over one
+       keep-alive connection."""
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json'}
+    number = first_number
+    for _ in range(num_requests):
+        tweets = []
+        for _ in range(batch_size):
+            tweets.append({'date': tweet_date(number), 'text': 'Service tweet {}'.format(number)})
+            number += 1
+        connection.request('POST', '/tweets', json.dumps({'tweets': tweets}), headers)
+        response = connection.getresponse()
+        content = json.loads(response.read().decode('utf8'))
+        if response.status != 200 or content['scheduled'] != batch_size:
+            failures.append(content)
+    connection.close()
+
+
+def time_service(port, num_requests, batch_size, num_clients):
+    """Returns the seconds taken for num_clients concurrent clients to make
+       num_requests requests between them, each of batch_size tweets."""
+    failures = []
+    per_client = num_requests // num_clients
+    clients = [threading.Thread(target=post_tweets,
+                                args=(port, client * per_client * batch_size, per_client, batch_size, failures))
+               for client in range(num_clients)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    if len(failures) > 0:
+        raise RuntimeError('{} requests failed, the first with: {}'.format(len(failures), failures[0]))
+    return elapsed
+
+
+def stored_tweets(storage_name):
+    connection = sqlite3.connect(storage_name)
+    try:
+        return connection.execute('''SELECT COUNT(*) FROM tweets''').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        print('{:<24}  {:>9}  {:>9}  {:>10}  {:>10}'.format('path', 'requests', 'time (s)', 'requests/s', 'tweets/s'))
+
+        def report(name, storage_name, num_requests, batch_size, elapsed):
+            num_tweets = num_requests * batch_size
+            assert stored_tweets(storage_name) == num_tweets
+            print('{:<24}  {:>9}  {:>9.2f}  {:>10.1f}  {:>10.1f}'.format(
+                name, num_requests, elapsed, num_requests / elapsed, num_tweets / elapsed))
+
+        storage_name = os.path.join(directory, 'script.db')
+        report('import-tweets.py string', storage_name, args.script_runs, 1,
+               time_script(storage_name, args.script_runs))
+
+        num_requests = args.requests - args.requests % args.clients
+        for name, batch_size in (('service, 1 per request', 1),
+                                 ('service, {} per request'.format(args.batch_size), args.batch_size)):
+            storage_name = os.path.join(directory, 'service-{}.db'.format(batch_size))
+            with ServiceProcess(storage_name, args.commit_interval) as service:
+                elapsed = time_service(service.port, num_requests, batch_size, args.clients)
+            report(name, storage_name, num_requests, batch_size, elapsed)
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--script-runs',
+                                 help='Number of tweets to schedule by running import-tweets.py.',
+                                 type=int,
+                                 default=100)
+    cli_main_parser.add_argument('--requests',
+                                 help='Number of requests to make to the service for each batch size.',
+                                 type=int,
+                                 default=5000)
+    cli_main_parser.add_argument('--clients',
+                                 help='Number of concurrent keep-alive connections making the requests.',
+                                 type=int,
+                                 default=8)
+    cli_main_parser.add_argument('--batch-size',
+                                 help='Number of tweets per request for the batched run.',
+                                 type=int,
+                                 default=100)
+    cli_main_parser.add_argument('--commit-interval',
+                                 help='Minimum milliseconds between the service\'s commits.',
+                                 type=float,
+                                 default=2)
+    main(cli_main_parser.parse_args())
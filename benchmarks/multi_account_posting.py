@@ -0,0 +1,112 @@
+#
+# Benchmark for posting the tweets of many accounts.
+#
+# Queues due tweets for a number of accounts in one storage file, then
+# posts them all against a local stub Twitter API server, first by
+# running post-scheduled-tweets.py once per account, as separate cron
+# entries would, and then with a single run using --accounts.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.multi_account_posting --accounts 40 --tweets 20 --latency 0.05
+#
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from benchmarks.stubs import StubApiServer
+from schtweet.storage import TweetStore
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'post-scheduled-tweets.py')
+
+
+def account_names(num_accounts):
+    return ['account{}'.format(i) for i in range(num_accounts)]
+
+
+def queue_account_tweets(storage_name, accounts, num_tweets):
+    first = pytz.utc.localize(datetime.utcnow() - timedelta(days=1))
+    for account in accounts:
+        with TweetStore(storage_name, account=account) as ts:
+            ts.schedule_tweets((first + timedelta(seconds=i), '{} tweet {}'.format(account, i), None)
+                               for i in range(num_tweets))
+
+
+def write_credentials(directory, accounts):
+    """Writes a credentials file for each account and an accounts file
+       listing them all, returning the name of the accounts file."""
+    accounts_name = os.path.join(directory, 'accounts')
+    with io.open(accounts_name, 'w', encoding='utf8') as accounts_file:
+        for account in accounts:
+            tokens = 'key secret {}-token {}-secret'.format(account, account)
+            with io.open(os.path.join(directory, account), 'w', encoding='utf8') as credentials_file:
+                credentials_file.write(tokens + '\n')
+            accounts_file.write('{} {}\n'.format(account, tokens))
+    return accounts_name
+
+
+def run_script(*args):
+    subprocess.run([sys.executable, SCRIPT] + list(args), check=True, stdout=subprocess.DEVNULL)
+
+
+def time_per_account(directory, storage_name, accounts, workers, server):
+    start = time.perf_counter()
+    for account in accounts:
+        run_script('--credentials', os.path.join(directory, account), '--account', account,
+                   '--workers', str(workers), '--api-url', server.base_url, storage_name)
+    return time.perf_counter() - start
+
+
+def time_single_run(accounts_name, storage_name, workers, server):
+    start = time.perf_counter()
+    run_script('--accounts', accounts_name, '--workers', str(workers), '--api-url', server.base_url, storage_name)
+    return time.perf_counter() - start
+
+
+def main(args):
+    accounts = account_names(args.accounts)
+    total = args.accounts * args.tweets
+    with tempfile.TemporaryDirectory() as directory, StubApiServer(args.latency) as server:
+        accounts_name = write_credentials(directory, accounts)
+        print('{:>14}  {:>10}  {:>12}'.format('mode', 'seconds', 'tweets/sec'))
+        modes = (
+            ('per account', lambda storage_name: time_per_account(directory, storage_name, accounts, args.workers,
+                                                                  server)),
+            ('--accounts', lambda storage_name: time_single_run(accounts_name, storage_name, args.workers, server)),
+        )
+        for run, (mode, timer) in enumerate(modes):
+            storage_name = os.path.join(directory, 'accounts-{}.db'.format(run))
+            queue_account_tweets(storage_name, accounts, args.tweets)
+            server.posted.clear()
+            elapsed = timer(storage_name)
+            assert sum(server.posted.values()) == total
+            assert len(server.posted) == args.accounts
+            print('{:>14}  {:>10.2f}  {:>12.0f}'.format(mode, elapsed, total / elapsed))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--accounts',
+                                 help='Number of accounts to queue tweets for.',
+                                 type=int,
+                                 default=40)
+    cli_main_parser.add_argument('--tweets',
+                                 help='Number of due tweets to queue per account.',
+                                 type=int,
+                                 default=20)
+    cli_main_parser.add_argument('--latency',
+                                 help='Simulated API latency, in seconds.',
+                                 type=float,
+                                 default=0.05)
+    cli_main_parser.add_argument('--workers',
+                                 help='Number of workers to post with.',
+                                 type=int,
+                                 default=16)
+    main(cli_main_parser.parse_args())
@@ -0,0 +1,67 @@
+#
+# Benchmark for importing many CSV files in parallel.
+#
+# Generates a number of CSV files then times import-tweets.py importing
+# all of them with the files command, using from 1 up to the number of
+# CPUs worth of worker processes.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.multi_file_import --files 24 --rows 50000
+#
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.data import write_csv
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import(storage_name, csv_pattern, jobs):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, os.path.join(REPOSITORY_ROOT, 'import-tweets.py'),
+                           '--output', storage_name, 'files', '--jobs', str(jobs), csv_pattern],
+                          cwd=REPOSITORY_ROOT, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main(args):
+    if args.jobs is not None:
+        job_counts = [int(x) for x in args.jobs.split(',')]
+    else:
+        job_counts = list(range(1, os.cpu_count() + 1))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(args.files):
+            write_csv(os.path.join(directory, 'partner-{}.csv'.format(i)), args.rows)
+        total_rows = args.files * args.rows
+
+        print('{:>6}  {:>10}  {:>12}  {:>8}'.format('jobs', 'seconds', 'rows/sec', 'speedup'))
+        baseline = None
+        for jobs in job_counts:
+            elapsed = time_import(os.path.join(directory, 'import-{}.db'.format(jobs)),
+                                  os.path.join(directory, '*.csv'), jobs)
+            if baseline is None:
+                baseline = elapsed
+            print('{:>6}  {:>10.2f}  {:>12.0f}  {:>7.2f}x'.format(jobs, elapsed, total_rows / elapsed,
+                                                                 baseline / elapsed))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--files',
+                                 help='Number of CSV files to generate.',
+                                 type=int,
+                                 default=24)
+    cli_main_parser.add_argument('--rows',
+                                 help='Number of rows in each CSV file.',
+                                 type=int,
+                                 default=10000)
+    cli_main_parser.add_argument('--jobs',
+                                 help='Comma separated numbers of worker processes to import with. '
+                                      'Defaults to every count from 1 to the number of CPUs.')
+    main(cli_main_parser.parse_args())
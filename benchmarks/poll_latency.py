@@ -0,0 +1,85 @@
+#
+# Benchmark for the latency of polling a store for due tweets.
+#
+# Builds stores containing a growing number of already posted rows
+# alongside a fixed number of pending rows, then times
+# TweetStore.process_due_tweets against each. With the pending index
+# in place the poll time should stay flat as the history grows.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.poll_latency --sizes 10000,100000,1000000,10000000
+#
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from schtweet.storage import TweetStore, utc_epoch
+
+PENDING_ROWS = 100
+INSERT_CHUNK = 50000
+
+
+def build_store(storage_name, num_rows):
+    """Creates a store with num_rows of posted history plus PENDING_ROWS
+       unposted rows, half of which are due."""
+    base = datetime(2000, 1, 1)
+    now = datetime.utcnow()
+
+    with TweetStore(storage_name) as ts:
+        cursor = ts._connection.cursor()
+        for chunk_start in range(0, num_rows, INSERT_CHUNK):
+            chunk_end = min(chunk_start + INSERT_CHUNK, num_rows)
+            rows = []
+            for i in range(chunk_start, chunk_end):
+                date = base + timedelta(minutes=i)
+                rows.append((date, utc_epoch(date), 'Historical tweet {}'.format(i), str(i), date))
+            cursor.executemany('''INSERT INTO tweets (tweet_on_date, tweet_on_epoch, tweet_text, tweet_id, tweeted_date)
+                                  VALUES (?,?,?,?,?)''', rows)
+        rows = []
+        for i in range(PENDING_ROWS):
+            date = now + timedelta(days=i - PENDING_ROWS // 2)
+            rows.append((date, utc_epoch(date), 'Pending tweet {}'.format(i)))
+        cursor.executemany('''INSERT INTO tweets (tweet_on_date, tweet_on_epoch, tweet_text) VALUES (?,?,?)''', rows)
+
+
+def time_poll(storage_name, repeats):
+    """Returns the best time in seconds taken to poll for due tweets. The
+       processor never reports success so every poll sees the same rows."""
+    def processor(tweet, scheduled_date):
+        return None
+
+    best = None
+    with TweetStore(storage_name) as ts:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            ts.process_due_tweets(processor)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+
+def main(args):
+    sizes = [int(x) for x in args.sizes.split(',')]
+    with tempfile.TemporaryDirectory() as directory:
+        print('{:>12}  {:>12}'.format('rows', 'poll (ms)'))
+        for size in sizes:
+            storage_name = os.path.join(directory, 'poll-{}.db'.format(size))
+            build_store(storage_name, size)
+            elapsed = time_poll(storage_name, args.repeats)
+            print('{:>12}  {:>12.3f}'.format(size, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--sizes',
+                                 help='Comma separated numbers of historical rows to benchmark against.',
+                                 default='10000,100000,1000000')
+    cli_main_parser.add_argument('--repeats',
+                                 help='Number of polls to run per size. The best time is reported.',
+                                 type=int,
+                                 default=20)
+    main(cli_main_parser.parse_args())
@@ -0,0 +1,69 @@
+#
+# Benchmark for the throughput of posting a backlog of due tweets.
+#
+# Queues a number of due tweets then drains them with the PostingEngine
+# against a stub API with varying simulated latency and numbers of
+# workers. Results are reported in tweets/sec.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.posting_throughput --tweets 1000 --latencies 0,0.01,0.05 --workers 1,4,16
+#
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from benchmarks.stubs import StubApi
+from schtweet.posting import PostingEngine
+from schtweet.storage import TweetStore
+
+
+def queue_tweets(storage_name, num_tweets):
+    first = pytz.utc.localize(datetime.utcnow() - timedelta(days=1))
+    with TweetStore(storage_name) as ts:
+        ts.schedule_tweets((first + timedelta(seconds=i), 'Queued tweet {}'.format(i), None)
+                           for i in range(num_tweets))
+
+
+def time_drain(storage_name, api, workers):
+    def post_update(tweet_text):
+        return api.PostUpdate(tweet_text).id_str
+
+    engine = PostingEngine(post_update, workers=workers)
+    start = time.perf_counter()
+    with TweetStore(storage_name) as ts:
+        _, sent = engine.process(ts)
+    return sent, time.perf_counter() - start
+
+
+def main(args):
+    latencies = [float(x) for x in args.latencies.split(',')]
+    worker_counts = [int(x) for x in args.workers.split(',')]
+    with tempfile.TemporaryDirectory() as directory:
+        print('{:>10}  {:>8}  {:>10}  {:>12}'.format('latency', 'workers', 'seconds', 'tweets/sec'))
+        for latency in latencies:
+            for workers in worker_counts:
+                storage_name = os.path.join(directory, 'posting-{}-{}.db'.format(latency, workers))
+                queue_tweets(storage_name, args.tweets)
+                sent, elapsed = time_drain(storage_name, StubApi(latency), workers)
+                assert sent == args.tweets
+                print('{:>10.3f}  {:>8}  {:>10.2f}  {:>12.0f}'.format(latency, workers, elapsed, sent / elapsed))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--tweets',
+                                 help='Number of due tweets to queue.',
+                                 type=int,
+                                 default=1000)
+    cli_main_parser.add_argument('--latencies',
+                                 help='Comma separated simulated API latencies, in seconds.',
+                                 default='0,0.01,0.05')
+    cli_main_parser.add_argument('--workers',
+                                 help='Comma separated numbers of workers to post with.',
+                                 default='1,4,16')
+    main(cli_main_parser.parse_args())
@@ -0,0 +1,70 @@
+#
+# Benchmark for generating a schedule with schedule-lines.py.
+#
+# Generates a lines file then times schedule-lines.py scheduling it
+# forwards from a start date, which streams the input once, and backwards
+# from an end date, which also has to count the input lines first. Then
+# compares scheduling into a database via a CSV and import-tweets.py with
+# scheduling straight into the database.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.schedule_lines --lines 10000000
+#
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.data import write_lines
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_script(name, *args):
+    subprocess.check_call([sys.executable, os.path.join(REPOSITORY_ROOT, name)] + list(args),
+                          cwd=REPOSITORY_ROOT, stdout=subprocess.DEVNULL)
+
+
+def time_schedule_lines(lines_name, date_option, *output_args):
+    start = time.perf_counter()
+    run_script('schedule-lines.py', date_option, '01/01/2030', '--times', '0900,1230,1800,2100',
+               *(list(output_args) + [lines_name]))
+    return time.perf_counter() - start
+
+
+def time_schedule_and_import(lines_name, csv_name, database_name):
+    start = time.perf_counter()
+    run_script('schedule-lines.py', '--start', '01/01/2030', '--times', '0900,1230,1800,2100',
+               '--overwrite', '--output', csv_name, lines_name)
+    run_script('import-tweets.py', '--output', database_name, 'csv', csv_name)
+    return time.perf_counter() - start
+
+
+def report(name, num_lines, elapsed):
+    print('{:<32}  {:>10.2f} s  {:>12.0f} lines/sec'.format(name, elapsed, num_lines / elapsed))
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        lines_name = os.path.join(directory, 'lines.txt')
+        write_lines(lines_name, args.lines)
+        csv_name = os.path.join(directory, 'schedule.csv')
+        for date_option in ('--start', '--end'):
+            report('CSV {}'.format(date_option), args.lines,
+                   time_schedule_lines(lines_name, date_option, '--overwrite', '--output', csv_name))
+        report('CSV then import-tweets.py', args.lines,
+               time_schedule_and_import(lines_name, csv_name, os.path.join(directory, 'imported.db')))
+        report('--database', args.lines,
+               time_schedule_lines(lines_name, '--start', '--database', os.path.join(directory, 'direct.db')))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--lines',
+                                 help='Number of lines in the generated input.',
+                                 type=int,
+                                 default=1000000)
+    main(cli_main_parser.parse_args())
@@ -0,0 +1,99 @@
+#
+# Benchmark for allocating free time slots around an existing schedule.
+#
+# Builds a store holding a busy calendar, with every other time slot taken
+# and some days fully booked. Then times loading the taken slots with
+# scheduled_epochs and allocating the free slots with a SlotAllocator, as
+# schedule-lines.py --fill does. Allocating a line should cost about the same
+# however many tweets are already scheduled.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.slot_allocation --sizes 10000,100000,1000000
+#
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from schtweet.dates import UtcConverter
+from schtweet.slots import SlotAllocator
+from schtweet.storage import TweetStore
+
+TIMEZONE = pytz.timezone('Europe/London')
+
+FIRST_DAY = datetime(2030, 1, 1)
+
+SLOT_TIMES = [datetime.strptime(time, '%H%M') for time in ('0900', '1230', '1800', '2100')]
+
+# Every this many days is fully booked
+FULL_DAY_INTERVAL = 7
+
+
+def busy_calendar(num_rows):
+    """Generator of num_rows (date, text, url) rows, taking every other slot
+       of SLOT_TIMES on most days and all of them on every FULL_DAY_INTERVAL
+       days."""
+    day = FIRST_DAY
+    num_generated = 0
+    while num_generated < num_rows:
+        full = (day - FIRST_DAY).days % FULL_DAY_INTERVAL == 0
+        for index, slot in enumerate(SLOT_TIMES):
+            if num_generated < num_rows and (full or index % 2 == 0):
+                schedule = day.replace(hour=slot.hour, minute=slot.minute)
+                yield TIMEZONE.localize(schedule), 'Existing tweet {}'.format(num_generated), None
+                num_generated += 1
+        day += timedelta(days=1)
+
+
+def time_allocation(storage_name, num_lines, max_per_day, min_spacing):
+    """Returns the seconds taken to load the taken slots and to allocate
+       num_lines free slots around them."""
+    start = time.perf_counter()
+    with TweetStore(storage_name) as ts:
+        occupied = ts.scheduled_epochs(UtcConverter(TIMEZONE).epoch(FIRST_DAY))
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    allocator = SlotAllocator(FIRST_DAY, SLOT_TIMES, TIMEZONE, occupied, max_per_day=max_per_day,
+                              min_spacing=min_spacing)
+    for _, _ in zip(range(num_lines), allocator.slots()):
+        pass
+    allocate = time.perf_counter() - start
+    return load, allocate
+
+
+def main(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    min_spacing = timedelta(minutes=args.min_spacing)
+    with tempfile.TemporaryDirectory() as directory:
+        print('{:>10}  {:>10}  {:>14}  {:>14}'.format('scheduled', 'load (s)', 'allocate (s)', 'per line (us)'))
+        for size in sizes:
+            storage_name = os.path.join(directory, 'busy-{}.db'.format(size))
+            with TweetStore(storage_name) as ts:
+                ts.schedule_tweets(busy_calendar(size))
+            load, allocate = time_allocation(storage_name, args.lines, args.max_per_day, min_spacing)
+            print('{:>10}  {:>10.2f}  {:>14.2f}  {:>14.2f}'.format(size, load, allocate, allocate * 1e6 / args.lines))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--sizes',
+                                 help='Comma separated numbers of tweets already scheduled.',
+                                 default='10000,100000,1000000')
+    cli_main_parser.add_argument('--lines',
+                                 help='Number of free slots to allocate against each calendar.',
+                                 type=int,
+                                 default=1000000)
+    cli_main_parser.add_argument('--max-per-day',
+                                 help='Maximum tweets per day to allocate with.',
+                                 type=int,
+                                 default=3)
+    cli_main_parser.add_argument('--min-spacing',
+                                 help='Minimum minutes between tweets to allocate with.',
+                                 type=int,
+                                 default=60)
+    main(cli_main_parser.parse_args())
@@ -0,0 +1,92 @@
+#
+# Benchmark for the start up cost of the scripts.
+#
+# Runs each script on a path which does no real work, such as --help or
+# posting from an empty store, with python -X importtime. Reports the
+# median wall clock time of the whole run, the total time spent importing
+# modules and the slowest top level imports.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.startup --repeats 10
+#
+import argparse
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def no_op_commands(directory):
+    """Returns (name, arguments) pairs for runs of the scripts which do no
+       real work."""
+    credentials_name = os.path.join(directory, 'access')
+    with io.open(credentials_name, 'w', encoding='utf8') as credentials_file:
+        credentials_file.write('key secret token token-secret\n')
+    storage_name = os.path.join(directory, 'empty.db')
+    return [
+        ('post --help', ['post-scheduled-tweets.py', '--help']),
+        ('post --nopost', ['post-scheduled-tweets.py', '--nopost', '--credentials', credentials_name, storage_name]),
+        ('import --help', ['import-tweets.py', '--help']),
+        ('schedule-lines --help', ['schedule-lines.py', '--help']),
+        ('compact --help', ['compact-tweets.py', '--help']),
+        ('serve --help', ['serve-tweets.py', '--help']),
+    ]
+
+
+def import_times(stderr):
+    """Parses -X importtime output, returning the total microseconds spent
+       importing and a dict of the cumulative microseconds of each top level
+       import."""
+    top_level = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented by two spaces per level
+        if not name.startswith('  '):
+            top_level[name.strip()] = int(cumulative)
+    return sum(top_level.values()), top_level
+
+
+def time_command(arguments, repeats):
+    """Returns the median wall clock seconds of running arguments, and the
+       import times of the last run."""
+    elapsed = []
+    stderr = ''
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, cwd=REPOSITORY_ROOT,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed.append(time.perf_counter() - start)
+        stderr = result.stderr
+    return statistics.median(elapsed), import_times(stderr)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        print('{:<24}  {:>10}  {:>12}  {}'.format('run', 'wall (ms)', 'imports (ms)', 'slowest imports'))
+        for name, arguments in no_op_commands(directory):
+            wall, (total, top_level) = time_command(arguments, args.repeats)
+            slowest = sorted(top_level.items(), key=lambda item: -item[1])[:args.top]
+            print('{:<24}  {:>10.1f}  {:>12.1f}  {}'.format(
+                name, wall * 1000, total / 1000,
+                ', '.join('{} {:.1f}'.format(module, micros / 1000) for module, micros in slowest)))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--repeats',
+                                 help='Number of times to run each script. The median time is reported.',
+                                 type=int,
+                                 default=10)
+    cli_main_parser.add_argument('--top',
+                                 help='Number of the slowest top level imports to list for each run.',
+                                 type=int,
+                                 default=4)
+    main(cli_main_parser.parse_args())
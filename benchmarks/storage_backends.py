@@ -0,0 +1,82 @@
+#
+# Benchmark comparing the SQLite and in-memory storage backends.
+#
+# For each backend, imports a number of tweets, half of them due, then
+# times looking up the next upcoming tweet as the daemon does, polling
+# for the due tweets and draining them with the PostingEngine against a
+# stub API with no latency.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.storage_backends --rows 1000000
+#
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from benchmarks.stubs import StubApi
+from schtweet.memory import MemoryTable, MemoryTweetStore
+from schtweet.posting import PostingEngine
+from schtweet.storage import TweetStore
+
+LOOKUP_REPEATS = 1000
+
+
+def generated_rows(num_rows):
+    first = pytz.utc.localize(datetime.utcnow()) - timedelta(minutes=num_rows // 2)
+    for i in range(num_rows):
+        yield first + timedelta(minutes=i), 'Generated tweet number {}'.format(i), None
+
+
+def time_backend(create_store, num_rows):
+    """Returns the seconds taken to import, the mean seconds per upcoming
+       tweet lookup, and the seconds taken to poll and drain the due tweets."""
+    api = StubApi()
+    engine = PostingEngine(lambda tweet_text: api.PostUpdate(tweet_text).id_str)
+    with create_store() as ts:
+        start = time.perf_counter()
+        ts.schedule_tweets(generated_rows(num_rows))
+        imported = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(LOOKUP_REPEATS):
+            ts.upcoming_tweets(1)
+        lookup = (time.perf_counter() - start) / LOOKUP_REPEATS
+
+        start = time.perf_counter()
+        due = sum(1 for _ in ts.due_tweets())
+        poll = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, sent = engine.process(ts)
+        drain = time.perf_counter() - start
+    assert sent == due
+    return imported, lookup, poll, drain
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        table = MemoryTable()
+        backends = (
+            ('sqlite', lambda: TweetStore(os.path.join(directory, 'backend.db'))),
+            ('memory', lambda: MemoryTweetStore(table=table)),
+        )
+        print('{:>8}  {:>10}  {:>12}  {:>10}  {:>10}'.format('backend', 'import (s)', 'lookup (us)', 'poll (s)',
+                                                            'drain (s)'))
+        for name, create_store in backends:
+            imported, lookup, poll, drain = time_backend(create_store, args.rows)
+            print('{:>8}  {:>10.2f}  {:>12.1f}  {:>10.3f}  {:>10.2f}'.format(name, imported, lookup * 1e6, poll,
+                                                                            drain))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--rows',
+                                 help='Number of tweets to import. Half of them are due.',
+                                 type=int,
+                                 default=100000)
+    main(cli_main_parser.parse_args())
@@ -0,0 +1,111 @@
+#
+# Local stand-ins for the Twitter API used by the benchmarks.
+#
+import http.server
+import itertools
+import json
+import socketserver
+import threading
+import time
+import urllib.parse
+from collections import namedtuple
+
+StubStatus = namedtuple('StubStatus', 'id_str, text')
+
+
+class StubApi(object):
+    """Stands in for twitter.Api. PostUpdate sleeps for latency seconds to
+       simulate the round trip, then returns a status with a unique ID."""
+
+    def __init__(self, latency=0.0, **tokens):
+        self.latency = latency
+        self.posted = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def PostUpdate(self, status):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            status_id = next(self._ids)
+            self.posted.append(status)
+        return StubStatus(str(status_id), status)
+
+
+class StubApiServer(object):
+    """Local HTTP server standing in for the Twitter API, for running the
+       posting script against with --api-url. Posts to statuses/update.json
+       sleep for latency seconds, then return a status with a unique ID.
+       The number of posts made with each access token is kept in posted.
+
+       Use as a context manager, which serves on a background thread."""
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.posted = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), _handler_for(self))
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/1.1'.format(host, port)
+
+    def record_post(self, access_token, status):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            status_id = next(self._ids)
+            self.posted[access_token] = self.posted.get(access_token, 0) + 1
+        return {'id': status_id, 'id_str': str(status_id), 'text': status}
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def _handler_for(stub):
+    class StubApiHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8')
+            if urllib.parse.urlsplit(self.path).path != '/1.1/statuses/update.json':
+                self.__respond(404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist.'}]})
+                return
+            status = urllib.parse.parse_qs(body).get('status', [''])[0]
+            self.__respond(200, stub.record_post(access_token(self.headers.get('Authorization', '')), status))
+
+        def __respond(self, code, content):
+            encoded = json.dumps(content).encode('utf8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubApiHandler
+
+
+def access_token(authorization):
+    """Returns the oauth_token from an OAuth 1 Authorization header."""
+    for part in authorization.split(','):
+        name, _, value = part.strip().partition('=')
+        if name.endswith('oauth_token'):
+            return urllib.parse.unquote(value.strip('"'))
+    return None
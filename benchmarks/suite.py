@@ -0,0 +1,152 @@
+#
+# Benchmark suite for the whole pipeline.
+#
+# For each size, generates synthetic data then times:
+#
+#   schedule_lines  schedule-lines.py scheduling a lines file into a CSV
+#   import_csv      import-tweets.py importing a CSV of due tweets
+#   drain_due       TweetStore.process_due_tweets posting every due tweet
+#                   to a stub callback
+#   poll_idle       TweetStore.process_due_tweets on the drained store
+#
+# Results are written as JSON, tagged with the current git commit, so
+# runs against different commits can be compared with --compare.
+#
+# Run from the repository root with:
+#
+#   python -m benchmarks.suite --sizes 1000,100000,10000000 --output results.json
+#
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.data import EVERY_MINUTE, write_csv, write_lines
+from schtweet.storage import TweetStore
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+POLL_REPEATS = 20
+
+
+def run_script(name, *args):
+    subprocess.check_call([sys.executable, os.path.join(REPOSITORY_ROOT, name)] + list(args),
+                          cwd=REPOSITORY_ROOT, stdout=subprocess.DEVNULL)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def drain_due(storage_name):
+    def processor(tweet, scheduled_date):
+        return '1'
+
+    with TweetStore(storage_name) as ts:
+        ts.process_due_tweets(processor)
+
+
+def poll_idle(storage_name):
+    """Returns the best time of POLL_REPEATS polls of a store with nothing due."""
+    def processor(tweet, scheduled_date):
+        raise AssertionError('Nothing should be due')
+
+    best = None
+    with TweetStore(storage_name) as ts:
+        for _ in range(POLL_REPEATS):
+            elapsed = time_call(ts.process_due_tweets, processor)
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(benchmark, rows, seconds):
+    return {'benchmark': benchmark, 'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds}
+
+
+def run_size(directory, rows):
+    lines_name = os.path.join(directory, 'lines-{}.txt'.format(rows))
+    csv_name = os.path.join(directory, 'due-{}.csv'.format(rows))
+    storage_name = os.path.join(directory, 'store-{}.db'.format(rows))
+    write_lines(lines_name, rows)
+    # Schedule the CSV in the past so every row is due
+    first_day = datetime.now() - timedelta(days=rows // len(EVERY_MINUTE) + 2)
+    write_csv(csv_name, rows, first_day=first_day, slot_times=EVERY_MINUTE)
+
+    results = [
+        result('schedule_lines', rows,
+               time_call(run_script, 'schedule-lines.py', '--start', '01/01/2030', '--times', '0900,1230,1800,2100',
+                         '--overwrite', '--output', os.path.join(directory, 'schedule.csv'), lines_name)),
+        result('import_csv', rows,
+               time_call(run_script, 'import-tweets.py', '--output', storage_name, 'csv', csv_name)),
+        result('drain_due', rows, time_call(drain_due, storage_name)),
+        result('poll_idle', rows, poll_idle(storage_name)),
+    ]
+
+    for name in (lines_name, csv_name, storage_name):
+        os.remove(name)
+    return results
+
+
+def compare(results, previous):
+    """Prints the change in time of each result against the matching result
+       in a previous run."""
+    previous_times = {(x['benchmark'], x['rows']): x['seconds'] for x in previous['results']}
+    print('Compared with {}:'.format(previous.get('commit')))
+    for x in results:
+        before = previous_times.get((x['benchmark'], x['rows']))
+        if before is not None:
+            print('{:<16} {:>10}  {:>12.6f}s -> {:>12.6f}s  {:>+7.1f}%'.format(
+                x['benchmark'], x['rows'], before, x['seconds'], (x['seconds'] - before) * 100 / before))
+
+
+def main(args):
+    sizes = [int(x) for x in args.sizes.split(',')]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            results.extend(run_size(directory, rows))
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as previous_file:
+            compare(results, json.load(previous_file))
+
+
+if __name__ == '__main__':
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('--sizes',
+                                 help='Comma separated numbers of rows to run the suite at.',
+                                 default='1000,100000')
+    cli_main_parser.add_argument('--output',
+                                 help='File to write the JSON results to. Defaults to stdout.')
+    cli_main_parser.add_argument('--compare',
+                                 help='JSON results of a previous run to compare against.')
+    main(cli_main_parser.parse_args())
@@ -0,0 +1,98 @@
+#
+# Script to move tweets which were posted
+# long ago out of the scheduled tweets
+# storage, and shrink the storage file.
+#
+#
+# Version: 1.0
+#
+import argparse
+import os
+from datetime import datetime, timedelta
+
+from schtweet.metrics import METRICS
+from schtweet.profiling import add_profile_argument, profiled
+from schtweet.storage import TweetStore, DEFAULT_CHUNK_SIZE
+
+DEFAULT_DAYS = 30
+
+VERBOSE = False
+
+
+def verbose_log(message, *args):
+    if VERBOSE:
+        print(message.format(*args) if len(args) > 0 else message)
+
+
+def compact_storage(storage_file, days, archive_file, batch_size, vacuum):
+    posted_before = datetime.now() - timedelta(days=days)
+    verbose_log('Archiving tweets posted before {}', posted_before.isoformat())
+    if archive_file is not None:
+        verbose_log('Archiving to storage: {}', archive_file)
+
+    size_before = os.path.getsize(storage_file)
+    with TweetStore(storage_file) as ts:
+        num_archived = ts.archive_posted(posted_before, archive_file, batch_size)
+        METRICS.increment('tweets_archived', num_archived)
+        print('Archived {} tweets posted more than {} days ago'.format(num_archived, days))
+
+        if vacuum:
+            verbose_log('Vacuuming storage: {}', storage_file)
+            pages_freed = ts.vacuum()
+            METRICS.increment('pages_vacuumed', pages_freed)
+
+    size_after = os.path.getsize(storage_file)
+    print('Storage size reduced from {:.1f}MB to {:.1f}MB'.format(size_before / 1e6, size_after / 1e6))
+
+
+def create_parser():
+    """Returns the parser for the command line of this script."""
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('-v', '--verbose',
+                                 help='Say all the things',
+                                 action='store_true')
+    cli_main_parser.add_argument('-d', '--days',
+                                 help='Archive tweets posted more than this many days ago.',
+                                 type=float,
+                                 default=DEFAULT_DAYS)
+    cli_main_parser.add_argument('-a', '--archive',
+                                 help='The name of a separate file to move the archived tweets to. Will be created if '
+                                      'it does not exist. Defaults to an archived_tweets table in the storage file.')
+    cli_main_parser.add_argument('-b', '--batch-size',
+                                 help='The number of tweets to archive per transaction.',
+                                 type=int,
+                                 default=DEFAULT_CHUNK_SIZE)
+    cli_main_parser.add_argument('--no-vacuum',
+                                 help='Only archive the tweets, leaving the storage file its current size.',
+                                 action='store_true')
+    cli_main_parser.add_argument('-m', '--metrics',
+                                 help='Write counters and timings for the run to this file when finished. Written in '
+                                      'the Prometheus text format if the name ends with .prom, otherwise as JSON.')
+    add_profile_argument(cli_main_parser)
+    cli_main_parser.add_argument('storage_file',
+                                 help='The name of the file the scheduled tweets are stored in.')
+    return cli_main_parser
+
+
+def main(argv=None):
+    """Parses the command line, from sys.argv unless argv is given, and
+       performs the user's bidding."""
+    global VERBOSE
+    args = create_parser().parse_args(argv)
+    if args.verbose:
+        VERBOSE = True
+    if args.metrics is not None:
+        METRICS.enable()
+    if not os.path.exists(args.storage_file):
+        raise SystemExit('Storage file {} does not exist.'.format(args.storage_file))
+
+    try:
+        with profiled(args.profile, args.storage_file, 'compact-tweets'):
+            compact_storage(args.storage_file, args.days, args.archive, args.batch_size, not args.no_vacuum)
+    finally:
+        if args.metrics is not None:
+            METRICS.write(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,118 +1,260 @@
 #
-# Script to import tweets from a CSV
-# file or string and store them for
+# Script to import tweets from CSV
+# files or a string and store them for
 # later tweeting.
 #
 # The format of the CSV should be:
 #
 #   date,tweet_text,[optional url]
 #
+# A fourth column, such as the reason
+# written to a --rejects file, is ignored.
+#
 # Version: 1.0
 #
 import argparse
 import csv
+import glob
 import io
-from collections import namedtuple
-
-import pytz
-from dateutil import parser
+import os
 
-from schtweet.storage import TweetStore
-
-ImportedRow = namedtuple('ImportedRow', 'date, tweet, url')
+from schtweet.metrics import METRICS
+from schtweet.profiling import add_profile_argument, profiled
+from schtweet.render import RejectsReport, validated_values
+from schtweet.storage import open_store, DEFAULT_ACCOUNT, DEFAULT_CHUNK_SIZE
 
 VERBOSE = False
 
 
-def verbose_log(message):
-    """Logs a message to stdout if"""
+def verbose_log(message, *args):
+    """Logs a message to stdout if verbose. Any args are only formatted
+       into the message when it is logged."""
     if VERBOSE:
-        print(message)
+        print(message.format(*args) if len(args) > 0 else message)
+
 
+def logged_values(values):
+    """Passes through rows normalised by tweet_values, logging each."""
+    for row_count, value in enumerate(values, 1):
+        verbose_log('Read row {}', row_count)
+        verbose_log('Scheduling tweet: date="{}", tweet="{}", url="{}"', value[0], value[2], value[3])
+        yield value
 
-def parse_row(row, default_timezone):
-    """Parses a CSV row and returned the data in the named tuple ImportedRow."""
-    row_date_string = row[0]
-    row_date = parser.parse(row_date_string, dayfirst=True)
-    if row_date.tzinfo is None:
-        row_date = default_timezone.localize(row_date)
-        verbose_log('No timezone info found, added timezone {}'.format(row_date.tzinfo))
-    else:
-        verbose_log('Detected timezone info: {}'.format(row_date.tzinfo))
 
-    if len(row) == 0 or len(row) > 3:
-        raise SystemExit('Could not read row. Expected 2 or 3 columns but found {}'
-                         '. Ensure you are using the format:'
-                         ' date,tweet_text,[optional url]'.format(len(row)))
+def log_duplicate(values):
+    """on_duplicate callback for TweetStore, logging each skipped row."""
+    verbose_log('Skipping duplicate tweet: date="{}", tweet="{}", url="{}"', values[0], values[2], values[3])
 
-    row_tweet = row[1]
-    row_url = ''
-    if len(row) > 2:
-        row_url = row[2]
 
-    return ImportedRow(row_date, row_tweet, row_url)
+def report_rejects(rejects):
+    METRICS.increment('rows_rejected', rejects.count)
+    if rejects.count > 0 and rejects.filename is not None:
+        print('Wrote {} rejected rows to {}'.format(rejects.count, rejects.filename))
 
 
-def parse_csv(csv_input, db_output, default_timezone):
-    """Iterate over CSV lines, parsing each and appending it to the specified storage."""
+def imported_message(row_count, duplicates, dedup, rejected=0):
+    message = 'Imported {} rows'.format(row_count)
+    if dedup:
+        message += ', skipped {} duplicates'.format(duplicates)
+    if rejected > 0:
+        message += ', rejected {}'.format(rejected)
+    return message
+
+
+def parse_csv(csv_input, db_output, default_timezone, batch_size, journal_mode=None, synchronous=None,
+              account=DEFAULT_ACCOUNT, dedup=False, rejects_file=None):
+    """Stream CSV lines into the specified storage, parsing each row and inserting them in batches.
+       Rows which can't be posted are reported, and written to rejects_file if given, instead."""
+    from schtweet.csvimport import RowError, read_values
     reader = csv.reader(csv_input)
-    row_count = 0
-    verbose_log('Writing to storage: {}'.format(db_output))
-    with TweetStore(storage_name=db_output) as ts:
-        for row in reader:
-            row_count += 1
-            verbose_log('Reading row {}'.format(row_count))
-            record = parse_row(row, default_timezone)
-            verbose_log('Scheduling tweet: date="{}",'
-                        ' tweet="{}", url="{}"'.format(record.date, record.tweet, record.url))
-            ts.schedule_tweet(record.date, record.tweet, record.url)
-    print('Imported {} rows'.format(row_count))
+    verbose_log('Writing to storage: {}', db_output)
+    with open_store(storage_name=db_output, account=account) as ts, RejectsReport(rejects_file, print) as rejects:
+        with ts.bulk_load(journal_mode=journal_mode, synchronous=synchronous):
+            try:
+                values = validated_values(logged_values(read_values(reader, default_timezone)), rejects)
+                row_count = ts.schedule_tweet_values(values, chunk_size=batch_size, dedup=dedup,
+                                                     on_duplicate=log_duplicate)
+            except RowError as e:
+                raise SystemExit(str(e))
+    METRICS.increment('rows_imported', row_count)
+    METRICS.increment('rows_skipped', ts.duplicates_skipped)
+    report_rejects(rejects)
+    print(imported_message(row_count, ts.duplicates_skipped, dedup, rejects.count))
+
+
+def parse_timezone(name):
+    """Returns the pytz timezone called name. pytz is imported here, rather
+       than at the top, so --help and argument errors don't wait for it."""
+    import pytz
+    return pytz.timezone(name)
 
 
 def parse_csv_file(command_args):
-    verbose_log('Reading CSV from file: {}'.format(command_args.csv_file))
+    verbose_log('Reading CSV from file: {}', command_args.csv_file)
     with io.open(command_args.csv_file, 'r', encoding='utf8') as csvfile:
-        parse_csv(csvfile, command_args.output, pytz.timezone(command_args.timezone))
+        parse_csv(csvfile, command_args.output, parse_timezone(command_args.timezone), command_args.batch_size,
+                  command_args.journal_mode, command_args.synchronous, command_args.account,
+                  command_args.dedup, command_args.rejects)
 
 
 def parse_csv_string(command_args):
-    verbose_log('Reading CSV from string: {}'.format(command_args.csv_string))
-    parse_csv(command_args.csv_string.splitlines(), command_args.output, pytz.timezone(command_args.timezone))
-
-
-########################################
-# Set up the CLI parse
-cli_main_parser = argparse.ArgumentParser()
-cli_main_parser.add_argument('-v', '--verbose',
-                             help='Say all the things',
-                             action='store_true')
-cli_main_parser.add_argument('-t', '--timezone',
-                             help='The timezone to apply to dates without timzeone information',
-                             default='Europe/London')
-cli_main_parser.add_argument('-o', '--output',
-                             help='The name of the file to append the imported data to.'
-                                  ' Will be created if it does not exist.',
-                             default='scheduled-tweets.db')
-cli_child_parsers = cli_main_parser.add_subparsers(dest='command', title='Commands')
-cli_child_parsers.required = True
-
-cli_csv_parser = cli_child_parsers.add_parser('csv',
-                                              help="Import from CSV file")
-cli_csv_parser.add_argument('csv_file',
-                            help='The CSV file to import tweets from. '
-                                 'Should have the format: date,tweet_text,[optional url]')
-cli_csv_parser.set_defaults(func=parse_csv_file)
-
-cli_csv_parser = cli_child_parsers.add_parser('string', help="Import from CSV string")
-cli_csv_parser.add_argument('csv_string',
-                            help='A CSV string to import a tweet from. '
-                                 'Should have the format: date,tweet_text,[optional url]')
-cli_csv_parser.set_defaults(func=parse_csv_string)
-
-########################################
-# Parse the command line and perform
-# the user's bidding
-args = cli_main_parser.parse_args()
-if args.verbose:
-    VERBOSE = True
-args.func(args)
+    verbose_log('Reading CSV from string: {}', command_args.csv_string)
+    parse_csv(command_args.csv_string.splitlines(), command_args.output, parse_timezone(command_args.timezone),
+              command_args.batch_size, command_args.journal_mode, command_args.synchronous, command_args.account,
+              command_args.dedup, command_args.rejects)
+
+
+def expand_file_patterns(patterns):
+    """Expands any glob patterns, returning the sorted unique filenames and
+       the patterns which didn't match any files."""
+    filenames = set()
+    unmatched = []
+    for pattern in patterns:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        if len(matches) == 0:
+            unmatched.append(pattern)
+        filenames.update(matches)
+    return sorted(filenames), unmatched
+
+
+def parse_csv_files(command_args):
+    """Parses many CSV files in a pool of worker processes, inserting each
+       file's rows from this process as it is parsed. A file with an invalid
+       row is reported and skipped without affecting the others."""
+    from concurrent.futures import ProcessPoolExecutor
+    from schtweet.csvimport import parse_file
+
+    filenames, unmatched = expand_file_patterns(command_args.csv_files)
+    failures = ['{}: No files found'.format(pattern) for pattern in unmatched]
+    # Fail on an unknown timezone here, rather than in every worker
+    parse_timezone(command_args.timezone)
+
+    verbose_log('Importing {} files with {} workers', len(filenames), command_args.jobs)
+    verbose_log('Writing to storage: {}', command_args.output)
+    total_rows = 0
+    imported_files = 0
+    with open_store(storage_name=command_args.output, account=command_args.account) as ts, \
+            RejectsReport(command_args.rejects, print) as rejects:
+        with ts.bulk_load(journal_mode=command_args.journal_mode, synchronous=command_args.synchronous):
+            with ProcessPoolExecutor(max_workers=command_args.jobs) as pool:
+                parsed_files = pool.map(parse_file, filenames, [command_args.timezone] * len(filenames))
+                for parsed in parsed_files:
+                    if parsed.error is not None:
+                        METRICS.increment('files_failed')
+                        print('Failed to import {}: {}'.format(parsed.filename, parsed.error))
+                        failures.append('{}: {}'.format(parsed.filename, parsed.error))
+                        continue
+                    skipped_before = ts.duplicates_skipped
+                    rejected_before = rejects.count
+                    row_count = ts.schedule_tweet_values(validated_values(parsed.values, rejects),
+                                                         chunk_size=command_args.batch_size,
+                                                         dedup=command_args.dedup, on_duplicate=log_duplicate)
+                    print('{} from {}'.format(imported_message(row_count, ts.duplicates_skipped - skipped_before,
+                                                               command_args.dedup, rejects.count - rejected_before),
+                                              parsed.filename))
+                    total_rows += row_count
+                    METRICS.increment('rows_imported', row_count)
+                    imported_files += 1
+        METRICS.increment('rows_skipped', ts.duplicates_skipped)
+
+    report_rejects(rejects)
+    print('{} from {} files'.format(imported_message(total_rows, ts.duplicates_skipped, command_args.dedup,
+                                                     rejects.count), imported_files))
+    if len(failures) > 0:
+        raise SystemExit('Failed to import {} files:\n{}'.format(len(failures), '\n'.join(failures)))
+
+
+def create_parser():
+    """Returns the parser for the command line of this script."""
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('-v', '--verbose',
+                                 help='Say all the things',
+                                 action='store_true')
+    cli_main_parser.add_argument('-t', '--timezone',
+                                 help='The timezone to apply to dates without timzeone information',
+                                 default='Europe/London')
+    cli_main_parser.add_argument('-o', '--output',
+                                 help='The name of the file to append the imported data to.'
+                                      ' Will be created if it does not exist.',
+                                 default='scheduled-tweets.db')
+    cli_main_parser.add_argument('-a', '--account',
+                                 help='The account to schedule the imported tweets for, when one storage file holds '
+                                      'the tweets of many accounts. Defaults to the unnamed account.',
+                                 default=DEFAULT_ACCOUNT)
+    cli_main_parser.add_argument('-d', '--dedup',
+                                 help='Skip rows with the same date, text and URL as a tweet already imported with '
+                                      '--dedup for the account, or earlier in the import, so the same CSV can safely '
+                                      'be imported again. Reports the number of rows skipped.',
+                                 action='store_true')
+    cli_main_parser.add_argument('-r', '--rejects',
+                                 help='Write rows which can\'t be posted, such as tweets too long to post or with an '
+                                      'invalid URL, to this CSV file with the reason for each, instead of just '
+                                      'reporting them. Rejected rows are never scheduled.')
+    cli_main_parser.add_argument('-b', '--batch-size',
+                                 help='The number of rows to insert at once. Each import is a single transaction.',
+                                 type=int,
+                                 default=DEFAULT_CHUNK_SIZE)
+    cli_main_parser.add_argument('--journal-mode',
+                                 help='SQLite journal_mode to use for the duration of the import, e.g. MEMORY or WAL. '
+                                      'Defaults to leaving the database setting unchanged.',
+                                 choices=['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'])
+    cli_main_parser.add_argument('--synchronous',
+                                 help='SQLite synchronous setting to use for the duration of the import. OFF is '
+                                      'fastest but the database may be corrupted if the machine crashes mid-import. '
+                                      'Defaults to leaving the database setting unchanged.',
+                                 choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'])
+    cli_main_parser.add_argument('-m', '--metrics',
+                                 help='Write counters and timings for the run to this file when finished. Written in '
+                                      'the Prometheus text format if the name ends with .prom, otherwise as JSON.')
+    add_profile_argument(cli_main_parser)
+    cli_child_parsers = cli_main_parser.add_subparsers(dest='command', title='Commands')
+    cli_child_parsers.required = True
+
+    cli_csv_parser = cli_child_parsers.add_parser('csv',
+                                                  help="Import from CSV file")
+    cli_csv_parser.add_argument('csv_file',
+                                help='The CSV file to import tweets from. '
+                                     'Should have the format: date,tweet_text,[optional url]')
+    cli_csv_parser.set_defaults(func=parse_csv_file)
+
+    cli_csv_parser = cli_child_parsers.add_parser('files',
+                                                  help="Import from many CSV files in parallel")
+    cli_csv_parser.add_argument('-j', '--jobs',
+                                help='The number of worker processes to parse the files with. '
+                                     'Defaults to the number of CPUs.',
+                                type=int,
+                                default=os.cpu_count())
+    cli_csv_parser.add_argument('csv_files',
+                                nargs='+',
+                                help='The CSV files to import tweets from, or glob patterns matching them. '
+                                     'Each should have the format: date,tweet_text,[optional url]')
+    cli_csv_parser.set_defaults(func=parse_csv_files)
+
+    cli_csv_parser = cli_child_parsers.add_parser('string', help="Import from CSV string")
+    cli_csv_parser.add_argument('csv_string',
+                                help='A CSV string to import a tweet from. '
+                                     'Should have the format: date,tweet_text,[optional url]')
+    cli_csv_parser.set_defaults(func=parse_csv_string)
+    return cli_main_parser
+
+
+def main(argv=None):
+    """Parses the command line, from sys.argv unless argv is given, and
+       performs the user's bidding."""
+    global VERBOSE
+    args = create_parser().parse_args(argv)
+    if args.verbose:
+        VERBOSE = True
+    if args.metrics is not None:
+        METRICS.enable()
+
+    try:
+        with profiled(args.profile, args.output, 'import-tweets'):
+            args.func(args)
+    finally:
+        if args.metrics is not None:
+            METRICS.write(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
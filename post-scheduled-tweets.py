@@ -5,24 +5,33 @@
 #
 # Version: 1.0
 #
-from schtweet.storage import TweetStore
-from collections import namedtuple
+from schtweet.daemon import LatenessTracker, SchedulerDaemon
+from schtweet.metrics import METRICS
+from schtweet.profiling import add_profile_argument, profiled
+from schtweet.posting import MultiAccountPoster, PostingEngine, TokenBucket, DEFAULT_RATE_LIMIT, DEFAULT_RATE_PERIOD, \
+    DEFAULT_WORKERS, create_pool
+from schtweet.storage import open_store, DEFAULT_ACCOUNT
+from collections import namedtuple, OrderedDict
 import io
 import argparse
-import twitter
 import shutil
+import signal
 import os
+import threading
 
 AccessInformation = namedtuple('AccessInformation',
                                'consumer_key, consumer_secret, access_token_key, access_token_secret')
 
+# Rate limit exceeded, over capacity and internal error
+TRANSIENT_TWITTER_ERROR_CODES = {88, 130, 131}
+
 NO_POST = False
 VERBOSE = False
 
 
-def verbose_log(message):
+def verbose_log(message, *args):
     if VERBOSE:
-        print(message)
+        print(message.format(*args) if len(args) > 0 else message)
 
 
 def fetch_access_information(access_file):
@@ -40,90 +49,279 @@ def fetch_access_information(access_file):
     return AccessInformation(parts[0], parts[1], parts[2], parts[3])
 
 
-def post_tweets_from_file(storage_file, tokens):
-    verbose_log('Connecting with consumer_key="{}", '
-                'access_token_key="{}"'.format(tokens.consumer_key, tokens.access_token_key))
-    twitter_api = twitter.Api(**tokens._asdict())
+def fetch_accounts(accounts_file):
+    """Loads the access information of many accounts from a file, one
+       account per line. Blank lines and lines starting with # are skipped."""
+    accounts = OrderedDict()
+    with io.open(accounts_file, 'r', encoding='utf8') as file:
+        for line_number, line in enumerate(file, 1):
+            parts = line.split()
+            if len(parts) == 0 or parts[0].startswith('#'):
+                continue
+            if not len(parts) == 5:
+                raise SystemExit('Could not read line {} of {}. Expected line with: <account> '
+                                 '<consumer_key> <consumer_secret> <access_token_key> '
+                                 '<access_token_secret>'.format(line_number, accounts_file))
+            if parts[0] in accounts:
+                raise SystemExit('Account {} is listed more than once in {}'.format(parts[0], accounts_file))
+            accounts[parts[0]] = AccessInformation(parts[1], parts[2], parts[3], parts[4])
 
-    processed_tweets = 0
-    sent_tweets = 0
+    if len(accounts) == 0:
+        raise SystemExit('No accounts found in {}'.format(accounts_file))
+    return accounts
 
-    def process_scheduled_tweet(tweet_text, scheduled_date):
-        verbose_log("Got tweet: '{}', due to be sent on {}".format(tweet_text, scheduled_date))
-        nonlocal processed_tweets
-        processed_tweets += 1
-        tweet_id = None
-        try:
-            status = None
-            if NO_POST:
-                print('Would have posted "{}"'.format(tweet_text))
-            else:
-                status = twitter_api.PostUpdate(tweet_text)
-                tweet_id = status.id_str
-            if status is not None:
-                nonlocal sent_tweets
-                sent_tweets += 1
-        except Exception as e:
-            print('Failed to send tweet "{}". Exception: {}'.format(tweet_text, e))
-
-        return tweet_id
-
-    with TweetStore(storage_file) as ts:
-        ts.process_due_tweets(process_scheduled_tweet)
+
+class LazyTwitterApi(object):
+    """Creates the twitter.Api on the first post. Importing twitter, and
+       requests with it, is most of the start up time of this script, so
+       runs with nothing to post or with --nopost never pay for it."""
+
+    def __init__(self, tokens, api_url=None):
+        self._tokens = tokens
+        self._api_url = api_url
+        self._api = None
+        self._lock = threading.Lock()
+
+    def PostUpdate(self, status):
+        with self._lock:
+            if self._api is None:
+                import twitter
+                # The API keeps a requests session, so connections are reused between posts
+                self._api = twitter.Api(base_url=self._api_url, **self._tokens._asdict())
+        return self._api.PostUpdate(status)
+
+
+def is_transient_error(error):
+    """Returns True if a failed post is worth retrying."""
+    # Only called after a post has failed, so both are already imported
+    import requests
+    import twitter
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, twitter.TwitterError) and isinstance(error.message, list):
+        return any(isinstance(m, dict) and m.get('code') in TRANSIENT_TWITTER_ERROR_CODES for m in error.message)
+    return False
+
+
+def create_posting_engine(tokens, workers, rate_limit, on_posted=None, api_url=None, pool=None, account=None,
+                          stop_event=None):
+    verbose_log('Connecting with consumer_key="{}", access_token_key="{}"',
+                tokens.consumer_key, tokens.access_token_key)
+    twitter_api = LazyTwitterApi(tokens, api_url)
+    prefix = '' if account is None else '{}: '.format(account)
+
+    def post_scheduled_tweet(tweet_text):
+        verbose_log("{}Posting tweet: '{}'", prefix, tweet_text)
+        if NO_POST:
+            print('{}Would have posted "{}"'.format(prefix, tweet_text))
+            return None
+        status = twitter_api.PostUpdate(tweet_text)
+        return status.id_str
+
+    def report_failure(tweet_text, error):
+        print('{}Failed to send tweet "{}". Exception: {}'.format(prefix, tweet_text, error))
+
+    # Nothing is posted with --nopost, so there's no rate to limit
+    rate_limiter = None if NO_POST else TokenBucket(rate_limit, DEFAULT_RATE_PERIOD, stop_event=stop_event)
+    return PostingEngine(post_scheduled_tweet,
+                         workers=workers,
+                         rate_limiter=rate_limiter,
+                         is_transient=is_transient_error,
+                         on_failure=report_failure,
+                         on_posted=on_posted,
+                         pool=pool,
+                         stop_event=stop_event)
+
+
+def post_tweets_from_file(storage_file, tokens, workers, rate_limit, max_tweets=None, time_budget=None,
+                          account=DEFAULT_ACCOUNT, api_url=None):
+    engine = create_posting_engine(tokens, workers, rate_limit, api_url=api_url)
+
+    # WAL lets other processes read the storage while we hold the write lock
+    with open_store(storage_file, journal_mode='WAL', account=account) as ts:
+        processed_tweets, sent_tweets = engine.process(ts, max_tweets=max_tweets, time_budget=time_budget)
 
     print('Number of tweets processed: {}'.format(processed_tweets))
     print('     Number of tweets sent: {}'.format(sent_tweets))
 
 
-########################################
-# Set up the CLI parse
-cli_main_parser = argparse.ArgumentParser()
-cli_main_parser.add_argument('-v', '--verbose',
-                             help='Say all the things',
-                             action='store_true')
-cli_main_parser.add_argument('-n', '--nopost',
-                             help='Do everything except send tweets',
-                             action='store_true')
-cli_main_parser.add_argument('-s', '--showcron',
-                             help='Show an entry suitable for calling this script every 5 minutes via crontab. '
-                                  'After showing the crontab entry, exit without posting tweets.', action='store_true')
-cli_main_parser.add_argument('-c', '--credentials',
-                             help='File containing the credentials to tweet with. Should be a single line of the '
-                                  'format (values are just space separated): consumer_key consumer_secret access_'
-                                  'token_key access_token_secret', default='access')
-cli_main_parser.add_argument('storage_file',
-                             help='The name of the file to read the scheduled tweets from. Will be updated after '
-                                  'the tweet is sent.')
-
-########################################
-# Parse the command line and perform
-# the user's bidding
-args = cli_main_parser.parse_args()
-
-if args.verbose:
-    VERBOSE = True
-if args.nopost:
-    NO_POST = True
-
-if args.showcron:
-    pipenv_location = shutil.which('pipenv')
-    script_location = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
-    script_name = os.path.basename(__file__)
-    storage_location = os.path.abspath(os.path.realpath(args.storage_file))
-    credentials_location = os.path.abspath(os.path.realpath(args.credentials))
-
-    command = "cd '{}' && PATH=/usr/bin:/bin:'{}' '{}' run " \
-              "python post-scheduled-tweets.py --credentials '{}' '{}'".format(
-                    script_location, os.path.dirname(pipenv_location), pipenv_location,
-                    credentials_location, storage_location)
-
-    cron = "*/5 * * * * {}".format(command)
-
-    print(cron)
-else:
-    verbose_log('Reading access information from "{}"'.format(args.credentials))
-    access = fetch_access_information(args.credentials)
-
-    print('Started processing scheduled tweets from "{}"'.format(args.storage_file))
-    post_tweets_from_file(args.storage_file, access)
-    print('Finished processing scheduled tweets from "{}"'.format(args.storage_file))
+def post_tweets_for_accounts(storage_file, accounts, workers, rate_limit, max_tweets=None, time_budget=None,
+                             api_url=None):
+    """Posts the due tweets of every account in one run. Each account has
+       its own API client and rate limit, and all share one pool of workers
+       threads."""
+    with create_pool(workers) as pool:
+        engines = OrderedDict((account, create_posting_engine(tokens, workers, rate_limit, api_url=api_url,
+                                                              pool=pool, account=account))
+                              for account, tokens in accounts.items())
+        results = MultiAccountPoster(storage_file, engines).process(max_tweets=max_tweets, time_budget=time_budget)
+
+    width = max(len(account) for account in results)
+    for account, (processed_tweets, sent_tweets) in results.items():
+        print('{:>{}}: {} tweets processed, {} sent'.format(account, width, processed_tweets, sent_tweets))
+    print('Number of tweets processed: {}'.format(sum(processed for processed, sent in results.values())))
+    print('     Number of tweets sent: {}'.format(sum(sent for processed, sent in results.values())))
+
+
+def run_daemon(storage_file, tokens, workers, rate_limit, metrics_file=None, account=DEFAULT_ACCOUNT, api_url=None):
+    """Posts tweets as they fall due until interrupted or terminated. If
+       metrics_file is given, metrics are written to it after each batch."""
+    lateness = LatenessTracker()
+    # Shared so stopping doesn't wait for a rate limit token or a retry
+    stopped = threading.Event()
+    engine = create_posting_engine(tokens, workers, rate_limit, on_posted=lateness.record_posted, api_url=api_url,
+                                   stop_event=stopped)
+
+    with open_store(storage_file, journal_mode='WAL', account=account) as ts:
+        daemon = SchedulerDaemon(ts, engine, lateness,
+                                 after_batch=lambda: write_metrics(metrics_file, lateness), stop_event=stopped)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: daemon.stop())
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            pass
+
+    print('Number of tweets processed: {}'.format(daemon.processed_tweets))
+    print('     Number of tweets sent: {}'.format(daemon.sent_tweets))
+    print(lateness)
+
+
+def write_metrics(metrics_file, lateness=None):
+    if metrics_file is None:
+        return
+    if lateness is not None:
+        for percent, seconds in lateness.percentiles().items():
+            METRICS.set_gauge('lateness_p{}_seconds'.format(percent), seconds)
+    METRICS.write(metrics_file)
+
+
+def create_parser():
+    """Returns the parser for the command line of this script."""
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('-v', '--verbose',
+                                 help='Say all the things',
+                                 action='store_true')
+    cli_main_parser.add_argument('-n', '--nopost',
+                                 help='Do everything except send tweets',
+                                 action='store_true')
+    cli_main_parser.add_argument('-s', '--showcron',
+                                 help='Show an entry suitable for calling this script every 5 minutes via crontab. '
+                                      'After showing the crontab entry, exit without posting tweets.',
+                                 action='store_true')
+    cli_main_parser.add_argument('-d', '--daemon',
+                                 help='Keep running, posting each tweet as soon as it is due, instead of posting the '
+                                      'currently due tweets and exiting. Stop with SIGINT or SIGTERM.',
+                                 action='store_true')
+    cli_main_parser.add_argument('-c', '--credentials',
+                                 help='File containing the credentials to tweet with. Should be a single line of the '
+                                      'format (values are just space separated): consumer_key consumer_secret access_'
+                                      'token_key access_token_secret', default='access')
+    cli_main_parser.add_argument('-a', '--account',
+                                 help='The account whose tweets are posted with --credentials, when one storage file '
+                                      'holds the tweets of many accounts. Defaults to the unnamed account.',
+                                 default=DEFAULT_ACCOUNT)
+    cli_main_parser.add_argument('--accounts',
+                                 help='File listing many accounts to post the tweets of in a single run, instead of '
+                                      'using --credentials and --account. Each line should be of the format '
+                                      '(values are just space separated): account consumer_key consumer_secret '
+                                      'access_token_key access_token_secret. Every account has its own --rate-limit '
+                                      'and all share the --workers. Blank lines and lines starting with # are '
+                                      'ignored.')
+    cli_main_parser.add_argument('--api-url',
+                                 help='Base URL of the Twitter API. Defaults to the real API, but can point at a local '
+                                      'stub server for testing.')
+    cli_main_parser.add_argument('-w', '--workers',
+                                 help='The number of tweets to post concurrently. With more than one worker, tweets '
+                                      'due at around the same time may be posted slightly out of order.',
+                                 type=int,
+                                 default=DEFAULT_WORKERS)
+    cli_main_parser.add_argument('-r', '--rate-limit',
+                                 help='The maximum number of tweets to post in any 3 hour period.',
+                                 type=int,
+                                 default=DEFAULT_RATE_LIMIT)
+    cli_main_parser.add_argument('--max-tweets',
+                                 help='Stop after processing this many tweets, leaving the rest for the next run.',
+                                 type=int)
+    cli_main_parser.add_argument('--time-budget',
+                                 help='Stop claiming tweets to post after this many seconds, leaving the rest for the '
+                                      'next run. Useful to stop a large backlog overlapping the next cron run.',
+                                 type=float)
+    cli_main_parser.add_argument('-m', '--metrics',
+                                 help='Write counters and timings for the run to this file when finished, or after '
+                                      'each batch of posts with --daemon. Written in the Prometheus text format if '
+                                      'the name ends with .prom, otherwise as JSON.')
+    add_profile_argument(cli_main_parser)
+    cli_main_parser.add_argument('storage_file',
+                                 help='The name of the file to read the scheduled tweets from. Will be updated after '
+                                      'the tweet is sent.')
+    return cli_main_parser
+
+
+def main(argv=None):
+    """Parses the command line, from sys.argv unless argv is given, and
+       performs the user's bidding."""
+    global VERBOSE, NO_POST
+    args = create_parser().parse_args(argv)
+
+    if args.verbose:
+        VERBOSE = True
+    if args.nopost:
+        NO_POST = True
+    if args.metrics is not None:
+        METRICS.enable()
+    if args.accounts is not None and args.daemon:
+        raise SystemExit('--accounts cannot be used with --daemon.')
+
+    if args.showcron:
+        pipenv_location = shutil.which('pipenv')
+        script_location = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+        script_name = os.path.basename(__file__)
+        storage_location = os.path.abspath(os.path.realpath(args.storage_file))
+
+        if args.accounts is not None:
+            credentials_option = "--accounts '{}'".format(os.path.abspath(os.path.realpath(args.accounts)))
+        else:
+            credentials_option = "--credentials '{}'".format(os.path.abspath(os.path.realpath(args.credentials)))
+            if args.account != DEFAULT_ACCOUNT:
+                credentials_option += " --account '{}'".format(args.account)
+
+        metrics_option = ''
+        if args.metrics is not None:
+            metrics_option = "--metrics '{}' ".format(os.path.abspath(os.path.realpath(args.metrics)))
+
+        command = "cd '{}' && PATH=/usr/bin:/bin:'{}' '{}' run " \
+                  "python post-scheduled-tweets.py {}{} '{}'".format(
+                        script_location, os.path.dirname(pipenv_location), pipenv_location,
+                        metrics_option, credentials_option, storage_location)
+
+        cron = "*/5 * * * * {}".format(command)
+
+        print(cron)
+    else:
+        if args.accounts is not None:
+            verbose_log('Reading accounts from "{}"', args.accounts)
+            accounts = fetch_accounts(args.accounts)
+        else:
+            verbose_log('Reading access information from "{}"', args.credentials)
+            access = fetch_access_information(args.credentials)
+
+        print('Started processing scheduled tweets from "{}"'.format(args.storage_file))
+        try:
+            with profiled(args.profile, args.storage_file, 'post-scheduled-tweets'):
+                if args.accounts is not None:
+                    post_tweets_for_accounts(args.storage_file, accounts, args.workers, args.rate_limit,
+                                             args.max_tweets, args.time_budget, args.api_url)
+                elif args.daemon:
+                    run_daemon(args.storage_file, access, args.workers, args.rate_limit, args.metrics,
+                               args.account, args.api_url)
+                else:
+                    post_tweets_from_file(args.storage_file, access, args.workers, args.rate_limit,
+                                          args.max_tweets, args.time_budget, args.account, args.api_url)
+        finally:
+            write_metrics(args.metrics)
+        print('Finished processing scheduled tweets from "{}"'.format(args.storage_file))
+
+
+if __name__ == '__main__':
+    main()
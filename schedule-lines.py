@@ -1,7 +1,8 @@
 #
 # Script to process lines in a text file
 # and output them to a CSV file suitable
-# for importing with import-tweets.py.
+# for importing with import-tweets.py, or
+# straight into a tweet database.
 #
 # Each line is assumed to contain a single tweet.
 # This is then scheduled according to the values
@@ -16,16 +17,29 @@
 import argparse
 import datetime
 import math
+import mmap
 import os
+import re
 from typing import TextIO
 
+from schtweet.metrics import METRICS
+from schtweet.profiling import add_profile_argument, profiled
+from schtweet.storage import open_store, DEFAULT_ACCOUNT, DEFAULT_CHUNK_SIZE
+
+# Size of the buffer used when writing the output file
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# Names of the days accepted by --weekdays, in date.weekday() order
+WEEKDAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
 VERBOSE = False
 
 
-def verbose_log(message):
-    """Logs a message to stdout if verbose"""
+def verbose_log(message, *args):
+    """Logs a message to stdout if verbose. Any args are only formatted
+       into the message when it is logged."""
     if VERBOSE:
-        print(message)
+        print(message.format(*args) if len(args) > 0 else message)
 
 
 def parse_date_string(date_str):
@@ -76,6 +90,24 @@ def parse_times(times_str):
     return entries
 
 
+def parse_weekdays(weekdays_str):
+    """Parses comma separated day names, such as "mon,wed,fri", into a set of
+       date.weekday() numbers."""
+    try:
+        weekdays = set()
+        for name in (x.strip() for x in weekdays_str.split(',') if len(x.strip()) > 0):
+            if name.lower()[:3] not in WEEKDAY_NAMES:
+                raise Exception('Unknown day "{}"'.format(name))
+            weekdays.add(WEEKDAY_NAMES.index(name.lower()[:3]))
+        if len(weekdays) == 0:
+            raise Exception('No days found')
+    except Exception as e:
+        raise SystemExit('{}\nUnexpected weekdays format. Expected "mon[,wed,fri]", found "{}".'.format(
+            e, weekdays_str))
+
+    return weekdays
+
+
 def escape_line_for_csv(line):
     if ',' in line or '"' in line:
         return '"' + line.replace('"', '""') + '"'
@@ -84,7 +116,7 @@ def escape_line_for_csv(line):
 
 
 def line_is_comment(line):
-    return line.startswith('//') or line.startswith('#')
+    return line.startswith(('//', '#'))
 
 
 def tweet_reader(filename):
@@ -92,33 +124,114 @@ def tweet_reader(filename):
         for line in input:
             line = line.strip()
             if line_is_comment(line):
-                verbose_log('Skipping comment: {}'.format(line))
+                verbose_log('Skipping comment: {}', line)
                 continue
             yield line
 
 
+# Matches the start of a comment line, as recognised by line_is_comment
+COMMENT_LINE = re.compile(rb'^[ \t\r\f\v]*(?://|#)', re.MULTILINE)
+
+# Size of the slices of the input newlines are counted in
+COUNT_CHUNK_SIZE = 16 * 1024 * 1024
+
+
 def count_tweets(filename):
-    num_tweets = 0
-    for _ in tweet_reader(filename):
-        num_tweets += 1
-    return  num_tweets
+    """Counts the lines tweet_reader would yield without decoding the file,
+       by counting newlines and comment lines in a memory map of it."""
+    with open(filename, 'rb') as input:
+        if os.fstat(input.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            num_lines = 0
+            for offset in range(0, len(data), COUNT_CHUNK_SIZE):
+                num_lines += data[offset:offset + COUNT_CHUNK_SIZE].count(b'\n')
+            if data[-1:] != b'\n':
+                num_lines += 1
+            num_comments = sum(1 for _ in COMMENT_LINE.finditer(data))
+    return num_lines - num_comments
+
+
+def time_slots(first_day, times):
+    """Generator of (datetime, formatted date string) for each time slot in
+       turn, starting at the first time on first_day. The time part of each
+       string is formatted once, and the date part once per day."""
+    slot_suffixes = [time.strftime(' %H:%M') for time in times]
+    current_day = first_day
+    while True:
+        day_prefix = current_day.strftime('%d/%m/%Y')
+        for time, suffix in zip(times, slot_suffixes):
+            schedule = datetime.datetime(current_day.year, current_day.month, current_day.day,
+                                         hour=time.hour, minute=time.minute)
+            yield schedule, day_prefix + suffix
+        current_day += datetime.timedelta(days=1)
+
+
+def scheduled_lines(input_filename, first_day, times, allocator=None):
+    """Generator pairing each line of the input with its time slot, yielding
+       (datetime, formatted date string, line). Empty lines are yielded too,
+       so the caller can skip their slot. The slots are the free ones found
+       by allocator if given, otherwise every slot in turn."""
+    slots = time_slots(first_day, times) if allocator is None else allocator.slots()
+    for (schedule, schedule_string), line in zip(slots, tweet_reader(input_filename)):
+        yield schedule, schedule_string, line
+
+
+def report_skipped_slots(allocator):
+    if allocator is not None:
+        METRICS.increment('slots_skipped', allocator.skipped_slots)
+        print('Skipped {} time slots which were taken or too close to another tweet.'.format(
+            allocator.skipped_slots))
+
+
+def create_allocator(args, first_day, times):
+    """Returns a SlotAllocator for the --fill, --max-per-day, --weekdays and
+       --min-spacing arguments, or None if none were given."""
+    if not args.fill and args.max_per_day is None and args.weekdays is None and args.min_spacing is None:
+        return None
+    if args.end is not None:
+        raise SystemExit('--end cannot be used with --fill, --max-per-day, --weekdays or --min-spacing.')
+
+    # Imported here as only allocating slots needs them
+    import pytz
+    from schtweet.dates import UtcConverter
+    from schtweet.slots import SlotAllocator
+
+    timezone = pytz.timezone(args.timezone)
+    min_spacing = datetime.timedelta(minutes=args.min_spacing or 0)
+    weekdays = None if args.weekdays is None else parse_weekdays(args.weekdays)
+    occupied = []
+    if args.fill:
+        storage_name = args.existing or args.database
+        if storage_name is None:
+            raise SystemExit('--fill needs --database, or --existing when writing a CSV file.')
+        if args.existing is not None and not os.path.exists(args.existing):
+            raise SystemExit('Storage file {} does not exist.'.format(args.existing))
+        # Tweets just before the first slot can still be too close to it
+        start_epoch = UtcConverter(timezone).epoch(first_day) - int(min_spacing.total_seconds())
+        with open_store(storage_name=storage_name, account=args.account) as ts:
+            occupied = ts.scheduled_epochs(start_epoch)
+        verbose_log('  Existing: {} tweets scheduled from {}', len(occupied), storage_name)
+
+    try:
+        return SlotAllocator(first_day, times, timezone, occupied, args.max_per_day, weekdays, min_spacing)
+    except ValueError as e:
+        raise SystemExit(str(e))
 
 
-def process_tweets(input_filename, output_filename, first_day, times, overwrite):
-    verbose_log('     Input: {}'.format(input_filename))
-    verbose_log('    Output: {}'.format(output_filename))
-    verbose_log(' Overwrite: {}'.format(overwrite))
-    verbose_log(' First day: {}'.format(first_day.isoformat()))
-    verbose_log('     Times: {}'.format([x.strftime('%H%M') for x in times]))
-    verbose_log('     Input: {}\n'.format(input_filename))
+def process_tweets(input_filename, output_filename, first_day, times, overwrite, allocator=None):
+    verbose_log('     Input: {}', input_filename)
+    verbose_log('    Output: {}', output_filename)
+    verbose_log(' Overwrite: {}', overwrite)
+    verbose_log(' First day: {}', first_day.isoformat())
+    verbose_log('     Times: {}', [x.strftime('%H%M') for x in times])
+    verbose_log('     Input: {}\n', input_filename)
 
     print('Processing tweets from {} and {} output file {}'.format(
         input_filename,
         'overwriting' if overwrite else 'appending to',
         output_filename))
 
-    current_time_index = 0
-    current_day = first_day
     num_lines = 0
     num_scheduled = 0
 
@@ -127,92 +240,211 @@ def process_tweets(input_filename, output_filename, first_day, times, overwrite)
     else:
         mode = 'a'
 
-    with open(output_filename, mode) as output_file:  # type: TextIO
-        for line in tweet_reader(input_filename):
+    with open(output_filename, mode, buffering=OUTPUT_BUFFER_SIZE) as output_file:  # type: TextIO
+        for _, schedule_string, line in scheduled_lines(input_filename, first_day, times, allocator):
             num_lines += 1
             if len(line) > 0:
-                schedule = datetime.datetime(current_day.year, current_day.month, current_day.day,
-                                             hour=times[current_time_index].hour,
-                                             minute=times[current_time_index].minute)
-                output_line = '{},{}'.format(schedule.strftime('%d/%m/%Y %H:%M'), escape_line_for_csv(line))
-                output_file.write('{}\n'.format(output_line))
-                verbose_log('Entry: {}'.format(output_line))
+                escaped_line = escape_line_for_csv(line)
+                output_file.write('{},{}\n'.format(schedule_string, escaped_line))
+                verbose_log('Entry: {},{}', schedule_string, escaped_line)
 
                 num_scheduled += 1
             else:
                 verbose_log('Skipping next time slot because of empty line')
 
-            current_time_index += 1
-            if current_time_index >= len(times):
-                current_time_index = 0
-                current_day += datetime.timedelta(days=1)
+    METRICS.increment('lines_read', num_lines)
+    METRICS.increment('tweets_scheduled', num_scheduled)
+    print('Scheduled {} tweets into {} time slots.'.format(num_scheduled, num_lines))
+    report_skipped_slots(allocator)
+
+
+def store_tweets(input_filename, database_filename, first_day, times, timezone, batch_size, account=DEFAULT_ACCOUNT,
+                 allocator=None, rejects_file=None):
+    """Schedules the lines straight into a TweetStore, without writing a CSV
+       for import-tweets.py. Times are localised to timezone in the same way
+       import-tweets.py localises dates without timezone information, and
+       lines which can't be posted are rejected as import-tweets.py rejects
+       rows. A rejected line still uses up its time slot."""
+    from schtweet.dates import UtcConverter
+    from schtweet.render import RejectsReport, validated_values
 
+    verbose_log('     Input: {}', input_filename)
+    verbose_log('  Database: {}', database_filename)
+    verbose_log('  Timezone: {}', timezone)
+    verbose_log(' First day: {}', first_day.isoformat())
+    verbose_log('     Times: {}\n', [x.strftime('%H%M') for x in times])
+
+    print('Processing tweets from {} and appending to database {}'.format(input_filename, database_filename))
+
+    num_lines = 0
+    converter = UtcConverter(timezone)
+
+    def values():
+        nonlocal num_lines
+        for schedule, schedule_string, line in scheduled_lines(input_filename, first_day, times, allocator):
+            num_lines += 1
+            if len(line) > 0:
+                verbose_log('Entry: {},{}', schedule_string, line)
+                with METRICS.timer('schedule_line'):
+                    tweet = converter.tweet_values(schedule, line)
+                yield tweet
+            else:
+                verbose_log('Skipping next time slot because of empty line')
+
+    with open_store(storage_name=database_filename, account=account) as ts, \
+            RejectsReport(rejects_file, print) as rejects:
+        num_scheduled = ts.schedule_tweet_values(validated_values(values(), rejects), chunk_size=batch_size)
+
+    METRICS.increment('lines_read', num_lines)
+    METRICS.increment('tweets_scheduled', num_scheduled)
+    METRICS.increment('lines_rejected', rejects.count)
     print('Scheduled {} tweets into {} time slots.'.format(num_scheduled, num_lines))
+    if rejects.count > 0:
+        print('Rejected {} lines which can\'t be posted.'.format(rejects.count))
+    report_skipped_slots(allocator)
+
 
+def schedule(args):
+    if args.database is not None and (args.output is not None or args.overwrite):
+        raise SystemExit('--database cannot be used with --output or --overwrite.')
+    if args.rejects is not None and args.database is None:
+        raise SystemExit('--rejects can only be used with --database.')
 
-########################################
-# Set up the CLI parse
-cli_main_parser = argparse.ArgumentParser()
-cli_main_parser.add_argument('-v', '--verbose',
-                             help='Say all the things',
-                             action='store_true')
-cli_main_parser.add_argument('-s', '--start',
-                             help='The initial date to schedule the lines from. Specified '
-                                  'as dd/mm/yyyy. You can omit year, year and month or year, '
-                                  'month and day. Omitted fields default to the current date.'
-                             'This argument is incompatible with --end.')
-cli_main_parser.add_argument('-e', '--end',
-                             help='The end date to schedule the lines from. Specified '
-                                  'as dd/mm/yyyy. You can omit year, year and month or year, '
-                                  'month and day. Omitted fields default to the current date. '
-                                  'This argument is incompatible with --start.')
-cli_main_parser.add_argument('-o', '--output',
-                             help='The name of the file to append the imported data to.'
-                                  ' Will be created if it does not exist.',
-                             default='scheduled-lines.csv')
-cli_main_parser.add_argument('-x', '--overwrite',
-                             help='Overwrite the output file. The default is to append.',
-                             action='store_true')
-cli_main_parser.add_argument('-t', '--times',
-                             help='The times to schedule the tweets within the day. Comma '
-                                  'separated 24h format strings. Lines will be scheduled in order '
-                                  'of these times, so if you specify 3 times, 3 tweets will be '
-                                  'scheduled for each day from the input lines. 1 time will cause '
-                                  '1 tweet to be sent per day. For example, to send one tweet in '
-                                  'the morning and one in the evening, you could specify: 0900,2100.',
-                             default='1200')
-cli_main_parser.add_argument('lines_file',
-                             help='The name of the file to read the tweet lines to be scheduled from.')
-
-########################################
-# Parse the command line and perform
-# the user's bidding
-
-
-def main(args):
     # Resolve the filenames
     input_filename = os.path.abspath(args.lines_file)
-    output_filename = os.path.abspath(args.output)
 
-    # Work out the length of the tweet period
-    num_tweets = count_tweets(input_filename)
     times = parse_times(args.times)
-    num_days_tweeting = math.ceil(num_tweets / len(times))
+
+    # Work out the length of the tweet period. This is only needed to work
+    # back from the end date, and means an extra pass over the input.
+    num_days_tweeting = None
+    if args.end is not None:
+        num_tweets = count_tweets(input_filename)
+        num_days_tweeting = math.ceil(num_tweets / len(times))
 
     # Work out the start date
     start_date = parse_start_date(args.start, args.end, num_days_tweeting)
+    allocator = create_allocator(args, start_date, times)
+
+    if args.database is not None:
+        # Imported here as only writing to a database needs it
+        import pytz
+        store_tweets(
+            input_filename,
+            args.database,
+            start_date,
+            times,
+            pytz.timezone(args.timezone),
+            args.batch_size,
+            args.account,
+            allocator,
+            args.rejects)
+    else:
+        process_tweets(
+            input_filename,
+            os.path.abspath(args.output or 'scheduled-lines.csv'),
+            start_date,
+            times,
+            args.overwrite,
+            allocator)
+
+
+def create_parser():
+    """Returns the parser for the command line of this script."""
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('-v', '--verbose',
+                                 help='Say all the things',
+                                 action='store_true')
+    cli_main_parser.add_argument('-s', '--start',
+                                 help='The initial date to schedule the lines from. Specified '
+                                      'as dd/mm/yyyy. You can omit year, year and month or year, '
+                                      'month and day. Omitted fields default to the current date.'
+                                 'This argument is incompatible with --end.')
+    cli_main_parser.add_argument('-e', '--end',
+                                 help='The end date to schedule the lines from. Specified '
+                                      'as dd/mm/yyyy. You can omit year, year and month or year, '
+                                      'month and day. Omitted fields default to the current date. '
+                                      'This argument is incompatible with --start.')
+    cli_main_parser.add_argument('-o', '--output',
+                                 help='The name of the file to append the imported data to.'
+                                      ' Will be created if it does not exist. Defaults to scheduled-lines.csv.')
+    cli_main_parser.add_argument('-x', '--overwrite',
+                                 help='Overwrite the output file. The default is to append.',
+                                 action='store_true')
+    cli_main_parser.add_argument('-d', '--database',
+                                 help='Append the scheduled lines directly to this tweet database, as used by '
+                                      'import-tweets.py, instead of writing a CSV file. Will be created if it does '
+                                      'not exist. This argument is incompatible with --output and --overwrite.')
+    cli_main_parser.add_argument('-z', '--timezone',
+                                 help='The timezone of the scheduled times. Used when writing to --database, and to '
+                                      'place slots with --fill, --existing, --max-per-day, --weekdays or '
+                                      '--min-spacing when writing a CSV file too.',
+                                 default='Europe/London')
+    cli_main_parser.add_argument('-a', '--account',
+                                 help='The account to schedule the lines for when writing to --database. Defaults '
+                                      'to the unnamed account.',
+                                 default=DEFAULT_ACCOUNT)
+    cli_main_parser.add_argument('-b', '--batch-size',
+                                 help='The number of rows to insert at once when writing to --database.',
+                                 type=int,
+                                 default=DEFAULT_CHUNK_SIZE)
+    cli_main_parser.add_argument('-t', '--times',
+                                 help='The times to schedule the tweets within the day. Comma '
+                                      'separated 24h format strings. Lines will be scheduled in order '
+                                      'of these times, so if you specify 3 times, 3 tweets will be '
+                                      'scheduled for each day from the input lines. 1 time will cause '
+                                      '1 tweet to be sent per day. For example, to send one tweet in '
+                                      'the morning and one in the evening, you could specify: 0900,2100.',
+                                 default='1200')
+    cli_main_parser.add_argument('-r', '--rejects',
+                                 help='Write lines which can\'t be posted, such as tweets too long to post, to this '
+                                      'CSV file when writing to --database. They are always reported and never '
+                                      'scheduled.')
+    cli_main_parser.add_argument('-f', '--fill',
+                                 help='Skip time slots which are already taken by, or closer than --min-spacing to, '
+                                      'an unposted tweet of --account in --database, so a new campaign fills the '
+                                      'gaps around what is already scheduled. When writing a CSV file, the tweets '
+                                      'are read from --existing instead.',
+                                 action='store_true')
+    cli_main_parser.add_argument('--existing',
+                                 help='The tweet database to read the tweets already scheduled from with --fill when '
+                                      'writing a CSV file. Defaults to --database.')
+    cli_main_parser.add_argument('--max-per-day',
+                                 help='Schedule at most this many tweets on any day, counting those already scheduled '
+                                      'with --fill. Later time slots on a full day are skipped.',
+                                 type=int)
+    cli_main_parser.add_argument('-w', '--weekdays',
+                                 help='Only schedule on these days of the week. Comma separated day names, for '
+                                      'example: mon,tue,wed,thu,fri.')
+    cli_main_parser.add_argument('--min-spacing',
+                                 help='Skip time slots closer than this many minutes to another scheduled tweet.',
+                                 type=int)
+    cli_main_parser.add_argument('-m', '--metrics',
+                                 help='Write counters and timings for the run to this file when finished. Written in '
+                                      'the Prometheus text format if the name ends with .prom, otherwise as JSON.')
+    add_profile_argument(cli_main_parser)
+    cli_main_parser.add_argument('lines_file',
+                                 help='The name of the file to read the tweet lines to be scheduled from.')
+    return cli_main_parser
+
+
+def main(argv=None):
+    """Parses the command line, from sys.argv unless argv is given, and
+       performs the user's bidding."""
+    global VERBOSE
+    args = create_parser().parse_args(argv)
+    if args.verbose:
+        VERBOSE = True
+    if args.metrics is not None:
+        METRICS.enable()
 
-    process_tweets(
-        input_filename,
-        output_filename,
-        start_date,
-        times,
-        args.overwrite)
-
-
-parsed_args = cli_main_parser.parse_args()
-if parsed_args.verbose:
-    VERBOSE = True
+    try:
+        with profiled(args.profile, args.database or args.output or 'scheduled-lines.csv', 'schedule-lines'):
+            schedule(args)
+    finally:
+        if args.metrics is not None:
+            METRICS.write(args.metrics)
 
 
-main(parsed_args)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import math
+
+# Rate of false positives a BloomFilter is sized for by default
+DEFAULT_ERROR_RATE = 0.001
+
+
+class BloomFilter(object):
+    """Compact set of digests which can answer "definitely not present" or
+       "possibly present". Sized to hold capacity items with error_rate false
+       positives. Adding more items than that still works, but false
+       positives become more common.
+
+       Items must be uniformly distributed digests of at least 16 bytes, such
+       as those returned by content_hash, as the bit positions are taken
+       directly from their bytes rather than hashing them again."""
+
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE):
+        capacity = max(1, capacity)
+        self._num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self._num_hashes = max(1, int(round(self._num_bits / capacity * math.log(2))))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+
+    def add(self, digest):
+        for position in self.__positions(digest):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(digest))
+
+    def __positions(self, digest):
+        # Double hashing: the i'th position is h1 + i * h2
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self._num_bits for i in range(self._num_hashes)]
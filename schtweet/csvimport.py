@@ -0,0 +1,63 @@
+from collections import namedtuple
+import csv
+import io
+
+import pytz
+
+from schtweet.dates import DateParser
+from schtweet.metrics import METRICS
+
+# Result of parsing a whole file with parse_file. error is None if every row
+# was parsed, otherwise values is empty.
+ParsedFile = namedtuple('ParsedFile', 'filename, values, error')
+
+
+class RowError(ValueError):
+    """Raised when a row of a CSV can't be imported."""
+
+    def __init__(self, row_number, message):
+        super().__init__('Could not read row {}. {}'.format(row_number, message))
+        self.row_number = row_number
+
+
+def check_columns(row):
+    """Raises ValueError if a CSV row has the wrong number of columns. A
+       fourth column is allowed, and ignored, so rejects files written by
+       RejectsReport can be fixed up and imported again as they are."""
+    if len(row) < 2 or len(row) > 4:
+        raise ValueError('Expected 2 to 4 columns but found {}'
+                         '. Ensure you are using the format:'
+                         ' date,tweet_text,[optional url],[ignored reason]'.format(len(row)))
+
+
+def read_values(reader, default_timezone):
+    """Generator which parses each CSV row in turn, yielding rows normalised
+       by tweet_values, ready for TweetStore.schedule_tweet_values. Dates are
+       converted to UTC in one step by a UtcConverter, rather than being
+       localised and then converted. Raises RowError for the first row which
+       can't be parsed."""
+    date_parser = DateParser()
+    converter = date_parser.converter(default_timezone)
+    for row_number, row in enumerate(reader, 1):
+        try:
+            with METRICS.timer('parse_row'):
+                check_columns(row)
+                values = converter.tweet_values(date_parser.parse_local(row[0]), row[1],
+                                                row[2] if len(row) > 2 else None)
+            yield values
+        except (ValueError, OverflowError) as e:
+            raise RowError(row_number, e)
+
+
+def parse_file(filename, timezone_name):
+    """Parses a whole CSV file into rows normalised by tweet_values, ready for
+       TweetStore.schedule_tweet_values. Intended to be run in a pool of worker
+       processes, so errors are returned in the ParsedFile rather than raised
+       and a file with any invalid rows produces no values."""
+    try:
+        default_timezone = pytz.timezone(timezone_name)
+        with io.open(filename, 'r', encoding='utf8') as csvfile:
+            values = list(read_values(csv.reader(csvfile), default_timezone))
+    except (OSError, UnicodeError, csv.Error, ValueError) as e:
+        return ParsedFile(filename, [], str(e))
+    return ParsedFile(filename, values, None)
@@ -0,0 +1,154 @@
+from collections import deque
+import heapq
+import threading
+import time
+
+# Number of upcoming tweet times held in memory at once
+DEFAULT_HEAP_SIZE = 1000
+
+# Seconds between checks of the storage for changes made by other processes
+DEFAULT_CHECK_INTERVAL = 1.0
+
+# Seconds to wait before retrying tweets which failed to post
+DEFAULT_RETRY_INTERVAL = 5 * 60
+
+# Number of lateness samples kept for calculating percentiles
+DEFAULT_LATENESS_SAMPLES = 10000
+
+
+class LatenessTracker(object):
+    """Records how late tweets were posted relative to their schedule and
+       reports percentiles over the most recent samples."""
+
+    def __init__(self, max_samples=DEFAULT_LATENESS_SAMPLES, clock=time.time):
+        self._samples = deque(maxlen=max_samples)
+        self._count = 0
+        self._clock = clock
+
+    @property
+    def count(self):
+        """Total number of samples ever recorded."""
+        return self._count
+
+    def record(self, lateness):
+        self._samples.append(lateness)
+        self._count += 1
+
+    def record_posted(self, tweet, tweet_id):
+        """on_posted callback for a PostingEngine, recording how late the
+           DueTweet was posted."""
+        self.record(max(0, self._clock() - tweet.scheduled_epoch))
+
+    def percentiles(self, percents=(50, 90, 99, 100)):
+        """Returns a dict mapping each of percents to the lateness in seconds
+           at that percentile, using the nearest rank method. Empty if nothing
+           has been recorded."""
+        ordered = sorted(self._samples)
+        if len(ordered) == 0:
+            return {}
+        result = {}
+        for percent in percents:
+            rank = max(1, int(-(-percent * len(ordered) // 100)))
+            result[percent] = ordered[rank - 1]
+        return result
+
+    def __str__(self):
+        percentiles = self.percentiles()
+        if len(percentiles) == 0:
+            return 'No tweets posted'
+        return 'Lateness over {} tweets: {}'.format(
+            len(self._samples),
+            ', '.join('p{}={:.1f}s'.format(percent, lateness) for percent, lateness in percentiles.items()))
+
+
+class SchedulerDaemon(object):
+    """Long running alternative to calling the posting script from cron.
+
+       Keeps a single store connection and PostingEngine for its whole life.
+       The times of the next heap_size upcoming tweets are held in a min-heap
+       so the daemon can sleep until exactly when the next tweet is due. New
+       tweets imported by other processes are noticed by watching the
+       storage's data_version, checked every check_interval seconds, rather
+       than by re-querying the schedule.
+
+       Tweets which fail to post are retried after retry_interval seconds.
+       If the engine's on_posted callback is the record_posted method of
+       lateness, a LatenessTracker, a summary of how late tweets were posted
+       is passed to log after each batch, and after_batch is called.
+
+       Our own commits don't change the data_version seen by the store's
+       connection, so posting never triggers a reload by itself.
+
+       The daemon waits on stop_event, a threading.Event by default, and
+       stop sets it. Give the engine and its rate limiter the same event so
+       stopping doesn't wait for a rate limit token or a retry."""
+
+    def __init__(self, store, engine, lateness=None, heap_size=DEFAULT_HEAP_SIZE, check_interval=DEFAULT_CHECK_INTERVAL,
+                 retry_interval=DEFAULT_RETRY_INTERVAL, clock=time.time, log=print, after_batch=None, stop_event=None):
+        self._store = store
+        self._engine = engine
+        self._heap_size = heap_size
+        self._check_interval = check_interval
+        self._retry_interval = retry_interval
+        self._clock = clock
+        self._log = log
+        self._after_batch = after_batch
+        self._heap = []
+        self._retry_at = None
+        self._data_version = None
+        self._stop_event = stop_event if stop_event is not None else threading.Event()
+        self.lateness = lateness if lateness is not None else LatenessTracker(clock=clock)
+        self.processed_tweets = 0
+        self.sent_tweets = 0
+
+    def stop(self):
+        """Asks a running daemon to return from run. Safe to call from a
+           signal handler or another thread."""
+        self._stop_event.set()
+
+    def run(self):
+        """Posts tweets as they fall due until stop is called."""
+        self._data_version = self._store.data_version
+        self.__reload()
+        self.__process_due()
+        while not self._stop_event.is_set():
+            now = self._clock()
+            wake = self.__next_wake()
+            if wake is not None and wake <= now:
+                self.__process_due()
+                continue
+
+            timeout = self._check_interval
+            if wake is not None:
+                timeout = min(timeout, wake - now)
+            self._stop_event.wait(timeout)
+
+            data_version = self._store.data_version
+            if data_version != self._data_version:
+                self._data_version = data_version
+                self.__reload()
+                self.__process_due()
+
+    def __next_wake(self):
+        wakes = [x for x in (self._retry_at, self._heap[0][0] if len(self._heap) > 0 else None) if x is not None]
+        return min(wakes) if len(wakes) > 0 else None
+
+    def __reload(self):
+        self._heap = self._store.upcoming_tweets(self._heap_size)
+        heapq.heapify(self._heap)
+
+    def __process_due(self):
+        processed, sent = self._engine.process(self._store)
+        self.processed_tweets += processed
+        self.sent_tweets += sent
+        if processed > 0:
+            self._log('Processed {} tweets, sent {}. {}'.format(processed, sent, self.lateness))
+            if self._after_batch is not None:
+                self._after_batch()
+
+        now = self._clock()
+        self._retry_at = now + self._retry_interval if processed > sent else None
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            heapq.heappop(self._heap)
+        if len(self._heap) == 0:
+            self.__reload()
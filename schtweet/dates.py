@@ -0,0 +1,196 @@
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta
+import calendar
+import functools
+
+from schtweet.storage import utc_date, utc_epoch, utc_tweet_values
+
+# Formats tried, in order, when detecting the format of imported dates, and
+# for any date which doesn't match the detected format. The first is the
+# format written by schedule-lines.py. Dates with slashes are day first, as
+# for the dateutil fallback, and dates with dashes are ISO 8601, year first.
+CANDIDATE_FORMATS = (
+    '%d/%m/%Y %H:%M',
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d',
+)
+
+# Number of rows sampled before settling on a single format
+DETECTION_ROWS = 10
+
+# Number of distinct date strings remembered
+DEFAULT_CACHE_SIZE = 4096
+
+# Number of local days whose UTC offset a UtcConverter remembers
+DEFAULT_DAY_CACHE_SIZE = 4096
+
+ONE_DAY = timedelta(days=1)
+
+# The UTC offset of every time on a local day, and the UTC epoch seconds of
+# the day's midnight
+DayOffset = namedtuple('DayOffset', 'offset, midnight_epoch')
+
+
+class UtcConverter(object):
+    """Converts naive datetimes in timezone, a pytz timezone, to UTC.
+
+       pytz's localize searches the timezone's transitions for every date,
+       which was most of the cost of importing a row. Instead the UTC offset
+       is found once per local day and cached, so the many times on each
+       day of a schedule share one lookup. Finding it is a binary search of
+       the local times around each transition, built once from the
+       transition table pytz keeps for the timezone.
+
+       Days touched by a transition are localised time by time with pytz,
+       with is_dst deciding ambiguous and nonexistent times as it does for
+       localize. By default both are read as standard time, so an ambiguous
+       time is the later of its two instants and a nonexistent one is moved
+       forward by the size of the gap."""
+
+    def __init__(self, timezone, is_dst=False, cache_size=DEFAULT_DAY_CACHE_SIZE):
+        self._timezone = timezone
+        self._is_dst = is_dst
+        self._day_offset = functools.lru_cache(maxsize=cache_size)(self._find_day_offset)
+
+        # The local times which are ambiguous or don't exist around each
+        # transition run from the start to the end of the same index
+        self._change_starts = []
+        self._change_ends = []
+        utc_times = getattr(timezone, '_utc_transition_times', [])
+        for index in range(1, len(utc_times)):
+            before = timezone._transition_info[index - 1][0]
+            after = timezone._transition_info[index][0]
+            self._change_starts.append(utc_times[index] + min(before, after))
+            self._change_ends.append(utc_times[index] + max(before, after))
+        self._longest_change = max((end - start for start, end in zip(self._change_starts, self._change_ends)),
+                                   default=timedelta(0))
+
+    def tweet_values(self, date, text, url=None):
+        """As storage.tweet_values, but naive dates are taken to be in the
+           timezone. Aware dates are converted as they are."""
+        date, epoch = self.utc(date)
+        return utc_tweet_values(date, epoch, text, url)
+
+    def utc(self, date):
+        """Returns the naive UTC datetime and UTC epoch seconds of date. Naive
+           dates are taken to be in the timezone."""
+        if date.tzinfo is None:
+            day = self._day_offset(date.date())
+            if day is None:
+                date = self._timezone.localize(date, is_dst=self._is_dst)
+            else:
+                return date - day.offset, day.midnight_epoch + date.hour * 3600 + date.minute * 60 + date.second
+        date = utc_date(date)
+        return date, utc_epoch(date)
+
+    def epoch(self, date):
+        """Returns the UTC epoch seconds of the naive datetime date in the
+           timezone."""
+        return self.utc(date)[1]
+
+    def _find_day_offset(self, day):
+        """Returns the DayOffset of day, or None if a transition touches any
+           time from its midnight to the next."""
+        midnight = datetime(day.year, day.month, day.day)
+        if len(self._change_starts) == 0:
+            # A fixed offset, which localize finds cheaply
+            offset = self._timezone.localize(midnight).utcoffset()
+        else:
+            first = bisect_left(self._change_starts, midnight - self._longest_change)
+            last = bisect_right(self._change_starts, midnight + ONE_DAY)
+            if any(self._change_ends[index] >= midnight for index in range(first, last)):
+                return None
+            # Every transition starting before midnight is over by then
+            offset = self._timezone._transition_info[bisect_right(self._change_starts, midnight)][0]
+        return DayOffset(offset, calendar.timegm(day.timetuple()) - int(offset.total_seconds()))
+
+
+class DateParser(object):
+    """Parses the date strings of imported rows into timezone aware datetimes.
+
+       The format of the dates is detected from the first rows parsed. After
+       that each date is parsed with datetime.strptime using the detected
+       format. Any that don't match are tried against every candidate format,
+       so a date is read the same wherever it appears in the file, and then
+       parsed with dateutil if none of them match either. Dates without
+       timezone information are left naive, for the UtcConverter returned by
+       converter to convert to UTC.
+
+       Results of parse_local are cached on the date string, as imports
+       which are re-run or repeat a short campaign see the same strings
+       heavily."""
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
+        self._format = None
+        self._votes = {}
+        self._sampled = 0
+        self._converters = {}
+        self.parse_local = functools.lru_cache(maxsize=cache_size)(self._parse_local)
+
+    ########################################################################
+    # Properties
+    @property
+    def detected_format(self):
+        """The strptime format in use, or None if it's still being detected
+           or no candidate format matched the sampled rows."""
+        return self._format
+
+    ########################################################################
+    # Parsing
+    def converter(self, timezone):
+        """Returns the UtcConverter for naive dates in timezone."""
+        converter = self._converters.get(timezone)
+        if converter is None:
+            converter = self._converters[timezone] = UtcConverter(timezone)
+        return converter
+
+    def _parse_local(self, date_string):
+        """Returns date_string as a datetime, which is naive unless the
+           string has timezone information."""
+        date = None
+        date_string = date_string.strip()
+        if self._sampled < DETECTION_ROWS:
+            date = self.__detect(date_string)
+        else:
+            if self._format is not None:
+                try:
+                    date = datetime.strptime(date_string, self._format)
+                except ValueError:
+                    pass
+            if date is None:
+                date = self.__parse_candidates(date_string)[0]
+
+        if date is None:
+            # Imported here as it is slow to import and often never needed
+            from dateutil import parser
+            date = parser.parse(date_string, dayfirst=True)
+        return date
+
+    def __detect(self, date_string):
+        """Tries each candidate format in turn, voting for the first that
+           matches. Once enough rows have been sampled the format with the
+           most votes is used for all further rows."""
+        self._sampled += 1
+        date, candidate = self.__parse_candidates(date_string)
+        if candidate is not None:
+            self._votes[candidate] = self._votes.get(candidate, 0) + 1
+
+        if self._sampled == DETECTION_ROWS and len(self._votes) > 0:
+            self._format = max(self._votes, key=self._votes.get)
+        return date
+
+    @staticmethod
+    def __parse_candidates(date_string):
+        """Returns date_string parsed with the first candidate format which
+           matches it, and that format, or (None, None) if none do."""
+        for candidate in CANDIDATE_FORMATS:
+            try:
+                return datetime.strptime(date_string, candidate), candidate
+            except ValueError:
+                continue
+        return None, None
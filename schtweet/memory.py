@@ -0,0 +1,351 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from schtweet.metrics import METRICS
+from schtweet.storage import BaseTweetStore, DueTweet, DEFAULT_ACCOUNT, DEFAULT_CHUNK_SIZE, DEFAULT_LEASE, \
+    DEFAULT_PAGE_SIZE, MEMORY_PREFIX, content_hash, full_tweet, tweet_values
+
+# Version of the snapshot file format written by MemoryTable.snapshot
+SNAPSHOT_VERSION = 1
+
+# Sorts after every schedule_id with the same epoch in the pending index
+LAST_ID = float('inf')
+
+
+class TweetRecord(object):
+    """A scheduled tweet held in memory, with the same fields as a row of the
+       SQLite tweets table. Dates are held as the strings SQLite returns."""
+    __slots__ = ('schedule_id', 'account', 'tweet_on_date', 'tweet_on_epoch', 'tweet_text', 'tweet_url', 'tweet_id',
+                 'tweeted_date', 'claimed_by', 'claim_expires', 'content_hash', 'payload', 'weighted_length')
+
+    def __init__(self, schedule_id, account, tweet_on_date, tweet_on_epoch, tweet_text, tweet_url, tweet_id=None,
+                 tweeted_date=None, claimed_by=None, claim_expires=None, content_hash=None, payload=None,
+                 weighted_length=None):
+        self.schedule_id = schedule_id
+        self.account = account
+        self.tweet_on_date = tweet_on_date
+        self.tweet_on_epoch = tweet_on_epoch
+        self.tweet_text = tweet_text
+        self.tweet_url = tweet_url
+        self.tweet_id = tweet_id
+        self.tweeted_date = tweeted_date
+        self.claimed_by = claimed_by
+        self.claim_expires = claim_expires
+        self.content_hash = content_hash
+        self.payload = payload
+        self.weighted_length = weighted_length
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+class MemoryTable(object):
+    """The tweets of every account in one in-memory storage, shared by all of
+       the MemoryTweetStores using it. Stores hold lock while they use it.
+
+       Records are kept by schedule_id. Each account's unposted tweets are
+       indexed by a sorted list of (tweet_on_epoch, schedule_id) keys, the
+       equivalent of the tweets_pending index, so finding the due or next
+       upcoming tweets is a binary search."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.records = {}
+        self.pending = {}
+        self.hashes = set()
+        self.next_id = 1
+        self.version = 0
+
+    def add(self, record):
+        self.records[record.schedule_id] = record
+        if record.content_hash is not None:
+            self.hashes.add((record.account, record.content_hash))
+        self.next_id = max(self.next_id, record.schedule_id + 1)
+
+    def index_pending(self, account, keys):
+        """Adds (tweet_on_epoch, schedule_id) keys to account's pending index."""
+        pending = self.pending.setdefault(account, [])
+        keys.sort()
+        if len(pending) == 0 or keys[0] >= pending[-1]:
+            # Imports are usually in schedule order, so can just be appended
+            pending.extend(keys)
+        else:
+            pending.extend(keys)
+            pending.sort()
+
+    def unindex_pending(self, record):
+        pending = self.pending.get(record.account, [])
+        key = (record.tweet_on_epoch, record.schedule_id)
+        index = bisect_left(pending, key)
+        if index < len(pending) and pending[index] == key:
+            del pending[index]
+
+    def snapshot(self, filename):
+        """Writes every record to filename, replacing it atomically."""
+        with self.lock:
+            content = {
+                'version': SNAPSHOT_VERSION,
+                'fields': TweetRecord.__slots__,
+                'records': [record.values() for record in self.records.values()],
+            }
+        directory = os.path.dirname(os.path.abspath(filename))
+        handle, temp_name = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                pickle.dump(content, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_name, filename)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        """Returns a table holding the records snapshotted to filename."""
+        with open(filename, 'rb') as snapshot_file:
+            content = pickle.load(snapshot_file)
+        if content['version'] != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version {} in {}'.format(content['version'], filename))
+        table = cls()
+        pending = {}
+        for values in content['records']:
+            record = TweetRecord(**dict(zip(content['fields'], values)))
+            table.add(record)
+            if record.tweeted_date is None:
+                pending.setdefault(record.account, []).append((record.tweet_on_epoch, record.schedule_id))
+        for account, keys in pending.items():
+            table.index_pending(account, keys)
+        return table
+
+
+# Tables opened through open_store, by snapshot file name. None is the table
+# of stores without a snapshot.
+_SHARED_TABLES = {}
+_SHARED_TABLES_LOCK = threading.Lock()
+
+
+def shared_table(snapshot_name):
+    """Returns the table shared by every store in this process opened with
+       snapshot_name, loading it from the snapshot file if it exists."""
+    with _SHARED_TABLES_LOCK:
+        table = _SHARED_TABLES.get(snapshot_name)
+        if table is None:
+            if snapshot_name is not None and os.path.exists(snapshot_name):
+                table = MemoryTable.load(snapshot_name)
+            else:
+                table = MemoryTable()
+            _SHARED_TABLES[snapshot_name] = table
+        return table
+
+
+class MemoryTweetStore(BaseTweetStore):
+    """Tweet storage held in memory, for tests, benchmarks and bursty
+       workloads which don't need SQLite's durability. Used in the same way
+       as TweetStore:
+
+            with MemoryTweetStore() as ts:
+                # use ts object
+
+        Stores opened with the same snapshot_name, or none, share a table,
+        unless one is passed in. If snapshot_name is given the table is
+        loaded from that file when first used, and written back to it when
+        the store is closed. Writes are visible to other stores straight
+        away, so commit does nothing."""
+
+    def __init__(self, snapshot_name=None, account=DEFAULT_ACCOUNT, table=None):
+        super().__init__(MEMORY_PREFIX + (snapshot_name or ''), account)
+        self._snapshot_name = snapshot_name
+        self._table = table
+        self._own_writes = 0
+
+    ########################################################################
+    # Properties
+    @property
+    def data_version(self):
+        """Changes whenever another store writes to the table."""
+        return self._table.version - self._own_writes
+
+    ########################################################################
+    # Data writing
+    def mark_tweeted(self, schedule_id, tweet_id):
+        with self._table.lock, METRICS.timer('db_update'):
+            self.__record_tweeted(self._table.records[schedule_id], str(datetime.now()), tweet_id)
+            self.__wrote()
+
+    def acknowledge(self, posted):
+        if len(posted) == 0:
+            return 0
+        now = str(datetime.now())
+        num_recorded = 0
+        with self._table.lock, METRICS.timer('db_update'):
+            for schedule_id, tweet_id in posted:
+                record = self._table.records[schedule_id]
+                if record.claimed_by == self.claimant:
+                    self.__record_tweeted(record, now, tweet_id)
+                    num_recorded += 1
+            if num_recorded > 0:
+                self.__wrote()
+        return num_recorded
+
+    def __record_tweeted(self, record, now, tweet_id):
+        if record.tweeted_date is None:
+            self._table.unindex_pending(record)
+        record.tweeted_date = now
+        record.tweet_id = tweet_id
+        record.claimed_by = None
+        record.claim_expires = None
+
+    def renew_claims(self, schedule_ids, lease=DEFAULT_LEASE):
+        now = int(time.time())
+        renewed = []
+        with self._table.lock, METRICS.timer('db_update'):
+            for schedule_id in schedule_ids:
+                record = self._table.records[schedule_id]
+                if record.claimed_by == self.claimant and record.tweeted_date is None:
+                    record.claim_expires = now + lease
+                    renewed.append(schedule_id)
+            if len(renewed) > 0:
+                self.__wrote()
+        return renewed
+
+    def release_claims(self, schedule_ids):
+        with self._table.lock, METRICS.timer('db_update'):
+            for schedule_id in schedule_ids:
+                record = self._table.records[schedule_id]
+                if record.claimed_by == self.claimant:
+                    record.claimed_by = None
+                    record.claim_expires = None
+            self.__wrote()
+
+    def commit(self):
+        pass
+
+    def schedule_tweet(self, date, text, url=None):
+        self.schedule_tweet_values([tweet_values(date, text, url)])
+
+    def schedule_tweet_values(self, values, chunk_size=DEFAULT_CHUNK_SIZE, dedup=False, on_duplicate=None):
+        """As TweetStore.schedule_tweet_values. Duplicates are found with an
+           exact set of content hashes rather than an index. Nothing is added
+           to the table until every value has been read, so if reading any
+           of them raises, none are scheduled."""
+        table = self._table
+        records = []
+        hashes = set()
+        with table.lock, METRICS.timer('db_insert'):
+            schedule_id = table.next_id
+            for value in values:
+                digest = None
+                if dedup:
+                    digest = content_hash(value)
+                    if (self._account, digest) in table.hashes or digest in hashes:
+                        self._duplicates_skipped += 1
+                        if on_duplicate is not None:
+                            on_duplicate(value)
+                        continue
+                    hashes.add(digest)
+                date, epoch, text, url, payload, length = value
+                records.append(TweetRecord(schedule_id, self._account, str(date), epoch, text, url,
+                                           content_hash=digest, payload=payload, weighted_length=length))
+                schedule_id += 1
+            for record in records:
+                table.add(record)
+            if len(records) > 0:
+                table.index_pending(self._account, [(record.tweet_on_epoch, record.schedule_id) for record in records])
+                self.__wrote()
+        return len(records)
+
+    ########################################################################
+    # Data reading
+    def due_tweets(self, page_size=DEFAULT_PAGE_SIZE):
+        """As TweetStore.due_tweets. Each page is found by a binary search
+           for the key after the last tweet of the previous page."""
+        now = int(time.time())
+        last_key = None
+        while True:
+            page = []
+            with self._table.lock, METRICS.timer('db_query'):
+                pending = self._table.pending.get(self._account, [])
+                index = 0 if last_key is None else bisect_right(pending, last_key)
+                end = bisect_right(pending, (now, LAST_ID))
+                while index < end and len(page) < page_size:
+                    last_key = pending[index]
+                    record = self._table.records[last_key[1]]
+                    if record.claim_expires is None or record.claim_expires <= now:
+                        page.append(self.__due_tweet(record))
+                    index += 1
+            for due_tweet in page:
+                yield due_tweet
+            if index >= end:
+                return
+
+    def backlog_size(self):
+        with self._table.lock:
+            return bisect_right(self._table.pending.get(self._account, []), (int(time.time()), LAST_ID))
+
+    def posted_since(self, since):
+        """As TweetStore.posted_since, though every record is scanned."""
+        since = str(since)
+        with self._table.lock, METRICS.timer('db_query'):
+            return sum(1 for record in self._table.records.values()
+                       if record.account == self._account and record.tweeted_date is not None
+                       and record.tweeted_date >= since)
+
+    def upcoming_tweets(self, limit):
+        with self._table.lock, METRICS.timer('db_query'):
+            pending = self._table.pending.get(self._account, [])
+            start = bisect_right(pending, (int(time.time()), LAST_ID))
+            return pending[start:start + limit]
+
+    def scheduled_epochs(self, start_epoch):
+        with self._table.lock, METRICS.timer('db_query'):
+            pending = self._table.pending.get(self._account, [])
+            return [epoch for epoch, _ in pending[bisect_left(pending, (start_epoch,)):]]
+
+    def claim_due_tweets(self, limit, lease=DEFAULT_LEASE):
+        """As TweetStore.claim_due_tweets. Claims last only as long as the
+           table, so are only shared between stores in one process."""
+        now = int(time.time())
+        claimed = []
+        with self._table.lock, METRICS.timer('db_update'):
+            pending = self._table.pending.get(self._account, [])
+            end = bisect_right(pending, (now, LAST_ID))
+            index = 0
+            while index < end and len(claimed) < limit:
+                record = self._table.records[pending[index][1]]
+                if record.claim_expires is None or record.claim_expires <= now:
+                    record.claimed_by = self.claimant
+                    record.claim_expires = now + lease
+                    claimed.append(self.__due_tweet(record))
+                index += 1
+            if len(claimed) > 0:
+                self.__wrote()
+        return claimed
+
+    def __due_tweet(self, record):
+        # Records loaded from snapshots taken before payloads were stored
+        payload = record.payload
+        if payload is None:
+            payload = full_tweet(record.tweet_text, record.tweet_url)
+        return DueTweet(record.schedule_id, payload, record.tweet_on_date, record.tweet_on_epoch)
+
+    ########################################################################
+    # General usage
+    def __enter__(self):
+        if self._table is None:
+            self._table = shared_table(self._snapshot_name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._snapshot_name is not None:
+            self._table.snapshot(self._snapshot_name)
+
+    def __wrote(self):
+        self._table.version += 1
+        self._own_writes += 1
+
+    def __str__(self):
+        return "<MemoryTweetStore: storage_name='{}'>".format(self.storage_name)
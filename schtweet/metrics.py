@@ -0,0 +1,171 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds, in seconds, of the buckets operation timings are counted in
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float('inf'))
+
+# Prefix of every exported metric name
+PREFIX = 'schtweet'
+
+
+class Histogram(object):
+    """Thread safe histogram of observed values, counted in cumulative
+       buckets in the same way as a Prometheus histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'buckets': {format_bound(bound): count for bound, count in zip(self.buckets, self.counts)},
+            }
+
+
+class _Timer(object):
+    """Context manager timing its body into a histogram."""
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class _NullTimer(object):
+    """Context manager which does nothing, used while metrics are disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics(object):
+    """Collects counters, gauges and operation timing histograms for a run.
+
+       Metrics are disabled until enable is called. While disabled every
+       method returns straight away, so instrumented code costs no more than
+       a function call and an attribute check."""
+
+    def __init__(self):
+        self.enabled = False
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def timer(self, operation):
+        """Returns a context manager which times its body as operation."""
+        if not self.enabled:
+            return NULL_TIMER
+        histogram = self._histograms.get(operation)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(operation, Histogram())
+        return _Timer(histogram)
+
+    def increment(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self):
+        """Returns all of the metrics as a dict suitable for JSON."""
+        with self._lock:
+            histograms = dict(self._histograms)
+            return {
+                'timestamp': time.time(),
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'operations': {name: histogram.snapshot() for name, histogram in histograms.items()},
+            }
+
+    def prometheus_text(self):
+        """Returns the metrics in the Prometheus text exposition format, as
+           read by the node exporter's textfile collector."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE {}_{}_total counter'.format(PREFIX, name))
+            lines.append('{}_{}_total {}'.format(PREFIX, name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('# TYPE {}_{} gauge'.format(PREFIX, name))
+            lines.append('{}_{} {}'.format(PREFIX, name, value))
+        if len(snapshot['operations']) > 0:
+            lines.append('# TYPE {}_operation_seconds histogram'.format(PREFIX))
+        for operation, histogram in sorted(snapshot['operations'].items()):
+            for bound, count in histogram['buckets'].items():
+                lines.append('{}_operation_seconds_bucket{{operation="{}",le="{}"}} {}'.format(
+                    PREFIX, operation, bound, count))
+            lines.append('{}_operation_seconds_sum{{operation="{}"}} {}'.format(PREFIX, operation, histogram['sum']))
+            lines.append('{}_operation_seconds_count{{operation="{}"}} {}'.format(
+                PREFIX, operation, histogram['count']))
+        lines.append('# TYPE {}_last_run_timestamp_seconds gauge'.format(PREFIX))
+        lines.append('{}_last_run_timestamp_seconds {}'.format(PREFIX, snapshot['timestamp']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """Writes the metrics to filename, in the Prometheus text format if it
+           ends with .prom and as JSON otherwise. The file is replaced
+           atomically so collectors never read a partial file."""
+        if filename.endswith('.prom'):
+            content = self.prometheus_text()
+        else:
+            content = json.dumps(self.snapshot(), indent=2) + '\n'
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        handle, temp_name = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        try:
+            with os.fdopen(handle, 'w') as temp_file:
+                temp_file.write(content)
+            os.chmod(temp_name, 0o644)
+            os.replace(temp_name, filename)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+# The metrics for this process, shared by everything instrumented
+METRICS = Metrics()
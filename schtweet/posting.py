@@ -0,0 +1,371 @@
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import partial
+
+from schtweet.metrics import METRICS
+from schtweet.storage import ACK_BATCH_SIZE, DEFAULT_LEASE, open_store
+
+# Twitter allows 300 tweets per account in a rolling 3 hour window
+DEFAULT_RATE_LIMIT = 300
+DEFAULT_RATE_PERIOD = 3 * 60 * 60
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 2.0
+MAX_BACKOFF = 60.0
+
+# Number of times claims are renewed per lease while their tweets wait to be
+# posted
+LEASE_RENEWALS = 3
+
+
+class PostingStopped(Exception):
+    """Raised in place of waiting for a rate limit token or a retry once
+       posting has been asked to stop."""
+
+
+def create_pool(workers):
+    """Returns a ThreadPoolExecutor with workers threads. concurrent.futures
+       is only imported when a pool is first needed, so runs with nothing to
+       post don't pay for importing it."""
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+class TokenBucket(object):
+    """Thread safe token bucket rate limiter. Holds up to capacity tokens,
+       refilled at capacity tokens every period seconds. Each call to
+       acquire takes a token, blocking until one is available.
+
+       The bucket starts full. Pass the number of posts already made in the
+       last period to limit_to, so each run of a script doesn't get a full
+       period's worth of its own.
+
+       If stop_event, a threading.Event, is given, waits for a token are
+       made on it, and acquire raises PostingStopped once it is set rather
+       than waiting on."""
+
+    def __init__(self, capacity=DEFAULT_RATE_LIMIT, period=DEFAULT_RATE_PERIOD, clock=time.monotonic,
+                 sleep=None, stop_event=None):
+        self._capacity = capacity
+        self._period = period
+        self._rate = capacity / period
+        self._tokens = capacity
+        self._clock = clock
+        if sleep is None:
+            sleep = time.sleep if stop_event is None else stop_event.wait
+        self._sleep = sleep
+        self._stop_event = stop_event
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    ########################################################################
+    # Properties
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def period(self):
+        return self._period
+
+    ########################################################################
+    # Tokens
+    def limit_to(self, tokens):
+        """Takes tokens from the bucket until it holds no more than tokens."""
+        with self._lock:
+            self.__refill()
+            self._tokens = min(self._tokens, max(0, tokens))
+
+    def acquire(self):
+        while True:
+            if self._stop_event is not None and self._stop_event.is_set():
+                raise PostingStopped()
+            with self._lock:
+                self.__refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            self._sleep(wait)
+
+    def __refill(self):
+        now = self._clock()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+
+class _ClaimedBatch(object):
+    """A batch of tweets claimed by a run of PostingEngine.process. Its
+       claims are renewed while the run waits for them to be posted, so they
+       can't expire while the tweets wait for rate limit tokens or retries.
+       Workers check a tweet's claim is still held before posting it, in case
+       it was lost to another store anyway."""
+
+    def __init__(self, tweets, lease):
+        self._tweets = tweets
+        self._lease = lease
+        self._lost = frozenset()
+        self._renew_at = time.monotonic() + lease / LEASE_RENEWALS
+
+    def holds(self, schedule_id):
+        return schedule_id not in self._lost
+
+    def result(self, store, future, index, posted):
+        """Returns the result of future, posting the index'th tweet. Each time
+           a renewal falls due while waiting, renews the claims on that tweet,
+           every later tweet and the posted tweets not yet acknowledged.
+           Called on the thread using store."""
+        # Imported here as it is only needed once there's a pool to wait on
+        from concurrent.futures import wait
+        while len(wait([future], max(0, self._renew_at - time.monotonic()))[0]) == 0:
+            waiting = [schedule_id for schedule_id, _ in posted]
+            waiting.extend(tweet.schedule_id for tweet in self._tweets[index:])
+            lost = set(waiting).difference(store.renew_claims(waiting, self._lease))
+            if len(lost) > 0:
+                METRICS.increment('claims_lost', len(lost))
+                self._lost = self._lost.union(lost)
+            self._renew_at = time.monotonic() + self._lease / LEASE_RENEWALS
+        return future.result()
+
+
+class PostingEngine(object):
+    """Posts due tweets from a TweetStore using a pool of worker threads.
+
+       post_update is called with the text of each tweet and should return
+       the string ID of the posted tweet, or None if it wasn't posted. If it
+       raises an exception for which is_transient returns True the post is
+       retried, with exponential backoff, up to max_retries times. Every
+       attempt first takes a token from rate_limiter, if one is given, which
+       each call to process first limits to the tokens left after the posts
+       the store recorded in the rate limiter's last period. Posts
+       which still fail are passed to on_failure along with the exception.
+       Each posted DueTweet is passed to on_posted along with its ID.
+
+       Setting stop_event, a threading.Event, stops posting. Posts not yet
+       started and retries waiting for their backoff are given up, and
+       process returns once the posts already being made finish. Retries
+       wait on stop_event unless sleep is given. Pass the same event to the
+       rate_limiter so waits for tokens are given up too.
+
+       Tweets are posted concurrently, so with more than one worker tweets due
+       at around the same time may be posted slightly out of order. Results
+       are always written back to the store in schedule order.
+
+       Posts are made on a pool of workers threads created for each call to
+       process which finds tweets to post, unless an existing
+       ThreadPoolExecutor is passed as pool. A shared pool is left running
+       for its owner to shut down."""
+
+    def __init__(self, post_update, workers=DEFAULT_WORKERS, rate_limiter=None,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                 is_transient=lambda error: False, on_failure=None, on_posted=None, sleep=None, pool=None,
+                 stop_event=None):
+        self._post_update = post_update
+        self._workers = workers
+        self._rate_limiter = rate_limiter
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._is_transient = is_transient
+        self._on_failure = on_failure
+        self._on_posted = on_posted
+        self._stop_event = stop_event if stop_event is not None else threading.Event()
+        self._sleep = sleep if sleep is not None else self._stop_event.wait
+        self._pool = pool
+
+    def process(self, store, claim_size=None, lease=DEFAULT_LEASE, max_tweets=None, time_budget=None):
+        """Posts all of the store's due tweets and records the IDs of those
+           successfully posted. Returns the number of tweets processed and the
+           number posted.
+
+           Tweets are claimed from the store claim_size at a time, defaulting
+           to four per worker, so other processes can post from the same
+           storage concurrently. Claims are renewed every third of lease
+           seconds until their tweets are posted, and a tweet whose claim was
+           lost to another process isn't posted or acknowledged. Posted tweets
+           are acknowledged in a short transaction every ACK_BATCH_SIZE
+           tweets, so a crash loses at most that many and the write lock is
+           never held while posting. Tweets which weren't posted are released
+           once everything due has been tried, ready for the next run. If an
+           exception stops the run, posts not yet started are cancelled and
+           those already started are waited for and acknowledged first.
+
+           No more tweets are claimed once max_tweets tweets have been
+           processed or time_budget seconds have passed, if given."""
+        with METRICS.timer('process_due_tweets'):
+            return self.__process(store, claim_size, lease, max_tweets, time_budget)
+
+    def __process(self, store, claim_size, lease, max_tweets, time_budget):
+        if claim_size is None:
+            claim_size = self._workers * 4
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        if METRICS.enabled:
+            METRICS.set_gauge('backlog', store.backlog_size())
+        processed_tweets = 0
+        sent_tweets = 0
+        posted = []
+        unposted = []
+        pool = self._pool
+        # The current batch, and how many of its tweets have been added to
+        # posted or unposted
+        claimed = []
+        futures = []
+        resolved = 0
+        try:
+            while True:
+                limit = claim_size
+                if max_tweets is not None:
+                    limit = min(limit, max_tweets - processed_tweets)
+                if limit <= 0 or (deadline is not None and time.monotonic() >= deadline):
+                    break
+                if self._stop_event.is_set():
+                    break
+                claimed = store.claim_due_tweets(limit, lease)
+                futures = []
+                resolved = 0
+                if len(claimed) == 0:
+                    break
+                if processed_tweets == 0:
+                    self.__limit_rate(store)
+                if pool is None:
+                    pool = create_pool(self._workers)
+                batch = _ClaimedBatch(claimed, lease)
+                futures = [pool.submit(self._post, tweet.tweet, partial(batch.holds, tweet.schedule_id))
+                           for tweet in claimed]
+                for index, (tweet, future) in enumerate(zip(claimed, futures)):
+                    processed_tweets += 1
+                    try:
+                        tweet_id = batch.result(store, future, index, posted)
+                    except PostingStopped:
+                        processed_tweets -= 1
+                        tweet_id = None
+                    except Exception as e:
+                        METRICS.increment('tweets_failed')
+                        if self._on_failure is None:
+                            raise
+                        self._on_failure(tweet.tweet, e)
+                        tweet_id = None
+                    if tweet_id is not None and len(tweet_id) > 0:
+                        posted.append((tweet.schedule_id, tweet_id))
+                        resolved += 1
+                        sent_tweets += 1
+                        METRICS.increment('tweets_posted')
+                        if self._on_posted is not None:
+                            self._on_posted(tweet, tweet_id)
+                        if len(posted) >= ACK_BATCH_SIZE:
+                            self.__acknowledge(store, posted)
+                            posted = []
+                    else:
+                        unposted.append(tweet.schedule_id)
+                        resolved += 1
+                self.__acknowledge(store, posted)
+                posted = []
+        except BaseException:
+            self.__abandon(claimed[resolved:], futures[resolved:], posted, unposted)
+            raise
+        finally:
+            try:
+                self.__acknowledge(store, posted)
+            finally:
+                if pool is not None and pool is not self._pool:
+                    pool.shutdown()
+                store.release_claims(unposted)
+        return processed_tweets, sent_tweets
+
+    def __abandon(self, tweets, futures, posted, unposted):
+        """Stops a batch left part way through by an exception. Posts which
+           haven't started are cancelled, those waiting for a token or a
+           retry are stopped and the rest waited for, as they can't be
+           stopped, so the tweets they posted can be acknowledged rather than
+           posted again once their claims expire. Every other tweet is added
+           to unposted."""
+        if len(futures) == 0:
+            return
+        # Imported here as it is only needed once there's a pool to wait on
+        from concurrent.futures import wait
+        for future in futures:
+            future.cancel()
+        stopping = not self._stop_event.is_set()
+        self._stop_event.set()
+        try:
+            wait(futures)
+        finally:
+            if stopping:
+                self._stop_event.clear()
+        for tweet, future in zip(tweets, futures):
+            tweet_id = None
+            if not future.cancelled() and future.exception() is None:
+                tweet_id = future.result()
+            if tweet_id is not None and len(tweet_id) > 0:
+                posted.append((tweet.schedule_id, tweet_id))
+                METRICS.increment('tweets_posted')
+            else:
+                unposted.append(tweet.schedule_id)
+
+    def __limit_rate(self, store):
+        """Takes the tokens spent by earlier runs from the rate limiter, as
+           a new one starts full."""
+        if self._rate_limiter is not None:
+            since = datetime.now() - timedelta(seconds=self._rate_limiter.period)
+            self._rate_limiter.limit_to(self._rate_limiter.capacity - store.posted_since(since))
+
+    @staticmethod
+    def __acknowledge(store, posted):
+        num_recorded = store.acknowledge(posted)
+        if num_recorded < len(posted):
+            METRICS.increment('acknowledgements_lost', len(posted) - num_recorded)
+
+    def _post(self, tweet_text, holds_claim=None):
+        attempt = 0
+        while True:
+            if self._stop_event.is_set():
+                raise PostingStopped()
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            # Waiting for the token may have outlasted the claim
+            if holds_claim is not None and not holds_claim():
+                return None
+            try:
+                with METRICS.timer('post_update'):
+                    return self._post_update(tweet_text)
+            except Exception as e:
+                if attempt >= self._max_retries or not self._is_transient(e):
+                    raise
+                METRICS.increment('post_retries')
+                delay = min(MAX_BACKOFF, self._backoff * (2 ** attempt))
+                self._sleep(delay * random.uniform(0.5, 1.0))
+                attempt += 1
+
+
+class MultiAccountPoster(object):
+    """Posts the due tweets of many accounts sharing one storage file in a
+       single run. engines maps each account name to the PostingEngine,
+       with its own API client and rate limiter, used to post its tweets.
+
+       Every account's queue is drained concurrently, each from its own store
+       connection on its own thread. All of the engines should share one
+       ThreadPoolExecutor. Each account waits for its current batch before
+       claiming another, so the pool's queue interleaves batches from every
+       account and a large backlog on one can't starve the rest."""
+
+    def __init__(self, storage_name, engines):
+        self._storage_name = storage_name
+        self._engines = engines
+
+    def process(self, max_tweets=None, time_budget=None):
+        """Posts every account's due tweets, returning a dict mapping each
+           account name to the number of tweets processed and the number
+           posted. max_tweets and time_budget apply to each account."""
+        if len(self._engines) == 0:
+            return {}
+        with create_pool(len(self._engines)) as accounts:
+            futures = {account: accounts.submit(self.__process_account, account, engine, max_tweets, time_budget)
+                       for account, engine in self._engines.items()}
+            return {account: future.result() for account, future in futures.items()}
+
+    def __process_account(self, account, engine, max_tweets, time_budget):
+        # WAL lets the accounts read the storage while another holds the write lock
+        with open_store(self._storage_name, journal_mode='WAL', account=account) as ts:
+            return engine.process(ts, max_tweets=max_tweets, time_budget=time_budget)
@@ -0,0 +1,186 @@
+import collections
+import io
+import os
+import sys
+import threading
+import time
+
+from schtweet.metrics import METRICS
+from schtweet.storage import MEMORY_PREFIX
+
+# Modes of the --profile option shared by the scripts
+PROFILE_MODES = ('cprofile', 'sample', 'sections')
+
+# Seconds between the stacks taken by StackSampler
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+def add_profile_argument(parser):
+    parser.add_argument('--profile',
+                        help='Profile the run. cprofile writes cProfile statistics, for python -m pstats or '
+                             'snakeviz, and sample writes stacks sampled from every thread in the collapsed format '
+                             'read by flamegraph.pl and speedscope. Both are written next to the storage file. '
+                             'sections only times named sections of the run, such as parse_row, db_insert, '
+                             'process_due_tweets and post_update, and prints a table of them when finished.',
+                        choices=PROFILE_MODES)
+
+
+def profile_filename(storage_name, script_name, extension):
+    """Returns the name of a new profile of a run of script_name, in the same
+       directory as storage_name and named after it."""
+    if storage_name.startswith(MEMORY_PREFIX):
+        storage_name = storage_name[len(MEMORY_PREFIX):] or 'memory'
+    storage_name = os.path.abspath(storage_name)
+    return os.path.join(os.path.dirname(storage_name), '{}.{}-{}.{}'.format(
+        os.path.basename(storage_name), script_name, time.strftime('%Y%m%d-%H%M%S'), extension))
+
+
+def profiled(mode, storage_name, script_name):
+    """Returns a context manager profiling its body in the --profile mode,
+       or doing nothing if mode is None. sample falls back to cprofile where
+       the interpreter can't list the stacks of its threads."""
+    if mode is None:
+        return NullProfiler()
+    if mode == 'sections':
+        return SectionTimer()
+    if mode == 'sample' and hasattr(sys, '_current_frames'):
+        return StackSampler(profile_filename(storage_name, script_name, 'collapsed'))
+    return CProfiler(profile_filename(storage_name, script_name, 'pstats'))
+
+
+class NullProfiler(object):
+    """Context manager which does nothing, used when not profiling."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class CProfiler(object):
+    """Profiles the calling thread with cProfile, writing the statistics to
+       filename when finished. Work done on other threads, such as posting
+       tweets, only shows up as the time spent waiting for it."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._profile = None
+
+    def __enter__(self):
+        # Imported here as it is only needed when profiling
+        import cProfile
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profile.disable()
+        self._profile.dump_stats(self._filename)
+        print('Wrote cProfile statistics to {}'.format(self._filename))
+
+
+class StackSampler(object):
+    """Sampling profiler which takes the stack of every other thread each
+       interval seconds, writing how often each was seen to filename when
+       finished. Each line of the file is a stack, outermost frame first and
+       separated by semicolons, followed by its count:
+
+            MainThread;main (import-tweets.py:231);parse_csv (import-tweets.py:60) 42
+
+       Unlike cProfile the profiled code isn't slowed down by every call, and
+       the time threads spend posting tweets is included. A thread's stack can
+       only be taken when it lets go of the interpreter, so time in a tight
+       loop tends to be counted against the loop rather than its callees."""
+
+    def __init__(self, filename, interval=DEFAULT_SAMPLE_INTERVAL):
+        self._filename = filename
+        self._interval = interval
+        self._stacks = collections.Counter()
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    ########################################################################
+    # Properties
+    @property
+    def num_samples(self):
+        return sum(self._stacks.values())
+
+    ########################################################################
+    # Sampling
+    def _run(self):
+        sampler_id = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != sampler_id:
+                    self._stacks[self.__stack(names.get(thread_id, str(thread_id)), frame)] += 1
+
+    def __stack(self, thread_name, frame):
+        frames = []
+        while frame is not None:
+            frames.append(self.__label(frame.f_code))
+            frame = frame.f_back
+        frames.append(thread_name)
+        return ';'.join(reversed(frames))
+
+    def __label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            # Semicolons and spaces separate the fields of the collapsed format
+            label = '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            label = label.replace(';', ':')
+            self._labels[code] = label
+        return label
+
+    def write(self, filename):
+        with io.open(filename, 'w', encoding='utf8') as collapsed_file:
+            for stack, count in sorted(self._stacks.items()):
+                collapsed_file.write('{} {}\n'.format(stack, count))
+
+    ########################################################################
+    # General usage
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name='StackSampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.write(self._filename)
+        print('Wrote {} sampled stacks to {}'.format(self.num_samples, self._filename))
+
+
+class SectionTimer(object):
+    """Times the named sections of the run with the operation timers of
+       METRICS, printing a table of them when finished. Sections may be
+       nested, such as db_insert within process_due_tweets, so their share
+       of the run can add up to more than 100%."""
+
+    def __init__(self):
+        self._start = None
+
+    def __enter__(self):
+        METRICS.enable()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self._start
+        print(self.table(METRICS.snapshot()['operations'], elapsed))
+
+    @staticmethod
+    def table(operations, elapsed):
+        """Returns the table of operations, a dict of histogram snapshots,
+           slowest first."""
+        width = max([len('section')] + [len(name) for name in operations])
+        lines = ['{:<{}}  {:>10}  {:>10}  {:>10}  {:>7}'.format('section', width, 'calls', 'total (s)', 'mean (us)',
+                                                                '% run')]
+        for name, histogram in sorted(operations.items(), key=lambda item: -item[1]['sum']):
+            lines.append('{:<{}}  {:>10}  {:>10.3f}  {:>10.1f}  {:>7.1f}'.format(
+                name, width, histogram['count'], histogram['sum'], histogram['sum'] * 1e6 / histogram['count'],
+                histogram['sum'] * 100 / elapsed))
+        lines.append('{:<{}}  {:>10}  {:>10.3f}'.format('run', width, '', elapsed))
+        return '\n'.join(lines)
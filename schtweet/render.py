@@ -0,0 +1,143 @@
+import csv
+import io
+import re
+import unicodedata
+
+# Longest tweet Twitter accepts, in weighted characters
+MAX_WEIGHTED_LENGTH = 280
+
+# Weighted length of every URL, as Twitter shortens them all to t.co links
+URL_LENGTH = 23
+
+# Code point ranges counted as one character by Twitter. Everything else,
+# such as CJK characters and emoji, counts as two.
+SINGLE_WEIGHT_RANGES = ((0, 4351), (8192, 8205), (8208, 8223), (8242, 8247))
+
+# Any code point counted as two, so they can be counted in a single pass
+DOUBLE_WEIGHT_PATTERN = re.compile('[^{}]'.format(''.join('{}-{}'.format(re.escape(chr(start)), re.escape(chr(end)))
+                                                          for start, end in SINGLE_WEIGHT_RANGES)))
+
+# URLs in the text of a tweet, which Twitter counts as URL_LENGTH
+URL_PATTERN = re.compile(r'https?://\S+', re.IGNORECASE)
+
+# URLs which can be posted: http or https, with a host and no whitespace
+VALID_URL_PATTERN = re.compile(r'https?://[^\s/?#]+\S*', re.IGNORECASE)
+
+
+def full_tweet(text, url):
+    """Returns the text to post for a tweet, including any URL."""
+    if url is not None:
+        return "{} {}".format(text, url)
+    return text
+
+
+def weighted_length(text):
+    """Returns the length of text as Twitter counts it against
+       MAX_WEIGHTED_LENGTH. The text is NFC normalised first, each http or
+       https URL counts as URL_LENGTH and each code point outside
+       SINGLE_WEIGHT_RANGES counts as two."""
+    text = unicodedata.normalize('NFC', text)
+    if '://' not in text:
+        return _code_point_length(text)
+    length = 0
+    position = 0
+    for match in URL_PATTERN.finditer(text):
+        length += _code_point_length(text[position:match.start()]) + URL_LENGTH
+        position = match.end()
+    return length + _code_point_length(text[position:])
+
+
+def _code_point_length(text):
+    return len(text) + len(DOUBLE_WEIGHT_PATTERN.findall(text))
+
+
+def render_tweet(text, url):
+    """Returns the (payload, weighted length) of a tweet, where payload is
+       the text posted. url should already be normalised by tweet_url."""
+    length = weighted_length(text)
+    if url is not None:
+        # The separating space plus the shortened URL
+        length += 1 + URL_LENGTH
+    return full_tweet(text, url), length
+
+
+def rejection_reason(values):
+    """Returns why a tweet normalised by tweet_values can't be posted, or None
+       if it can."""
+    text, url, length = values[2], values[3], values[5]
+    if len(text.strip()) == 0:
+        return 'The tweet text is empty'
+    if url is not None and not is_valid_url(url):
+        return 'The URL "{}" is not valid'.format(url)
+    if length > MAX_WEIGHTED_LENGTH:
+        return 'The tweet is {} characters long, more than the {} allowed'.format(length, MAX_WEIGHTED_LENGTH)
+    return None
+
+
+def is_valid_url(url):
+    return VALID_URL_PATTERN.fullmatch(url) is not None
+
+
+def validated_values(values, on_reject):
+    """Generator passing through the tweets normalised by tweet_values which
+       can be posted. Each of the others is passed to on_reject along with
+       the reason it was rejected, instead of being scheduled."""
+    for value in values:
+        reason = rejection_reason(value)
+        if reason is None:
+            yield value
+        else:
+            on_reject(value, reason)
+
+
+class RejectsReport(object):
+    """Collects the tweets rejected by validated_values, for use as its
+       on_reject callback. If filename is given each is written to it as a
+       CSV line of: date,tweet_text,url,reason. The date is in UTC, with the
+       offset included so the line can be fixed up and imported again. If
+       log is given it is called with a message describing each.
+
+            with RejectsReport('rejects.csv') as rejects:
+                ts.schedule_tweet_values(validated_values(values, rejects))"""
+
+    def __init__(self, filename=None, log=None):
+        self._filename = filename
+        self._log = log
+        self._file = None
+        self._writer = None
+        self._count = 0
+
+    ########################################################################
+    # Properties
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def count(self):
+        """Number of tweets rejected so far."""
+        return self._count
+
+    ########################################################################
+    # Reporting
+    def __call__(self, values, reason):
+        self._count += 1
+        if self._log is not None:
+            self._log('Rejected tweet: date="{}", tweet="{}", url="{}". {}'.format(values[0], values[2], values[3],
+                                                                                  reason))
+        if self._writer is not None:
+            self._writer.writerow(['{}+00:00'.format(values[0]), values[2], values[3] or '', reason])
+
+    ########################################################################
+    # General usage
+    def __enter__(self):
+        if self._filename is not None:
+            self._file = io.open(self._filename, 'w', encoding='utf8', newline='')
+            self._writer = csv.writer(self._file)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
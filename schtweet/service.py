@@ -0,0 +1,370 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+from schtweet.dates import DateParser
+from schtweet.metrics import METRICS
+from schtweet.render import rejection_reason
+from schtweet.storage import content_hash
+
+# Minimum seconds between group commits. Writes arriving in between are
+# gathered into the next one.
+DEFAULT_COMMIT_INTERVAL = 0.002
+
+# Number of buffered tweets which are committed straight away, rather than
+# waiting for the rest of the commit interval
+MAX_GROUP_SIZE = 10000
+
+# Largest request body accepted, in bytes
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+# Reason phrases of the status codes sent
+STATUS_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+
+class RequestError(ValueError):
+    """Raised when a request can't be served, with the HTTP status code to
+       respond with."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class _PendingWrite(object):
+    """A request's tweets waiting for the next group commit, with the future
+       its handler is waiting on."""
+    __slots__ = ('values', 'future', 'duplicates')
+
+    def __init__(self, values, future):
+        self.values = values
+        self.future = future
+        self.duplicates = 0
+
+
+class IngestService(object):
+    """Local HTTP service scheduling tweets into a store which it holds open
+       for its whole life, so each tweet costs a request rather than starting
+       import-tweets.py, opening the storage and checking its schema.
+
+       POST /tweets takes a JSON tweet object, a list of them, or an object
+       with a list of them as "tweets". Each tweet has "date", "text" and an
+       optional "url", read in the same way as the columns of an imported
+       CSV. Dates without timezone information are in timezone. Tweets which
+       can't be posted are rejected, as import-tweets.py rejects rows. The
+       response gives the number of tweets scheduled, duplicates skipped if
+       dedup is set, and the index and reason of each rejected tweet.
+
+       GET /status returns the queue depth, which is the number of due tweets
+       not yet posted, the number of tweets waiting to be committed, and when
+       the next tweet not yet due falls due.
+
+       Rather than committing each request, there is at most one commit every
+       commit_interval seconds. The tweets of every request arriving in
+       between are inserted and committed together, then all of their
+       responses are sent. A request arriving while idle is committed
+       straight away, so the interval only adds latency under load. A request
+       is only answered once its tweets are committed.
+
+       The store is only used on writer, an executor with a single thread,
+       which should be the thread the store was opened on. Requests keep
+       being read while a commit waits for the disk, and are gathered into
+       the next one. Without a writer the store is used on the event loop's
+       thread, which then serves nothing else while each commit is made."""
+
+    def __init__(self, store, timezone, commit_interval=DEFAULT_COMMIT_INTERVAL, dedup=False, loop=None,
+                 writer=None):
+        self._store = store
+        self._timezone = timezone
+        self._commit_interval = commit_interval
+        self._dedup = dedup
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._writer = writer
+        self._date_parser = DateParser()
+        self._pending = []
+        self._num_pending = 0
+        self._flush_handle = None
+        self._flushing = None
+        self._last_flush = None
+        self._server = None
+
+    ########################################################################
+    # Properties
+    @property
+    def pending_writes(self):
+        """Number of tweets waiting for the next group commit."""
+        return self._num_pending
+
+    ########################################################################
+    # Serving
+    async def start(self, host, port):
+        """Starts listening on host and port, returning the address actually
+           listened on, which differs if port is 0."""
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        """Stops accepting connections and commits any buffered tweets."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        await self.flush()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if len(request_line) == 0:
+                    break
+                keep_alive = True
+                try:
+                    method, path, version, headers, body = await self.__read_request(request_line, reader)
+                    keep_alive = self.__keep_alive(version, headers)
+                    status, content = await self.respond(method, path, body)
+                except RequestError as e:
+                    # The rest of the request can't be trusted to be read
+                    keep_alive = False
+                    status, content = e.status, {'error': str(e)}
+                self.__write_response(writer, status, content, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def __read_request(self, request_line, reader):
+        try:
+            method, path, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise RequestError(400, 'Invalid request line')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise RequestError(400, 'Invalid Content-Length')
+        if length > MAX_BODY_SIZE:
+            raise RequestError(413, 'Request bodies are limited to {} bytes'.format(MAX_BODY_SIZE))
+        body = await reader.readexactly(length) if length > 0 else b''
+        return method, path, version, headers, body
+
+    @staticmethod
+    def __keep_alive(version, headers):
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    @staticmethod
+    def __write_response(writer, status, content, keep_alive):
+        encoded = json.dumps(content).encode('utf8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: {}\r\n\r\n'.format(status, STATUS_REASONS[status], len(encoded),
+                                                     'keep-alive' if keep_alive else 'close').encode('latin-1'))
+        writer.write(encoded)
+
+    async def respond(self, method, path, body):
+        """Returns the (status code, JSON content) of the response to a
+           request."""
+        METRICS.increment('requests_served')
+        path = path.split('?', 1)[0]
+        try:
+            if path == '/tweets':
+                if method != 'POST':
+                    raise RequestError(405, 'Use POST to schedule tweets')
+                return 200, await self.schedule(self.__json(body))
+            if path == '/status':
+                if method != 'GET':
+                    raise RequestError(405, 'Use GET to read the status')
+                return 200, await self.status()
+            raise RequestError(404, 'No such path {}'.format(path))
+        except RequestError as e:
+            return e.status, {'error': str(e)}
+        except Exception as e:
+            print('Failed to serve {} {}. Exception: {}'.format(method, path, e))
+            return 500, {'error': str(e)}
+
+    @staticmethod
+    def __json(body):
+        try:
+            return json.loads(body.decode('utf8'))
+        except ValueError as e:
+            raise RequestError(400, 'Invalid JSON: {}'.format(e))
+
+    ########################################################################
+    # Scheduling
+    async def schedule(self, request):
+        """Schedules the tweets of a decoded POST /tweets request, returning
+           the content of the response once they are committed."""
+        values = []
+        rejected = []
+        for index, tweet in enumerate(self.__tweets(request)):
+            tweet_values = self.__tweet_values(index, tweet)
+            reason = rejection_reason(tweet_values)
+            if reason is None:
+                values.append(tweet_values)
+            else:
+                rejected.append({'index': index, 'reason': reason})
+        METRICS.increment('rows_rejected', len(rejected))
+
+        scheduled, duplicates = 0, 0
+        if len(values) > 0:
+            scheduled, duplicates = await self.__write(values)
+        response = {'scheduled': scheduled, 'rejected': rejected}
+        if self._dedup:
+            response['duplicates'] = duplicates
+        return response
+
+    @staticmethod
+    def __tweets(request):
+        if isinstance(request, dict) and 'tweets' in request:
+            request = request['tweets']
+        if isinstance(request, dict):
+            return [request]
+        if isinstance(request, list):
+            return request
+        raise RequestError(400, 'Expected a tweet, a list of tweets or an object with a list of "tweets"')
+
+    def __tweet_values(self, index, tweet):
+        """Returns a tweet object normalised by tweet_values. Raises
+           RequestError if it can't be read."""
+        try:
+            if not isinstance(tweet, dict):
+                raise ValueError('Expected an object with "date", "text" and an optional "url"')
+            date, text, url = tweet.get('date'), tweet.get('text'), tweet.get('url')
+            if not isinstance(date, str) or not isinstance(text, str) or not isinstance(url, (str, type(None))):
+                raise ValueError('"date" and "text" must be strings, and "url" a string if given')
+            converter = self._date_parser.converter(self._timezone)
+            return converter.tweet_values(self._date_parser.parse_local(date), text, url)
+        except (ValueError, OverflowError) as e:
+            raise RequestError(400, 'Could not read tweet {}. {}'.format(index, e))
+
+    def __write(self, values):
+        """Buffers values for the next group commit, returning a future for
+           the number of them scheduled and the number skipped as
+           duplicates."""
+        write = _PendingWrite(values, self._loop.create_future())
+        self._pending.append(write)
+        self._num_pending += len(values)
+        # A commit in progress schedules the next when it finishes
+        if self._flushing is None:
+            if self._num_pending >= MAX_GROUP_SIZE:
+                self.__schedule_flush(0)
+            elif self._flush_handle is None:
+                self.__schedule_flush(self.__next_flush_delay())
+        return write.future
+
+    def __next_flush_delay(self):
+        if self._last_flush is None or self._num_pending >= MAX_GROUP_SIZE:
+            return 0
+        return max(0, self._last_flush + self._commit_interval - self._loop.time())
+
+    def __schedule_flush(self, delay):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = self._loop.call_later(delay, self.__start_flush)
+
+    def __start_flush(self):
+        self._flush_handle = None
+        if self._flushing is None and len(self._pending) > 0:
+            self._flushing = self._loop.create_task(self.__flush())
+
+    async def flush(self):
+        """Waits for any commit in progress, then commits every tweet still
+           buffered."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._flushing is not None or len(self._pending) > 0:
+            if self._flushing is None:
+                self.__start_flush()
+            await asyncio.wait([self._flushing])
+
+    async def __flush(self):
+        """Inserts and commits every buffered tweet in one transaction on the
+           writer, then resolves the future of each request."""
+        pending, self._pending = self._pending, []
+        num_pending, self._num_pending = self._num_pending, 0
+
+        # Later copies of a tweet are the duplicates, so each is charged to
+        # the last request still holding a copy
+        owners = {}
+        if self._dedup:
+            for write in pending:
+                for value in write.values:
+                    owners.setdefault(content_hash(value), []).append(write)
+
+        def charge_duplicate(value):
+            owners[content_hash(value)].pop().duplicates += 1
+
+        on_duplicate = charge_duplicate if self._dedup else None
+
+        def commit():
+            with METRICS.timer('group_commit'):
+                return self._store.schedule_tweet_values(
+                    (value for write in pending for value in write.values), chunk_size=num_pending,
+                    dedup=self._dedup, on_duplicate=on_duplicate)
+
+        try:
+            num_scheduled = await self.__on_writer(commit)
+        except Exception as e:
+            for write in pending:
+                if not write.future.done():
+                    write.future.set_exception(e)
+            return
+        finally:
+            self._last_flush = self._loop.time()
+            self._flushing = None
+            if len(self._pending) > 0:
+                self.__schedule_flush(self.__next_flush_delay())
+        METRICS.increment('group_commits')
+        METRICS.increment('tweets_scheduled', num_scheduled)
+        # Each request is charged from the number actually inserted, in
+        # order, in case any rows were skipped without being reported
+        for write in pending:
+            scheduled = min(len(write.values) - write.duplicates, num_scheduled)
+            num_scheduled -= scheduled
+            if not write.future.done():
+                write.future.set_result((scheduled, len(write.values) - scheduled))
+
+    ########################################################################
+    # Status
+    async def status(self):
+        """Returns the content of the response to GET /status."""
+        upcoming, queue_depth = await self.__on_writer(
+            lambda: (self._store.upcoming_tweets(1), self._store.backlog_size()))
+        next_due = None
+        next_due_epoch = None
+        if len(upcoming) > 0:
+            next_due_epoch = upcoming[0][0]
+            next_due = datetime.fromtimestamp(next_due_epoch, timezone.utc).isoformat()
+        return {
+            'account': self._store.account,
+            'queue_depth': queue_depth,
+            'pending_writes': self.pending_writes,
+            'next_due': next_due,
+            'next_due_epoch': next_due_epoch,
+        }
+
+    ########################################################################
+    # Storage
+    async def __on_writer(self, function):
+        """Returns the result of calling function on the writer."""
+        if self._writer is None:
+            return function()
+        return await self._loop.run_in_executor(self._writer, function)
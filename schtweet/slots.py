@@ -0,0 +1,93 @@
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+
+from schtweet.dates import UtcConverter
+
+ONE_DAY = timedelta(days=1)
+
+
+class SlotAllocator(object):
+    """Allocates the time slots of a schedule, skipping those which aren't
+       free. Used by schedule-lines.py to fit a new campaign around the
+       tweets already scheduled.
+
+       The candidate slots are each of times, datetimes of which only the
+       time is used, on each day from first_day. They are taken in the order
+       given, as schedule-lines.py has always done. A slot is skipped if:
+
+       * its day isn't one of weekdays, a set of date.weekday() numbers
+       * its day already has max_per_day tweets, including those occupied
+       * it is closer than min_spacing to an occupied time or a slot already
+         allocated. With no spacing, only a tweet at exactly the same time
+         takes the slot.
+
+       occupied is a sorted list of the UTC epoch seconds of the tweets
+       already scheduled, as returned by scheduled_epochs. Slot times are
+       localised to timezone to compare with them. Each check is a binary
+       search and the slots are only walked forwards, so allocating a slot
+       costs O(log n) in the number of tweets already scheduled, plus the
+       slots skipped to reach it."""
+
+    def __init__(self, first_day, times, timezone, occupied=(), max_per_day=None, weekdays=None,
+                 min_spacing=timedelta(0)):
+        if weekdays is not None and len(weekdays) == 0:
+            raise ValueError('No weekdays to schedule on')
+        if max_per_day is not None and max_per_day < 1:
+            raise ValueError('Expected at least 1 tweet per day, found {}'.format(max_per_day))
+        self._first_day = datetime(first_day.year, first_day.month, first_day.day)
+        self._times = times
+        self._converter = UtcConverter(timezone)
+        self._occupied = occupied
+        self._allocated = []
+        self._max_per_day = max_per_day
+        self._weekdays = weekdays
+        self._spacing = max(1, int(min_spacing.total_seconds()))
+        self._skipped_slots = 0
+
+    ########################################################################
+    # Properties
+    @property
+    def skipped_slots(self):
+        """Number of slots skipped so far because they were taken or too
+           close to another tweet."""
+        return self._skipped_slots
+
+    ########################################################################
+    # Allocation
+    def slots(self):
+        """Generator of (datetime, formatted date string) for each free slot
+           in turn, like time_slots in schedule-lines.py. Each slot is
+           allocated as it is yielded."""
+        slot_suffixes = [time.strftime(' %H:%M') for time in self._times]
+        current_day = self._first_day
+        while True:
+            if self._weekdays is None or current_day.weekday() in self._weekdays:
+                day_prefix = current_day.strftime('%d/%m/%Y')
+                num_tweets = self.__count_occupied(current_day)
+                for time, suffix in zip(self._times, slot_suffixes):
+                    if self._max_per_day is not None and num_tweets >= self._max_per_day:
+                        break
+                    schedule = datetime(current_day.year, current_day.month, current_day.day,
+                                        hour=time.hour, minute=time.minute)
+                    epoch = self._converter.epoch(schedule)
+                    if self.__is_taken(self._occupied, epoch) or self.__is_taken(self._allocated, epoch):
+                        self._skipped_slots += 1
+                        continue
+                    insort(self._allocated, epoch)
+                    num_tweets += 1
+                    yield schedule, day_prefix + suffix
+            current_day += ONE_DAY
+
+    def __count_occupied(self, day):
+        """Returns the number of occupied times on the local day."""
+        if len(self._occupied) == 0:
+            return 0
+        start = bisect_left(self._occupied, self._converter.epoch(day))
+        end = bisect_left(self._occupied, self._converter.epoch(day + ONE_DAY), start)
+        return end - start
+
+    def __is_taken(self, epochs, epoch):
+        """Returns True if any of the sorted epochs is closer to epoch than
+           the minimum spacing."""
+        index = bisect_left(epochs, epoch - self._spacing + 1)
+        return index < len(epochs) and epochs[index] < epoch + self._spacing
@@ -1,17 +1,158 @@
-from datetime import datetime
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import calendar
+import hashlib
+import itertools
+import os
+import socket
 import sqlite3
-import pytz
+import time
 
-class TweetStore(object):
-    """Interface to schedule tweet storage. General use is:
+from schtweet.bloom import BloomFilter
+from schtweet.metrics import METRICS
+from schtweet.render import full_tweet, render_tweet
 
-            with TweetStore() as ts:
-                # use ts object
+# Version of the schema written to PRAGMA user_version. Each entry in
+# TweetStore._MIGRATIONS upgrades the database by one version.
+SCHEMA_VERSION = 7
+
+# Number of rows inserted per transaction by TweetStore.schedule_tweets
+DEFAULT_CHUNK_SIZE = 10000
+
+# Seconds a claimed tweet is reserved for the claiming store before other
+# stores may claim it again
+DEFAULT_LEASE = 15 * 60
+
+# Number of due tweets read at a time by TweetStore.due_tweets
+DEFAULT_PAGE_SIZE = 500
+
+# Number of acknowledgements written per transaction
+ACK_BATCH_SIZE = 10
+
+DueTweet = namedtuple('DueTweet', 'schedule_id, tweet, scheduled_date, scheduled_epoch')
+
+# Account tweets belong to when none is given
+DEFAULT_ACCOUNT = ''
+
+# Seconds to wait for another connection's write lock before giving up
+LOCK_TIMEOUT = 30
+
+# Number of free pages returned to the file system per transaction by
+# TweetStore.vacuum
+VACUUM_STEP_PAGES = 2000
+
+# Storage names starting with this are opened by open_store as a
+# MemoryTweetStore. The rest of the name, if any, is its snapshot file.
+MEMORY_PREFIX = 'memory:'
+
+# Columns of the tweets table kept for archived tweets
+ARCHIVE_COLUMNS = 'schedule_id, account, tweet_on_date, tweet_on_epoch, tweet_text, tweet_url, tweet_id, tweeted_date'
+
+# Archived tweets have their own key, as SQLite reuses the schedule_id of
+# the most recently scheduled tweets once they are archived and deleted
+CREATE_ARCHIVE_TABLE = '''CREATE TABLE IF NOT EXISTS {0}.archived_tweets (
+                            archive_id INTEGER PRIMARY KEY,
+                            schedule_id INTEGER NOT NULL,
+                            account TEXT NOT NULL,
+                            tweet_on_date TIMESTAMP NOT NULL,
+                            tweet_on_epoch INTEGER,
+                            tweet_text TEXT NOT NULL,
+                            tweet_url TEXT default NULL,
+                            tweet_id TEXT,
+                            tweeted_date TIMESTAMP)'''
+CREATE_ARCHIVE_INDEX = '''CREATE INDEX IF NOT EXISTS {0}.archived_tweets_schedule
+                            ON archived_tweets (schedule_id)'''
+
+# Number of new tweets the duplicate filter is sized for, on top of those
+# already scheduled
+DUPLICATE_FILTER_CAPACITY = 1000000
+
+# Maximum number of parameters bound to a single IN (...) query
+MAX_IN_PARAMETERS = 500
+
+INSERT_TWEET = '''INSERT INTO tweets (tweet_on_date, tweet_on_epoch, tweet_text, tweet_url, payload, weighted_length,
+                                       account)
+                     VALUES (?,?,?,?,?,?,?)'''
+INSERT_UNIQUE_TWEET = '''INSERT OR IGNORE INTO tweets (tweet_on_date, tweet_on_epoch, tweet_text, tweet_url, payload,
+                                                 weighted_length, account, content_hash)
+                            VALUES (?,?,?,?,?,?,?,?)'''
+
+
+def utc_epoch(date):
+    """Converts a naive UTC datetime to integer seconds since the epoch."""
+    return calendar.timegm(date.timetuple())
+
+
+def tweet_values(date, text, url=None):
+    """Normalises a tweet into the values bound to INSERT_TWEET, apart from
+       the account: (date, epoch, text, url, payload, weighted length)."""
+    date = utc_date(date)
+    return utc_tweet_values(date, utc_epoch(date), text, url)
+
+
+def utc_date(date):
+    """Converts an aware datetime to a naive UTC datetime."""
+    # Convert the date to UTC and remove the timezone. This
+    # allows us to use SQL functions to compare dates
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def utc_tweet_values(date, epoch, text, url=None):
+    """As tweet_values, for a date already converted to naive UTC and its
+       epoch seconds. The text posted is rendered once here, rather than
+       every time the tweet is read to be posted."""
+    url = tweet_url(url)
+    return (date, epoch, text, url) + render_tweet(text, url)
+
+
+def tweet_url(url):
+    """Normalises the URL of a tweet, returning None if there isn't one."""
+    if url is not None and len(url) > 0:
+        if not url.lower().startswith('http'):
+            url = "http://{}".format(url)
+    else:
+        url = None
+    return url
+
+
+def open_store(storage_name="scheduled-tweets.db", journal_mode=None, account=DEFAULT_ACCOUNT):
+    """Returns a store for storage_name, using the backend it names. Names
+       starting with MEMORY_PREFIX are kept in memory, optionally snapshotted
+       to the file named after the prefix. Anything else is a SQLite file,
+       opened with journal_mode if given."""
+    if storage_name.startswith(MEMORY_PREFIX):
+        from schtweet.memory import MemoryTweetStore
+        return MemoryTweetStore(storage_name[len(MEMORY_PREFIX):] or None, account=account)
+    return TweetStore(storage_name, journal_mode=journal_mode, account=account)
 
-        Using it this way ensure data is saved to the underlying storage."""
 
-    def __init__(self, storage_name="scheduled-tweets.db"):
+def content_hash(values):
+    """Returns a digest of the date, text and URL of a tweet normalised by
+       tweet_values, used to recognise the same tweet being scheduled twice."""
+    epoch, text, url = values[1:4]
+    return hashlib.sha1('{}\x1f{}\x1f{}'.format(epoch, text, url or '').encode('utf8')).digest()
+
+
+class BaseTweetStore(object):
+    """The operations every tweet storage backend provides. TweetStore, the
+       default, keeps tweets in SQLite. MemoryTweetStore keeps them in memory
+       for tests, benchmarks and bursty workloads. open_store picks between
+       them by storage name.
+
+       Backends implement scheduling (schedule_tweet and
+       schedule_tweet_values), the due queries (due_tweets, backlog_size,
+       upcoming_tweets and claim_due_tweets), marking tweets posted
+       (mark_tweeted, acknowledge, renew_claims and release_claims) and
+       commit, and are used as context managers. Everything else is built on
+       those here."""
+
+    def __init__(self, storage_name, account=DEFAULT_ACCOUNT):
         self._storage_name = storage_name
+        self._account = account
+        # Identifies the tweets claimed by this store
+        self._claimant = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), os.urandom(4).hex())
+        self._duplicates_skipped = 0
 
     ########################################################################
     # Properties
@@ -19,23 +160,122 @@ class TweetStore(object):
     def storage_name(self):
         return self._storage_name
 
+    @property
+    def account(self):
+        """The account whose tweets this store schedules and reads. Several
+           accounts can share one storage file."""
+        return self._account
+
+    @property
+    def claimant(self):
+        return self._claimant
+
+    @property
+    def duplicates_skipped(self):
+        """Number of tweets skipped as duplicates by this store so far."""
+        return self._duplicates_skipped
+
+    @property
+    def data_version(self):
+        """Changes whenever another store commits to the storage."""
+        raise NotImplementedError
+
     ########################################################################
     # Data writing
+    def mark_tweeted(self, schedule_id, tweet_id):
+        """Records that the scheduled tweet was posted with the given ID."""
+        raise NotImplementedError
+
+    def acknowledge(self, posted):
+        """Records many posted tweets claimed by this store at once. posted
+           is a list of (schedule_id, tweet_id) tuples. Tweets whose claim has
+           since passed to another store are left to it. Returns the number
+           recorded."""
+        raise NotImplementedError
+
+    def renew_claims(self, schedule_ids, lease=DEFAULT_LEASE):
+        """Extends this store's claims on the given tweets to lease seconds
+           from now, returning the schedule IDs of those still claimed by it."""
+        raise NotImplementedError
+
+    def release_claims(self, schedule_ids):
+        """Releases this store's claims on the given tweets so they can be
+           claimed again straight away."""
+        raise NotImplementedError
+
+    def commit(self):
+        """Commits any outstanding writes to the underlying storage."""
+        raise NotImplementedError
+
     def schedule_tweet(self, date, text, url=None):
-        # Convert the date to UTC and remove the timezone. This
-        # allows us to use SQL functions to compare dates
-        date = date.astimezone(pytz.utc).replace(tzinfo=None)
-
-        if url is not None and len(url) > 0:
-            if not url.lower().startswith('http'):
-                url = "http://{}".format(url)
-            self._cursor.execute('''INSERT INTO tweets (tweet_on_date, tweet_text, tweet_url) VALUES (?,?,?)''', (date, text, url))
-        else:
-            self._cursor.execute('''INSERT INTO tweets (tweet_on_date, tweet_text) VALUES (?,?)''', (date, text))
+        raise NotImplementedError
+
+    def schedule_tweets(self, rows, chunk_size=DEFAULT_CHUNK_SIZE, dedup=False, on_duplicate=None):
+        """Schedules many tweets at once. rows is an iterable of
+           (date, text, url) tuples, such as a generator of parsed CSV rows.
+
+           Rows are consumed lazily in chunks of chunk_size, each inserted at
+           once, so memory use is bounded no matter how many rows there are.
+           The whole of rows is scheduled in one transaction, so if reading
+           or inserting any of them raises, none are scheduled and the import
+           can simply be run again.
+
+           If dedup is True, tweets with the same date, text and URL as one
+           already scheduled with dedup for the account, or earlier in rows,
+           are skipped. The tweet_values of each is passed to on_duplicate, if
+           given, and they are counted in duplicates_skipped.
+
+           Returns the number of tweets scheduled."""
+        return self.schedule_tweet_values((tweet_values(date, text, url) for date, text, url in rows), chunk_size,
+                                          dedup, on_duplicate)
+
+    def schedule_tweet_values(self, values, chunk_size=DEFAULT_CHUNK_SIZE, dedup=False, on_duplicate=None):
+        """As schedule_tweets, but takes rows already normalised by
+           tweet_values. This lets the normalisation be done elsewhere, such
+           as in a pool of worker processes."""
+        raise NotImplementedError
+
+    @contextmanager
+    def bulk_load(self, journal_mode=None, synchronous=None):
+        """Context manager wrapped around a large import. Backends without
+           durability settings to relax do nothing."""
+        yield self
 
     ########################################################################
     # Data reading
-    def process_due_tweets(self, processor):
+    def due_tweets(self, page_size=DEFAULT_PAGE_SIZE):
+        """Generator of DueTweet tuples for all scheduled tweets which were
+           due when it started and have not already been successfully posted,
+           in schedule order. Tweets currently claimed by a store are not
+           included."""
+        raise NotImplementedError
+
+    def backlog_size(self):
+        """Returns the number of tweets which are due but not yet posted."""
+        raise NotImplementedError
+
+    def posted_since(self, since):
+        """Returns the number of tweets posted at or after the naive local
+           datetime since."""
+        raise NotImplementedError
+
+    def upcoming_tweets(self, limit):
+        """Returns a list of up to limit (scheduled_epoch, schedule_id) tuples
+           for the unposted tweets which are not yet due, soonest first."""
+        raise NotImplementedError
+
+    def scheduled_epochs(self, start_epoch):
+        """Returns a sorted list of the tweet_on_epoch of every unposted tweet
+           scheduled at or after start_epoch."""
+        raise NotImplementedError
+
+    def claim_due_tweets(self, limit, lease=DEFAULT_LEASE):
+        """Atomically claims up to limit due tweets for this store, returning
+           them as a list of DueTweet tuples in schedule order. See
+           TweetStore.claim_due_tweets."""
+        raise NotImplementedError
+
+    def process_due_tweets(self, processor, max_tweets=None, time_budget=None):
         """Allows the processing of all scheduled tweets which have not already
            been successfully processed. They are processed by the supplied
            processing function.
@@ -45,36 +285,474 @@ class TweetStore(object):
                 processor(tweet, scheduled_date)
 
            If the tweet is successfully processed it should return the string
-           ID of the posted tweet, otherwise return None."""
-        self._cursor.execute('''SELECT * FROM tweets 
-                                    WHERE tweeted_date IS NULL AND DATETIME(tweet_on_date) <= DATETIME('now')
-                                    ORDER BY tweet_on_date ASC''')
-        due_rows = self._cursor.fetchall()
-        for row in due_rows:
-            row_id = row['schedule_id']
-            row_tweet = row['tweet_text']
-            row_scheduled_date = row['tweet_on_date']
-            row_url = row['tweet_url']
-
-            full_tweet = row_tweet
-            if row_url is not None:
-                full_tweet = "{} {}".format(row_tweet, row_url)
-
-            tweet_id = processor(full_tweet, row_scheduled_date)
+           ID of the posted tweet, otherwise return None. Successfully
+           processed tweets are committed every ACK_BATCH_SIZE tweets.
+
+           Processing stops early once max_tweets tweets have been processed
+           or time_budget seconds have passed, if given. Returns the number
+           of tweets processed."""
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        num_processed = 0
+        num_marked = 0
+        for due_tweet in self.due_tweets():
+            if max_tweets is not None and num_processed >= max_tweets:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            tweet_id = processor(due_tweet.tweet, due_tweet.scheduled_date)
+            num_processed += 1
             if tweet_id is not None and len(tweet_id) > 0:
-                self._cursor.execute('''UPDATE tweets SET tweeted_date=?, tweet_id=? WHERE schedule_id=?''', (datetime.now(), tweet_id, row_id))
+                self.mark_tweeted(due_tweet.schedule_id, tweet_id)
+                num_marked += 1
+                if num_marked % ACK_BATCH_SIZE == 0:
+                    self.commit()
+        return num_processed
+
+
+class TweetStore(BaseTweetStore):
+    """Interface to schedule tweet storage. General use is:
+
+            with TweetStore() as ts:
+                # use ts object
+
+        Using it this way ensure data is saved to the underlying storage."""
+
+    def __init__(self, storage_name="scheduled-tweets.db", journal_mode=None, account=DEFAULT_ACCOUNT):
+        super().__init__(storage_name, account)
+        self._journal_mode = journal_mode
+        self._duplicate_filter = None
+
+    ########################################################################
+    # Properties
+    @property
+    def data_version(self):
+        """Changes whenever another connection commits to the storage."""
+        return self._connection.execute('''PRAGMA data_version''').fetchone()[0]
+
+    ########################################################################
+    # Data writing
+    def mark_tweeted(self, schedule_id, tweet_id):
+        """Records that the scheduled tweet was posted with the given ID."""
+        with METRICS.timer('db_update'):
+            self._cursor.execute('''UPDATE tweets SET tweeted_date=?, tweet_id=?, claimed_by=NULL, claim_expires=NULL
+                                    WHERE schedule_id=?''', (datetime.now(), tweet_id, schedule_id))
+
+    def acknowledge(self, posted):
+        """Records many posted tweets claimed by this store at once, in a
+           short transaction of its own. posted is a list of
+           (schedule_id, tweet_id) tuples. Tweets whose claim has since passed
+           to another store are left to it. Returns the number recorded."""
+        if len(posted) == 0:
+            return 0
+        now = datetime.now()
+        with self.__write_transaction(), METRICS.timer('db_update'):
+            self._cursor.executemany('''UPDATE tweets SET tweeted_date=?, tweet_id=?, claimed_by=NULL, claim_expires=NULL
+                                        WHERE schedule_id=? AND claimed_by=?''',
+                                     [(now, tweet_id, schedule_id, self.claimant) for schedule_id, tweet_id in posted])
+            return self._cursor.rowcount
+
+    def renew_claims(self, schedule_ids, lease=DEFAULT_LEASE):
+        """Extends this store's claims on the given tweets to lease seconds
+           from now, returning the schedule IDs of those still claimed by it.
+           A claim which expired without another store claiming the tweet is
+           renewed too."""
+        if len(schedule_ids) == 0:
+            return []
+        now = int(time.time())
+        renewed = []
+        with self.__write_transaction(), METRICS.timer('db_update'):
+            for schedule_id in schedule_ids:
+                self._cursor.execute('''UPDATE tweets SET claim_expires=?
+                                            WHERE schedule_id=? AND claimed_by=? AND tweeted_date IS NULL''',
+                                     (now + lease, schedule_id, self.claimant))
+                if self._cursor.rowcount > 0:
+                    renewed.append(schedule_id)
+        return renewed
+
+    def release_claims(self, schedule_ids):
+        """Releases this store's claims on the given tweets so they can be
+           claimed again straight away."""
+        with self.__write_transaction(), METRICS.timer('db_update'):
+            self._cursor.executemany('''UPDATE tweets SET claimed_by=NULL, claim_expires=NULL
+                                        WHERE schedule_id=? AND claimed_by=?''',
+                                     [(schedule_id, self.claimant) for schedule_id in schedule_ids])
+
+    def commit(self):
+        """Commits any outstanding writes to the underlying storage."""
+        with METRICS.timer('db_commit'):
+            self._connection.commit()
+
+    def schedule_tweet(self, date, text, url=None):
+        values = tweet_values(date, text, url)
+        with METRICS.timer('db_insert'):
+            self._cursor.execute(INSERT_TWEET, values + (self._account,))
+
+    def schedule_tweet_values(self, values, chunk_size=DEFAULT_CHUNK_SIZE, dedup=False, on_duplicate=None):
+        """As schedule_tweets, but takes rows already normalised by
+           tweet_values. This lets the normalisation be done elsewhere, such
+           as in a pool of worker processes."""
+        if dedup:
+            return self.__schedule_unique_values(values, chunk_size, on_duplicate)
+        values = (value + (self._account,) for value in values)
+        num_scheduled = 0
+        with self.__write_transaction():
+            while True:
+                chunk = list(itertools.islice(values, chunk_size))
+                if len(chunk) == 0:
+                    break
+                with METRICS.timer('db_insert'):
+                    self._cursor.executemany(INSERT_TWEET, chunk)
+                num_scheduled += len(chunk)
+        return num_scheduled
+
+    def __schedule_unique_values(self, values, chunk_size, on_duplicate):
+        """Inserts each chunk of values with INSERT OR IGNORE, which the
+           tweets_content unique index turns into a no-op for duplicates.
+
+           Rows the duplicate filter has definitely not seen before go
+           straight to the insert. Any others are looked up with one query
+           per chunk, so skipped rows can be reported individually. Every
+           chunk is looked up and inserted in the one write transaction. If
+           the insert still ignores rows, scheduled by another process since
+           the filter was loaded, they are found by the IDs the insert gave
+           the rest, so every skipped row is reported."""
+        duplicate_filter = self.__load_duplicate_filter()
+        values = iter(values)
+        num_scheduled = 0
+        with self.__write_transaction():
+            while True:
+                chunk = list(itertools.islice(values, chunk_size))
+                if len(chunk) == 0:
+                    break
+                rows = []
+                possible_duplicates = set()
+                for value in chunk:
+                    digest = content_hash(value)
+                    if digest in duplicate_filter:
+                        possible_duplicates.add(digest)
+                    else:
+                        duplicate_filter.add(digest)
+                    rows.append(value + (self._account, digest))
+
+                duplicates = self.__scheduled_hashes(possible_duplicates)
+                unique_rows = []
+                for row in rows:
+                    if row[-1] in duplicates:
+                        if on_duplicate is not None:
+                            on_duplicate(row[:-2])
+                        continue
+                    unique_rows.append(row)
+                    if row[-1] in possible_duplicates:
+                        # Any later copy in this chunk is a duplicate of this one
+                        duplicates.add(row[-1])
+
+                last_id = self._cursor.execute('''SELECT MAX(schedule_id) FROM tweets''').fetchone()[0] or 0
+                with METRICS.timer('db_insert'):
+                    self._cursor.executemany(INSERT_UNIQUE_TWEET, unique_rows)
+                    inserted = self._cursor.rowcount if len(unique_rows) > 0 else 0
+                if inserted < len(unique_rows):
+                    self.__report_ignored(unique_rows, last_id, on_duplicate)
+                num_scheduled += inserted
+                self._duplicates_skipped += len(rows) - inserted
+        return num_scheduled
+
+    def __report_ignored(self, rows, last_id, on_duplicate):
+        """Passes each of rows which INSERT OR IGNORE skipped to on_duplicate.
+           The rows inserted were given schedule IDs after last_id."""
+        self._cursor.execute('''SELECT content_hash FROM tweets WHERE schedule_id > ?''', (last_id,))
+        inserted = set(row[0] for row in self._cursor.fetchall())
+        if on_duplicate is not None:
+            for row in rows:
+                if row[-1] not in inserted:
+                    on_duplicate(row[:-2])
+
+    def __load_duplicate_filter(self):
+        if self._duplicate_filter is None:
+            with METRICS.timer('db_query'):
+                self._cursor.execute('''SELECT (SELECT COUNT(*) FROM tweets
+                                                WHERE account = ? AND content_hash IS NOT NULL)
+                                            + (SELECT COUNT(*) FROM archived_hashes WHERE account = ?)''',
+                                     (self._account, self._account))
+                self._duplicate_filter = BloomFilter(self._cursor.fetchone()[0] + DUPLICATE_FILTER_CAPACITY)
+                for row in self._connection.execute('''SELECT content_hash FROM tweets
+                                                        WHERE account = ? AND content_hash IS NOT NULL
+                                                      UNION ALL
+                                                      SELECT content_hash FROM archived_hashes WHERE account = ?''',
+                                                    (self._account, self._account)):
+                    self._duplicate_filter.add(row[0])
+        return self._duplicate_filter
+
+    def __scheduled_hashes(self, digests):
+        """Returns the set of digests already scheduled for this account,
+           including those of archived tweets."""
+        digests = list(digests)
+        scheduled = set()
+        with METRICS.timer('db_query'):
+            for start in range(0, len(digests), MAX_IN_PARAMETERS):
+                batch = digests[start:start + MAX_IN_PARAMETERS]
+                for table in ('tweets', 'archived_hashes'):
+                    self._cursor.execute('''SELECT content_hash FROM {} WHERE account = ? AND content_hash IN ({})'''
+                                         .format(table, ','.join('?' * len(batch))), [self._account] + batch)
+                    scheduled.update(row[0] for row in self._cursor.fetchall())
+        return scheduled
+
+    @contextmanager
+    def bulk_load(self, journal_mode=None, synchronous=None):
+        """Context manager which sets the journal_mode and synchronous
+           PRAGMAs for the duration of a large import, restoring the previous
+           values afterwards. Passing None leaves a setting unchanged. For
+           example:
+
+                with ts.bulk_load(journal_mode='MEMORY', synchronous='OFF'):
+                    ts.schedule_tweets(rows)"""
+        pragmas = [(name, value) for name, value in
+                   (('journal_mode', journal_mode), ('synchronous', synchronous)) if value is not None]
+        # The journal mode can't be changed inside a transaction
+        self._connection.commit()
+        previous = []
+        for name, value in pragmas:
+            previous.append((name, self._connection.execute('PRAGMA {}'.format(name)).fetchone()[0]))
+            self._connection.execute('PRAGMA {} = {}'.format(name, value))
+        try:
+            yield self
+        finally:
+            self._connection.commit()
+            for name, value in reversed(previous):
+                self._connection.execute('PRAGMA {} = {}'.format(name, value))
+
+    ########################################################################
+    # Data reading
+    def due_tweets(self, page_size=DEFAULT_PAGE_SIZE):
+        """Generator of DueTweet tuples for all scheduled tweets which were
+           due when it started and have not already been successfully posted,
+           in schedule order. The tweet field holds the full text to post,
+           including any URL. Tweets currently claimed by a store are not
+           included.
+
+           Rows are read page_size at a time, each page starting after the
+           (tweet_on_epoch, schedule_id) of the last, so memory use doesn't
+           grow with the backlog and tweets may be marked as posted between
+           pages."""
+        now = int(time.time())
+        cursor = self._connection.cursor()
+        last_epoch = None
+        last_id = None
+        while True:
+            # Compare against the integer epoch column so each page is a
+            # range scan over the tweets_pending index
+            with METRICS.timer('db_query'):
+                if last_epoch is None:
+                    cursor.execute('''SELECT * FROM tweets
+                                        WHERE tweeted_date IS NULL AND account = ? AND tweet_on_epoch <= ?
+                                            AND (claim_expires IS NULL OR claim_expires <= ?)
+                                        ORDER BY tweet_on_epoch ASC, schedule_id ASC LIMIT ?''',
+                                   (self._account, now, now, page_size))
+                else:
+                    cursor.execute('''SELECT * FROM tweets
+                                        WHERE tweeted_date IS NULL AND account = ? AND tweet_on_epoch <= ?
+                                            AND tweet_on_epoch >= ? AND (tweet_on_epoch > ? OR schedule_id > ?)
+                                            AND (claim_expires IS NULL OR claim_expires <= ?)
+                                        ORDER BY tweet_on_epoch ASC, schedule_id ASC LIMIT ?''',
+                                   (self._account, now, last_epoch, last_epoch, last_id, now, page_size))
+                rows = cursor.fetchall()
+            for row in rows:
+                yield self.__due_tweet(row)
+            if len(rows) < page_size:
+                return
+            last_epoch = rows[-1]['tweet_on_epoch']
+            last_id = rows[-1]['schedule_id']
+
+    def backlog_size(self):
+        """Returns the number of tweets which are due but not yet posted."""
+        with METRICS.timer('db_query'):
+            self._cursor.execute('''SELECT COUNT(*) FROM tweets
+                                        WHERE tweeted_date IS NULL AND account = ? AND tweet_on_epoch <= ?''',
+                                 (self._account, int(time.time())))
+            return self._cursor.fetchone()[0]
+
+    def posted_since(self, since):
+        """Returns the number of tweets posted at or after the naive local
+           datetime since, found by a range scan of the tweets_posted index.
+           Archived tweets aren't counted."""
+        with METRICS.timer('db_query'):
+            self._cursor.execute('''SELECT COUNT(*) FROM tweets WHERE account = ? AND tweeted_date >= ?''',
+                                 (self._account, since))
+            return self._cursor.fetchone()[0]
+
+    def upcoming_tweets(self, limit):
+        """Returns a list of up to limit (scheduled_epoch, schedule_id) tuples
+           for the unposted tweets which are not yet due, soonest first."""
+        with METRICS.timer('db_query'):
+            self._cursor.execute('''SELECT tweet_on_epoch, schedule_id FROM tweets
+                                        WHERE tweeted_date IS NULL AND account = ? AND tweet_on_epoch > ?
+                                        ORDER BY tweet_on_epoch ASC LIMIT ?''', (self._account, int(time.time()), limit))
+            rows = self._cursor.fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def scheduled_epochs(self, start_epoch):
+        """Returns a sorted list of the tweet_on_epoch of every unposted tweet
+           scheduled at or after start_epoch, found by a range scan of the
+           tweets_pending index."""
+        with METRICS.timer('db_query'):
+            self._cursor.execute('''SELECT tweet_on_epoch FROM tweets
+                                        WHERE tweeted_date IS NULL AND account = ? AND tweet_on_epoch >= ?
+                                        ORDER BY tweet_on_epoch ASC''', (self._account, start_epoch))
+            return [row[0] for row in self._cursor]
+
+    def claim_due_tweets(self, limit, lease=DEFAULT_LEASE):
+        """Atomically claims up to limit due tweets for this store, returning
+           them as a list of DueTweet tuples in schedule order. Claimed tweets
+           are not returned to any other store until lease seconds have passed,
+           so several processes can drain the same storage without posting a
+           tweet twice. Claimed tweets should be passed to acknowledge once
+           posted, and any which aren't posted passed to release_claims.
+           Claims held for longer than lease should be passed to renew_claims
+           before they expire. If the claiming process dies, its claimed
+           tweets become available again once the lease expires."""
+        now = int(time.time())
+        with self.__write_transaction():
+            with METRICS.timer('db_query'):
+                self._cursor.execute('''SELECT * FROM tweets
+                                            WHERE tweeted_date IS NULL AND account = ? AND tweet_on_epoch <= ?
+                                                AND (claim_expires IS NULL OR claim_expires <= ?)
+                                            ORDER BY tweet_on_epoch ASC LIMIT ?''', (self._account, now, now, limit))
+                rows = self._cursor.fetchall()
+            claimed = [self.__due_tweet(row) for row in rows]
+            with METRICS.timer('db_update'):
+                self._cursor.executemany('''UPDATE tweets SET claimed_by=?, claim_expires=? WHERE schedule_id=?''',
+                                         [(self.claimant, now + lease, tweet.schedule_id) for tweet in claimed])
+        return claimed
+
+    ########################################################################
+    # Maintenance
+    def archive_posted(self, posted_before, archive_name=None, batch_size=DEFAULT_CHUNK_SIZE):
+        """Moves the tweets of every account which were posted before the
+           naive local datetime posted_before out of the tweets table and into
+           an archived_tweets table, returning the number moved. The archive
+           table is kept in the storage itself, or in the separate storage
+           file archive_name if given, created if it doesn't exist.
+
+           Rows are moved batch_size at a time, in schedule_id order, each
+           batch in its own transaction so tweets can still be posted while a
+           large history is archived. The content hashes of tweets scheduled
+           with dedup are kept in the storage's archived_hashes table, so
+           they are still skipped if scheduled again. The space they used is
+           kept by the storage file until vacuum is called."""
+        schema = 'main'
+        if archive_name is not None:
+            self._connection.commit()
+            self._cursor.execute('''ATTACH DATABASE ? AS archive''', (archive_name,))
+            schema = 'archive'
+        try:
+            self.__ensure_archive_table(schema)
+
+            num_archived = 0
+            last_id = 0
+            while True:
+                with self.__write_transaction(), METRICS.timer('db_archive'):
+                    # Unposted tweets have a NULL tweeted_date, so never match
+                    self._cursor.execute('''SELECT MAX(schedule_id), COUNT(*) FROM (
+                                                SELECT schedule_id FROM tweets
+                                                    WHERE schedule_id > ? AND tweeted_date < ?
+                                                    ORDER BY schedule_id ASC LIMIT ?)''',
+                                         (last_id, posted_before, batch_size))
+                    batch_last_id, count = self._cursor.fetchone()
+                    if count == 0:
+                        break
+                    batch = (last_id, batch_last_id, posted_before)
+                    # Skip tweets already archived, in case an earlier run
+                    # copied a batch to a separate archive file and then
+                    # failed to delete it. A reused schedule_id is a different
+                    # tweet, posted at a different time.
+                    self._cursor.execute('''INSERT INTO {0}.archived_tweets ({1})
+                                                SELECT {1} FROM tweets
+                                                    WHERE schedule_id > ? AND schedule_id <= ? AND tweeted_date < ?
+                                                        AND NOT EXISTS (
+                                                            SELECT 1 FROM {0}.archived_tweets AS archived
+                                                                WHERE archived.schedule_id = tweets.schedule_id
+                                                                    AND archived.tweeted_date IS tweets.tweeted_date
+                                                                    AND archived.tweet_id IS tweets.tweet_id)'''
+                                         .format(schema, ARCHIVE_COLUMNS), batch)
+                    self._cursor.execute('''INSERT OR IGNORE INTO archived_hashes (account, content_hash)
+                                                SELECT account, content_hash FROM tweets
+                                                    WHERE schedule_id > ? AND schedule_id <= ? AND tweeted_date < ?
+                                                        AND content_hash IS NOT NULL''', batch)
+                    self._cursor.execute('''DELETE FROM tweets
+                                                WHERE schedule_id > ? AND schedule_id <= ? AND tweeted_date < ?''',
+                                         batch)
+                num_archived += count
+                last_id = batch_last_id
+            return num_archived
+        finally:
+            if archive_name is not None:
+                self._connection.commit()
+                self._cursor.execute('''DETACH DATABASE archive''')
+
+    def __ensure_archive_table(self, schema):
+        """Creates the archived_tweets table in schema, upgrading one made
+           before archived tweets had their own key. Those were keyed on
+           schedule_id, so a reused ID replaced the older archived tweet."""
+        columns = [row[1] for row in self._connection.execute('''PRAGMA {}.table_info(archived_tweets)'''
+                                                               .format(schema))]
+        with self.__write_transaction():
+            if len(columns) > 0 and 'archive_id' not in columns:
+                self._cursor.execute('''ALTER TABLE {}.archived_tweets RENAME TO archived_tweets_keyed'''
+                                     .format(schema))
+                self._cursor.execute(CREATE_ARCHIVE_TABLE.format(schema))
+                self._cursor.execute('''INSERT INTO {0}.archived_tweets ({1})
+                                            SELECT {1} FROM {0}.archived_tweets_keyed ORDER BY schedule_id'''
+                                     .format(schema, ARCHIVE_COLUMNS))
+                self._cursor.execute('''DROP TABLE {}.archived_tweets_keyed'''.format(schema))
+            else:
+                self._cursor.execute(CREATE_ARCHIVE_TABLE.format(schema))
+            self._cursor.execute(CREATE_ARCHIVE_INDEX.format(schema))
+
+    def vacuum(self, step_pages=VACUUM_STEP_PAGES):
+        """Returns the storage's free pages to the file system, shrinking the
+           file. Returns the number of pages freed.
+
+           Storage created before incremental vacuuming was turned on is
+           converted with a one off full VACUUM, which rewrites the whole
+           file. After that free pages are released step_pages at a time,
+           each step in its own short transaction."""
+        self.commit()
+        page_count = self._connection.execute('''PRAGMA page_count''').fetchone()[0]
+        if self._connection.execute('''PRAGMA auto_vacuum''').fetchone()[0] != 2:
+            with METRICS.timer('db_vacuum'):
+                self._cursor.execute('''PRAGMA auto_vacuum = INCREMENTAL''')
+                self._cursor.execute('''VACUUM''')
+        else:
+            while True:
+                with self.__write_transaction(), METRICS.timer('db_vacuum'):
+                    if self._connection.execute('''PRAGMA freelist_count''').fetchone()[0] == 0:
+                        break
+                    # Each page freed is a step of the statement, so run it to completion
+                    self._cursor.execute('''PRAGMA incremental_vacuum({})'''.format(step_pages)).fetchall()
+
+        if self._connection.execute('''PRAGMA journal_mode''').fetchone()[0] == 'wal':
+            # The file only shrinks once the vacuumed pages are checkpointed
+            self._cursor.execute('''PRAGMA wal_checkpoint(TRUNCATE)''')
+        return page_count - self._connection.execute('''PRAGMA page_count''').fetchone()[0]
+
+    def __due_tweet(self, row):
+        # Tweets scheduled before payloads were stored are rendered here
+        payload = row['payload']
+        if payload is None:
+            payload = full_tweet(row['tweet_text'], row['tweet_url'])
+        return DueTweet(row['schedule_id'], payload, row['tweet_on_date'], row['tweet_on_epoch'])
 
     ########################################################################
     # General usage
     def __enter__(self):
         self.__create_connection()
         self.__ensure_table()
+        self.__migrate_schema()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         if self._connection is not None:
             try:
-                self._connection.commit()
+                self.commit()
             except Exception as e:
                 raise e
             finally:
@@ -84,9 +762,12 @@ class TweetStore(object):
     ########################################################################
     # Private database related methods
     def __create_connection(self):
-        self._connection = sqlite3.connect(self.storage_name)
+        with METRICS.timer('db_connect'):
+            self._connection = sqlite3.connect(self.storage_name, timeout=LOCK_TIMEOUT)
         self._connection.row_factory = sqlite3.Row
         self._cursor = self._connection.cursor()
+        if self._journal_mode is not None:
+            self._cursor.execute('''PRAGMA journal_mode = {}'''.format(self._journal_mode))
 
     def __destroy_connection(self):
         self._connection.close()
@@ -94,6 +775,9 @@ class TweetStore(object):
         self._connection = None
 
     def __ensure_table(self):
+        # Only takes effect when the storage is first created. Existing
+        # storage is converted the first time it is vacuumed.
+        self._cursor.execute('''PRAGMA auto_vacuum = INCREMENTAL''')
         self._cursor.execute('''CREATE TABLE IF NOT EXISTS tweets (
                                     schedule_id INTEGER PRIMARY KEY,
                                     tweet_on_date TIMESTAMP NOT NULL,
@@ -102,5 +786,70 @@ class TweetStore(object):
                                     tweet_text TEXT NOT NULL, 
                                     tweet_url TEXT default NULL)''')
 
+    # Each migration upgrades the schema from version N to N+1, where N is
+    # its index in this list.
+    _MIGRATIONS = [
+        # 0 -> 1: Store the schedule time as integer UTC seconds and index the
+        # pending rows on it, so polling for due tweets doesn't scan history.
+        ['''ALTER TABLE tweets ADD COLUMN tweet_on_epoch INTEGER default NULL''',
+         '''UPDATE tweets SET tweet_on_epoch = CAST(STRFTIME('%s', tweet_on_date) AS INTEGER)''',
+         '''CREATE INDEX IF NOT EXISTS tweets_pending ON tweets (tweet_on_epoch)
+                WHERE tweeted_date IS NULL'''],
+        # 1 -> 2: Allow due tweets to be leased to a store while they are
+        # posted, so concurrent posting processes don't post them twice.
+        ['''ALTER TABLE tweets ADD COLUMN claimed_by TEXT default NULL''',
+         '''ALTER TABLE tweets ADD COLUMN claim_expires INTEGER default NULL'''],
+        # 2 -> 3: Allow many accounts to share a storage, indexing the pending
+        # rows by account so each account's queue is still a range scan.
+        ["ALTER TABLE tweets ADD COLUMN account TEXT NOT NULL default ''",
+         '''DROP INDEX IF EXISTS tweets_pending''',
+         '''CREATE INDEX tweets_pending ON tweets (account, tweet_on_epoch)
+                WHERE tweeted_date IS NULL'''],
+        # 3 -> 4: Identify tweets imported with dedup by a hash of their
+        # content, so importing the same tweet again can be ignored.
+        ['''ALTER TABLE tweets ADD COLUMN content_hash BLOB default NULL''',
+         '''CREATE UNIQUE INDEX tweets_content ON tweets (account, content_hash)
+                WHERE content_hash IS NOT NULL'''],
+        # 4 -> 5: Store the text to post, rendered and checked when the tweet
+        # is scheduled. Rows from before are rendered when they are posted.
+        ['''ALTER TABLE tweets ADD COLUMN payload TEXT default NULL''',
+         '''ALTER TABLE tweets ADD COLUMN weighted_length INTEGER default NULL'''],
+        # 5 -> 6: Index when each account's tweets were posted, so a run can
+        # count its recent posts against the rate limit.
+        ['''CREATE INDEX IF NOT EXISTS tweets_posted ON tweets (account, tweeted_date)
+                WHERE tweeted_date IS NOT NULL'''],
+        # 6 -> 7: Keep the content hashes of archived tweets, which may be
+        # moved to another file, so they are still found by dedup.
+        ['''CREATE TABLE IF NOT EXISTS archived_hashes (
+                account TEXT NOT NULL,
+                content_hash BLOB NOT NULL,
+                PRIMARY KEY (account, content_hash)) WITHOUT ROWID'''],
+    ]
+
+    def __migrate_schema(self):
+        version = self._connection.execute('''PRAGMA user_version''').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        with self.__write_transaction():
+            # Another process may have migrated the schema before we got the lock
+            version = self._connection.execute('''PRAGMA user_version''').fetchone()[0]
+            for statements in self._MIGRATIONS[version:SCHEMA_VERSION]:
+                for statement in statements:
+                    self._cursor.execute(statement)
+            self._cursor.execute('''PRAGMA user_version = {}'''.format(SCHEMA_VERSION))
+
+    @contextmanager
+    def __write_transaction(self):
+        """Runs the body in a transaction which takes the database write lock
+           up front, committing it on success."""
+        self._connection.commit()
+        self._cursor.execute('''BEGIN IMMEDIATE''')
+        try:
+            yield
+        except BaseException:
+            self._connection.rollback()
+            raise
+        self.commit()
+
     def __str__(self):
         return "<TweetStore: storage_name='{}'>".format(self.storage_name)
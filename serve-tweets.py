@@ -0,0 +1,142 @@
+#
+# Script to serve a local HTTP API for
+# scheduling tweets, and reading the
+# status of the schedule, without
+# starting a script for each tweet.
+#
+# Schedule tweets by posting JSON:
+#
+#   {"tweets": [{"date": "01/01/2030 09:00", "text": "Hello", "url": "example.com"}]}
+#
+# to /tweets, and read the status from /status.
+#
+# Version: 1.0
+#
+import argparse
+import signal
+
+from schtweet.metrics import METRICS
+from schtweet.profiling import add_profile_argument, profiled
+from schtweet.storage import open_store, DEFAULT_ACCOUNT
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8086
+
+# Minimum milliseconds between group commits
+DEFAULT_COMMIT_INTERVAL_MS = 2
+
+VERBOSE = False
+
+
+def verbose_log(message, *args):
+    if VERBOSE:
+        print(message.format(*args) if len(args) > 0 else message)
+
+
+def serve(storage_file, host, port, timezone, commit_interval, account=DEFAULT_ACCOUNT, dedup=False):
+    """Serves until interrupted or terminated, then commits any tweets still
+       waiting to be."""
+    # Imported here as asyncio and pytz are slow to import, and not needed
+    # for --help
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from contextlib import ExitStack
+    from schtweet.service import IngestService
+    import pytz
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stopped = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+
+    # The store is opened, used and closed on the writer's thread, as an
+    # SQLite connection can only be used on the thread which opened it. WAL
+    # lets the posting script read the storage while we write to it.
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        stack = ExitStack()
+        ts = writer.submit(stack.enter_context, open_store(storage_file, journal_mode='WAL', account=account)).result()
+        try:
+            service = IngestService(ts, pytz.timezone(timezone), commit_interval, dedup, loop, writer)
+
+            async def run():
+                bound_host, bound_port = await service.start(host, port)
+                # Flushed so anything waiting for the service to start sees it
+                # straight away when stdout is a pipe
+                print('Serving scheduled tweets from "{}" on http://{}:{}'.format(storage_file, bound_host,
+                                                                                 bound_port), flush=True)
+                await stopped.wait()
+                await service.stop()
+
+            try:
+                loop.run_until_complete(run())
+            finally:
+                loop.close()
+        finally:
+            writer.submit(stack.close).result()
+    print('Stopped serving scheduled tweets from "{}"'.format(storage_file))
+
+
+def create_parser():
+    """Returns the parser for the command line of this script."""
+    cli_main_parser = argparse.ArgumentParser()
+    cli_main_parser.add_argument('-v', '--verbose',
+                                 help='Say all the things',
+                                 action='store_true')
+    cli_main_parser.add_argument('--host',
+                                 help='The address to listen on. Defaults to only accepting local connections.',
+                                 default=DEFAULT_HOST)
+    cli_main_parser.add_argument('-p', '--port',
+                                 help='The port to listen on, or 0 for any free port.',
+                                 type=int,
+                                 default=DEFAULT_PORT)
+    cli_main_parser.add_argument('-t', '--timezone',
+                                 help='The timezone to apply to dates without timezone information',
+                                 default='Europe/London')
+    cli_main_parser.add_argument('-a', '--account',
+                                 help='The account to schedule tweets for, when one storage file holds the tweets of '
+                                      'many accounts. Defaults to the unnamed account.',
+                                 default=DEFAULT_ACCOUNT)
+    cli_main_parser.add_argument('-d', '--dedup',
+                                 help='Skip tweets with the same date, text and URL as a tweet already scheduled with '
+                                      '--dedup for the account, in the same way as import-tweets.py --dedup.',
+                                 action='store_true')
+    cli_main_parser.add_argument('-c', '--commit-interval',
+                                 help='Minimum milliseconds between commits. Tweets from requests arriving in between '
+                                      'are committed together. Each request is answered once its tweets are committed.',
+                                 type=float,
+                                 default=DEFAULT_COMMIT_INTERVAL_MS)
+    cli_main_parser.add_argument('-m', '--metrics',
+                                 help='Write counters and timings for the run to this file when stopped. Written in '
+                                      'the Prometheus text format if the name ends with .prom, otherwise as JSON.')
+    add_profile_argument(cli_main_parser)
+    cli_main_parser.add_argument('storage_file',
+                                 help='The name of the file to store the scheduled tweets in. Will be created if it '
+                                      'does not exist.')
+    return cli_main_parser
+
+
+def main(argv=None):
+    """Parses the command line, from sys.argv unless argv is given, and
+       performs the user's bidding."""
+    global VERBOSE
+    args = create_parser().parse_args(argv)
+    if args.verbose:
+        VERBOSE = True
+    if args.metrics is not None:
+        METRICS.enable()
+    if args.commit_interval < 0:
+        raise SystemExit('--commit-interval cannot be negative.')
+
+    verbose_log('Writing to storage: {}', args.storage_file)
+    try:
+        with profiled(args.profile, args.storage_file, 'serve-tweets'):
+            serve(args.storage_file, args.host, args.port, args.timezone, args.commit_interval / 1000,
+                  args.account, args.dedup)
+    finally:
+        if args.metrics is not None:
+            METRICS.write(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
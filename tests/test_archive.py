@@ -0,0 +1,54 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from schtweet.storage import TweetStore, tweet_values
+
+
+class ArchiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._storage_name = os.path.join(self._directory, 'tweets.db')
+        self._date = datetime.now(timezone.utc) - timedelta(days=1)
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def schedule_and_post(self, store, text, dedup=False):
+        store.schedule_tweet_values([self.values(text)], dedup=dedup)
+        for tweet in store.claim_due_tweets(10):
+            store.acknowledge([(tweet.schedule_id, tweet.tweet)])
+
+    def values(self, text):
+        return tweet_values(self._date, text)
+
+    def archived_texts(self, storage_name):
+        connection = sqlite3.connect(storage_name)
+        try:
+            return [row[0] for row in connection.execute('''SELECT tweet_text FROM archived_tweets
+                                                                ORDER BY archive_id''')]
+        finally:
+            connection.close()
+
+    def test_reused_schedule_ids_keep_their_archived_tweets(self):
+        for archive_name in (None, os.path.join(self._directory, 'archive.db')):
+            with TweetStore(self._storage_name) as ts:
+                self.schedule_and_post(ts, 'First')
+                self.assertEqual(ts.archive_posted(datetime.now() + timedelta(seconds=1), archive_name), 1)
+                # The archived tweet's schedule_id is free to be used again
+                self.schedule_and_post(ts, 'Second')
+                self.assertEqual(ts.archive_posted(datetime.now() + timedelta(seconds=1), archive_name), 1)
+            self.assertEqual(self.archived_texts(archive_name or self._storage_name), ['First', 'Second'])
+            os.remove(self._storage_name)
+
+    def test_archived_tweets_are_still_duplicates(self):
+        with TweetStore(self._storage_name) as ts:
+            self.schedule_and_post(ts, 'Once only', dedup=True)
+            ts.archive_posted(datetime.now() + timedelta(seconds=1), os.path.join(self._directory, 'archive.db'))
+        with TweetStore(self._storage_name) as ts:
+            self.assertEqual(ts.schedule_tweet_values([self.values('Once only'), self.values('New')], dedup=True), 1)
+            self.assertEqual(ts.duplicates_skipped, 1)
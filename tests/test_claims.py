@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from schtweet.memory import MemoryTable, MemoryTweetStore
+from schtweet.storage import TweetStore
+
+
+def schedule_due(store, count):
+    due = datetime.now(timezone.utc) - timedelta(minutes=10)
+    for number in range(count):
+        store.schedule_tweet(due + timedelta(minutes=number), 'Tweet {}'.format(number))
+    store.commit()
+
+
+class ClaimTests(object):
+    """Tests of the claim protocol run against each backend. Subclasses
+       open two stores on the same storage with open_store."""
+
+    def test_claimed_tweets_are_not_claimed_again(self):
+        with self.open_store() as ours, self.open_store() as theirs:
+            schedule_due(ours, 5)
+            claimed = ours.claim_due_tweets(3)
+            self.assertEqual([tweet.tweet for tweet in claimed], ['Tweet 0', 'Tweet 1', 'Tweet 2'])
+            self.assertEqual([tweet.tweet for tweet in theirs.claim_due_tweets(10)], ['Tweet 3', 'Tweet 4'])
+            self.assertEqual(ours.claim_due_tweets(10), [])
+
+    def test_expired_claims_can_be_taken(self):
+        with self.open_store() as ours, self.open_store() as theirs:
+            schedule_due(ours, 2)
+            claimed = ours.claim_due_tweets(2, lease=0)
+            self.assertEqual(theirs.claim_due_tweets(10), claimed)
+
+    def test_acknowledge_only_records_own_claims(self):
+        with self.open_store() as ours, self.open_store() as theirs:
+            schedule_due(ours, 2)
+            first, second = ours.claim_due_tweets(2, lease=0)
+            theirs.claim_due_tweets(1)
+            self.assertEqual(ours.acknowledge([(first.schedule_id, '1'), (second.schedule_id, '2')]), 1)
+            self.assertEqual(ours.backlog_size(), 1)
+            self.assertEqual(theirs.claim_due_tweets(10), [])
+
+    def test_release_claims_only_releases_own_claims(self):
+        with self.open_store() as ours, self.open_store() as theirs:
+            schedule_due(ours, 2)
+            first, second = ours.claim_due_tweets(1) + theirs.claim_due_tweets(1)
+            theirs.release_claims([first.schedule_id, second.schedule_id])
+            self.assertEqual(theirs.claim_due_tweets(10), [second])
+            ours.release_claims([first.schedule_id])
+            self.assertEqual(theirs.claim_due_tweets(10), [first])
+
+    def test_renew_claims_returns_claims_still_held(self):
+        with self.open_store() as ours, self.open_store() as theirs:
+            schedule_due(ours, 3)
+            first, second, third = ours.claim_due_tweets(3, lease=0)
+            theirs.claim_due_tweets(1)
+            ours.acknowledge([(third.schedule_id, '3')])
+            self.assertEqual(ours.renew_claims([first.schedule_id, second.schedule_id, third.schedule_id]),
+                             [second.schedule_id])
+            self.assertEqual(theirs.claim_due_tweets(10), [])
+
+    def test_posted_since_counts_recent_posts(self):
+        with self.open_store() as ours:
+            schedule_due(ours, 3)
+            before = datetime.now() - timedelta(seconds=1)
+            ours.mark_tweeted(1, '1')
+            ours.mark_tweeted(2, '2')
+            ours.commit()
+            self.assertEqual(ours.posted_since(before), 2)
+            self.assertEqual(ours.posted_since(datetime.now() + timedelta(seconds=1)), 0)
+
+
+class TweetStoreClaimTests(ClaimTests, unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def open_store(self):
+        return TweetStore(os.path.join(self._directory, 'tweets.db'))
+
+
+class MemoryTweetStoreClaimTests(ClaimTests, unittest.TestCase):
+
+    def setUp(self):
+        self._table = MemoryTable()
+
+    def open_store(self):
+        return MemoryTweetStore(table=self._table)
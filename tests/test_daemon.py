@@ -0,0 +1,160 @@
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.stubs import StubApi
+from schtweet.daemon import LatenessTracker, SchedulerDaemon
+from schtweet.memory import MemoryTable, MemoryTweetStore
+from schtweet.posting import PostingEngine, PostingStopped, TokenBucket
+from schtweet.storage import DueTweet
+from tests.test_posting import FlakyApi, TransientError, post_update
+
+
+class FakeStopEvent(object):
+    """Stop event for SchedulerDaemon whose waits move a fake clock on by
+       their whole timeout, running any actions which fall due on the way.
+       Sets itself once the clock reaches stop_at."""
+
+    def __init__(self, stop_at):
+        self.now = time.time()
+        self.start = self.now
+        self.stop_at = self.start + stop_at
+        self._actions = []
+        self._set = False
+
+    def clock(self):
+        return self.now
+
+    def after(self, seconds, action):
+        self._actions.append((self.start + seconds, action))
+        self._actions.sort(key=lambda item: item[0])
+
+    def is_set(self):
+        return self._set
+
+    def set(self):
+        self._set = True
+
+    def wait(self, timeout=None):
+        self.now += timeout
+        while len(self._actions) > 0 and self._actions[0][0] <= self.now:
+            self._actions.pop(0)[1]()
+        if self.now >= self.stop_at:
+            self._set = True
+        return self._set
+
+
+def due(minutes_ago):
+    return datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)
+
+
+class SchedulerDaemonTests(unittest.TestCase):
+
+    def run_daemon(self, store, api, stop_event, **kwargs):
+        posted_at = []
+        failures = []
+        engine = PostingEngine(post_update(api), workers=1, max_retries=0,
+                               is_transient=lambda error: isinstance(error, TransientError),
+                               on_failure=lambda text, error: failures.append(text),
+                               on_posted=lambda tweet, tweet_id: posted_at.append(stop_event.clock()))
+        daemon = SchedulerDaemon(store, engine, clock=stop_event.clock, log=lambda message: None,
+                                 stop_event=stop_event, **kwargs)
+        daemon.run()
+        return daemon, posted_at, failures
+
+    def test_tweet_imported_by_another_store_is_posted_within_check_interval(self):
+        table = MemoryTable()
+        store = MemoryTweetStore(table=table)
+        importer = MemoryTweetStore(table=table)
+        stop_event = FakeStopEvent(stop_at=30)
+        stop_event.after(10, lambda: importer.schedule_tweet(due(1), 'Imported'))
+        api = StubApi()
+
+        daemon, posted_at, failures = self.run_daemon(store, api, stop_event, check_interval=2.0)
+
+        self.assertEqual(api.posted, ['Imported'])
+        self.assertEqual(len(posted_at), 1)
+        self.assertTrue(stop_event.start + 10 <= posted_at[0] <= stop_event.start + 12)
+        self.assertEqual((daemon.processed_tweets, daemon.sent_tweets), (1, 1))
+        self.assertEqual(store.backlog_size(), 0)
+
+    def test_failed_tweet_is_retried_after_retry_interval(self):
+        store = MemoryTweetStore(table=MemoryTable())
+        store.schedule_tweet(due(1), 'Flaky')
+        stop_event = FakeStopEvent(stop_at=120)
+        api = FlakyApi({'Flaky': 1})
+
+        daemon, posted_at, failures = self.run_daemon(store, api, stop_event, check_interval=5.0,
+                                                      retry_interval=60)
+
+        self.assertEqual(failures, ['Flaky'])
+        self.assertEqual(api.posted, ['Flaky'])
+        self.assertEqual(len(posted_at), 1)
+        self.assertTrue(stop_event.start + 60 <= posted_at[0] <= stop_event.start + 65)
+        self.assertEqual((daemon.processed_tweets, daemon.sent_tweets), (2, 1))
+        self.assertEqual(store.backlog_size(), 0)
+
+    def test_stop_interrupts_a_wait_for_a_rate_limit_token(self):
+        store = MemoryTweetStore(table=MemoryTable())
+        for number in range(3):
+            store.schedule_tweet(due(3 - number), 'Tweet {}'.format(number))
+        stopped = threading.Event()
+        api = StubApi()
+        engine = PostingEngine(post_update(api), workers=1, stop_event=stopped,
+                               rate_limiter=TokenBucket(1, 3600, stop_event=stopped))
+        daemon = SchedulerDaemon(store, engine, log=lambda message: None, stop_event=stopped)
+        threading.Timer(0.2, daemon.stop).start()
+
+        started = time.monotonic()
+        daemon.run()
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(api.posted, ['Tweet 0'])
+        self.assertEqual((daemon.processed_tweets, daemon.sent_tweets), (1, 1))
+        # The tweets left waiting are released rather than kept claimed
+        self.assertEqual(len(store.claim_due_tweets(10)), 2)
+
+
+class TokenBucketStopTests(unittest.TestCase):
+
+    def test_acquire_raises_once_stopped(self):
+        stopped = threading.Event()
+        bucket = TokenBucket(1, 3600, stop_event=stopped)
+        bucket.acquire()
+        threading.Timer(0.1, stopped.set).start()
+        started = time.monotonic()
+        with self.assertRaises(PostingStopped):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - started, 5)
+
+
+class LatenessTrackerTests(unittest.TestCase):
+
+    def test_percentiles_use_the_nearest_rank(self):
+        lateness = LatenessTracker()
+        for seconds in range(1, 11):
+            lateness.record(seconds)
+        self.assertEqual(lateness.percentiles(), {50: 5, 90: 9, 99: 10, 100: 10})
+        self.assertEqual(lateness.count, 10)
+
+    def test_only_the_latest_samples_are_kept(self):
+        lateness = LatenessTracker(max_samples=2)
+        for seconds in (100, 1, 2):
+            lateness.record(seconds)
+        self.assertEqual(lateness.percentiles((100,)), {100: 2})
+        self.assertEqual(lateness.count, 3)
+
+    def test_nothing_recorded(self):
+        lateness = LatenessTracker()
+        self.assertEqual(lateness.percentiles(), {})
+        self.assertEqual(str(lateness), 'No tweets posted')
+
+    def test_record_posted_measures_from_the_schedule(self):
+        now = [1000.0]
+        lateness = LatenessTracker(clock=lambda: now[0])
+        tweet = DueTweet(1, 'Tweet', None, 990)
+        lateness.record_posted(tweet, '1')
+        now[0] = 980.0
+        lateness.record_posted(tweet, '2')
+        self.assertEqual(lateness.percentiles((50, 100)), {50: 0, 100: 10})
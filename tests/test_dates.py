@@ -0,0 +1,64 @@
+import calendar
+import unittest
+from datetime import datetime, timedelta
+
+import pytz
+
+from schtweet.dates import DETECTION_ROWS, DateParser, UtcConverter
+
+# The local days either side of, and including, the clock changes of 2030
+TRANSITION_DAYS = {
+    'Europe/London': (datetime(2030, 3, 31), datetime(2030, 10, 27)),
+    'America/New_York': (datetime(2030, 3, 10), datetime(2030, 11, 3)),
+}
+
+
+class DateParserTests(unittest.TestCase):
+
+    def test_iso_dates_are_read_the_same_after_detection(self):
+        parser = DateParser()
+        self.assertEqual(parser.parse_local('2030-01-02 09:00'), datetime(2030, 1, 2, 9, 0))
+        for day in range(1, DETECTION_ROWS + 1):
+            parser.parse_local('{:02}/02/2030 09:00'.format(day))
+        self.assertEqual(parser.detected_format, '%d/%m/%Y %H:%M')
+        self.assertEqual(parser.parse_local('2030-01-03 09:00'), datetime(2030, 1, 3, 9, 0))
+        self.assertEqual(parser.parse_local('03/01/2030'), datetime(2030, 1, 3))
+
+    def test_other_dates_fall_back_to_dateutil(self):
+        parser = DateParser()
+        self.assertEqual(parser.parse_local('3 Jan 2030 9am'), datetime(2030, 1, 3, 9, 0))
+
+
+class UtcConverterTests(unittest.TestCase):
+
+    def assert_matches_localize(self, timezone_name, is_dst):
+        timezone = pytz.timezone(timezone_name)
+        converter = UtcConverter(timezone, is_dst=is_dst)
+        for transition_day in TRANSITION_DAYS[timezone_name]:
+            # Every quarter hour from the day before the change to the day after
+            date = transition_day - timedelta(days=1)
+            while date < transition_day + timedelta(days=2):
+                aware = timezone.localize(date, is_dst=is_dst)
+                expected = aware.astimezone(pytz.utc).replace(tzinfo=None)
+                self.assertEqual(converter.utc(date), (expected, calendar.timegm(aware.utctimetuple())),
+                                 '{} in {} with is_dst={}'.format(date, timezone_name, is_dst))
+                date += timedelta(minutes=15)
+
+    def test_london_matches_localize_as_standard_time(self):
+        self.assert_matches_localize('Europe/London', False)
+
+    def test_london_matches_localize_as_dst(self):
+        self.assert_matches_localize('Europe/London', True)
+
+    def test_new_york_matches_localize_as_standard_time(self):
+        self.assert_matches_localize('America/New_York', False)
+
+    def test_new_york_matches_localize_as_dst(self):
+        self.assert_matches_localize('America/New_York', True)
+
+    def test_only_days_touched_by_a_change_are_localised(self):
+        converter = UtcConverter(pytz.timezone('Europe/London'))
+        self.assertIsNotNone(converter._find_day_offset(datetime(2030, 3, 30).date()))
+        self.assertIsNone(converter._find_day_offset(datetime(2030, 3, 31).date()))
+        self.assertIsNotNone(converter._find_day_offset(datetime(2030, 4, 1).date()))
+        self.assertIsNone(converter._find_day_offset(datetime(2030, 10, 27).date()))
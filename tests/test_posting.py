@@ -0,0 +1,195 @@
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.stubs import StubApi
+from schtweet.memory import MemoryTable, MemoryTweetStore
+from schtweet.posting import PostingEngine, TokenBucket
+
+
+class TransientError(Exception):
+    pass
+
+
+class FlakyApi(StubApi):
+    """StubApi whose posts of each text fail with TransientError the number
+       of times given in failures before succeeding."""
+
+    def __init__(self, failures, latency=0.0):
+        super().__init__(latency)
+        self.failures = dict(failures)
+
+    def PostUpdate(self, status):
+        with self._lock:
+            if self.failures.get(status, 0) > 0:
+                self.failures[status] -= 1
+                raise TransientError(status)
+        return super().PostUpdate(status)
+
+
+class FakeClock(object):
+    """Clock for TokenBucket whose sleep moves time on straight away."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RecordingStore(MemoryTweetStore):
+    """MemoryTweetStore keeping the schedule IDs of every acknowledgement, and
+       counting renewals, in the order they're made."""
+
+    def __init__(self, table, renew=True):
+        super().__init__(table=table)
+        self.acknowledged = []
+        self.renewals = 0
+        self._renew = renew
+
+    def acknowledge(self, posted):
+        self.acknowledged.extend(schedule_id for schedule_id, _ in posted)
+        return super().acknowledge(posted)
+
+    def renew_claims(self, schedule_ids, lease=None):
+        self.renewals += 1
+        if self._renew:
+            return super().renew_claims(schedule_ids, lease)
+        return []
+
+
+def scheduled_store(count, **kwargs):
+    store = RecordingStore(MemoryTable(), **kwargs)
+    due = datetime.now(timezone.utc) - timedelta(minutes=count + 1)
+    for number in range(count):
+        store.schedule_tweet(due + timedelta(minutes=number), 'Tweet {}'.format(number))
+    return store
+
+
+def post_update(api):
+    return lambda text: api.PostUpdate(text).id_str
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def test_acquire_waits_for_a_token_once_empty(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, 10, clock=clock, sleep=clock.sleep)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(clock.sleeps, [])
+        bucket.acquire()
+        self.assertEqual(clock.sleeps, [5])
+
+    def test_limit_to_takes_tokens_already_spent(self):
+        clock = FakeClock()
+        bucket = TokenBucket(3, 30, clock=clock, sleep=clock.sleep)
+        bucket.limit_to(1)
+        bucket.acquire()
+        self.assertEqual(clock.sleeps, [])
+        bucket.acquire()
+        self.assertEqual(clock.sleeps, [10])
+
+    def test_limit_to_never_adds_tokens(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1, 10, clock=clock, sleep=clock.sleep)
+        bucket.acquire()
+        bucket.limit_to(5)
+        bucket.acquire()
+        self.assertEqual(clock.sleeps, [10])
+
+
+class PostingEngineTests(unittest.TestCase):
+
+    def test_transient_errors_are_retried_with_backoff(self):
+        api = FlakyApi({'Tweet 1': 2})
+        sleeps = []
+        engine = PostingEngine(post_update(api), workers=1, backoff=1.0, sleep=sleeps.append,
+                               is_transient=lambda error: isinstance(error, TransientError))
+        store = scheduled_store(3)
+        self.assertEqual(engine.process(store), (3, 3))
+        self.assertEqual(api.posted, ['Tweet 0', 'Tweet 1', 'Tweet 2'])
+        self.assertEqual(len(sleeps), 2)
+        self.assertTrue(0.5 <= sleeps[0] <= 1.0)
+        self.assertTrue(1.0 <= sleeps[1] <= 2.0)
+        self.assertEqual(store.backlog_size(), 0)
+
+    def test_failures_are_reported_and_released_after_max_retries(self):
+        api = FlakyApi({'Tweet 0': 5})
+        failures = []
+        engine = PostingEngine(post_update(api), workers=1, max_retries=2, sleep=lambda seconds: None,
+                               is_transient=lambda error: isinstance(error, TransientError),
+                               on_failure=lambda text, error: failures.append(text))
+        store = scheduled_store(2)
+        self.assertEqual(engine.process(store), (2, 1))
+        self.assertEqual(failures, ['Tweet 0'])
+        self.assertEqual(api.failures, {'Tweet 0': 2})
+        self.assertEqual([tweet.tweet for tweet in store.claim_due_tweets(10)], ['Tweet 0'])
+
+    def test_other_errors_are_not_retried(self):
+        api = FlakyApi({'Tweet 0': 1})
+        engine = PostingEngine(post_update(api), workers=1, sleep=lambda seconds: None)
+        with self.assertRaises(TransientError):
+            engine.process(scheduled_store(1))
+
+    def test_posts_in_flight_are_acknowledged_when_an_error_stops_the_run(self):
+        api = StubApi()
+
+        def post_update_or_fail(text):
+            if text == 'Tweet 0':
+                time.sleep(0.05)
+                raise ValueError(text)
+            time.sleep(0.2)
+            return api.PostUpdate(text).id_str
+
+        engine = PostingEngine(post_update_or_fail, workers=2)
+        store = scheduled_store(4)
+        with self.assertRaises(ValueError):
+            engine.process(store)
+        # Tweets 1 and 2 were being posted, and tweet 3 was cancelled
+        self.assertEqual(sorted(api.posted), ['Tweet 1', 'Tweet 2'])
+        self.assertEqual(store.acknowledged, [2, 3])
+        self.assertEqual([tweet.tweet for tweet in store.claim_due_tweets(10)], ['Tweet 0', 'Tweet 3'])
+
+    def test_results_are_written_back_in_schedule_order(self):
+        api = StubApi()
+        # Later tweets finish first, as the earlier ones are slow to post
+        latencies = {'Tweet 0': 0.05, 'Tweet 1': 0.03}
+
+        def post_slowly(text):
+            time.sleep(latencies.get(text, 0.001))
+            return api.PostUpdate(text).id_str
+
+        engine = PostingEngine(post_slowly, workers=4)
+        store = scheduled_store(30)
+        self.assertEqual(engine.process(store, claim_size=30), (30, 30))
+        self.assertEqual(store.acknowledged, list(range(1, 31)))
+
+    def test_rate_limit_counts_earlier_posts(self):
+        store = scheduled_store(5)
+        store.mark_tweeted(1, '1')
+        store.mark_tweeted(2, '2')
+        clock = FakeClock()
+        engine = PostingEngine(post_update(StubApi()), workers=1,
+                               rate_limiter=TokenBucket(3, 30, clock=clock, sleep=clock.sleep))
+        self.assertEqual(engine.process(store), (3, 3))
+        self.assertEqual(clock.sleeps, [10, 10])
+
+    def test_claims_are_renewed_while_waiting(self):
+        store = scheduled_store(2)
+        engine = PostingEngine(post_update(StubApi(latency=0.1)), workers=1)
+        self.assertEqual(engine.process(store, lease=0.06), (2, 2))
+        self.assertGreater(store.renewals, 0)
+        self.assertEqual(store.backlog_size(), 0)
+
+    def test_tweets_whose_claims_are_lost_are_not_posted(self):
+        api = StubApi(latency=0.1)
+        store = scheduled_store(3, renew=False)
+        engine = PostingEngine(post_update(api), workers=1)
+        self.assertEqual(engine.process(store, lease=0.06, max_tweets=3), (3, 1))
+        self.assertEqual(api.posted, ['Tweet 0'])
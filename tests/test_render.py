@@ -0,0 +1,78 @@
+import csv
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+from schtweet.csvimport import read_values
+from schtweet.render import MAX_WEIGHTED_LENGTH, URL_LENGTH, RejectsReport, rejection_reason, render_tweet, \
+    validated_values, weighted_length
+from schtweet.storage import tweet_values
+
+
+def values(text, url=None):
+    return tweet_values(datetime(2030, 1, 1, 9, 0, tzinfo=timezone.utc), text, url)
+
+
+class WeightedLengthTests(unittest.TestCase):
+
+    def test_every_url_counts_as_url_length(self):
+        self.assertEqual(weighted_length('See https://example.com'), 4 + URL_LENGTH)
+        self.assertEqual(weighted_length('http://a.io and https://example.com/' + 'x' * 100),
+                         URL_LENGTH + 5 + URL_LENGTH)
+
+    def test_cjk_and_emoji_count_as_two(self):
+        self.assertEqual(weighted_length('こんにちは'), 10)
+        self.assertEqual(weighted_length('Hi \U0001F600'), 5)
+
+    def test_text_is_nfc_normalised_first(self):
+        self.assertEqual(weighted_length('cafe\u0301'), 4)
+
+    def test_separate_url_counts_with_its_space(self):
+        payload, length = render_tweet('Read this', 'http://example.com')
+        self.assertEqual(payload, 'Read this http://example.com')
+        self.assertEqual(length, 9 + 1 + URL_LENGTH)
+
+
+class RejectionTests(unittest.TestCase):
+
+    def test_exactly_the_maximum_length_is_accepted(self):
+        self.assertIsNone(rejection_reason(values('x' * MAX_WEIGHTED_LENGTH)))
+        self.assertIsNone(rejection_reason(values('一' * (MAX_WEIGHTED_LENGTH // 2))))
+        url = 'https://example.com'
+        self.assertIsNone(rejection_reason(values('x' * (MAX_WEIGHTED_LENGTH - 1 - URL_LENGTH), url)))
+
+    def test_one_more_than_the_maximum_is_rejected(self):
+        self.assertIn('281 characters', rejection_reason(values('x' * (MAX_WEIGHTED_LENGTH + 1))))
+        self.assertIsNotNone(rejection_reason(values('x' * (MAX_WEIGHTED_LENGTH - 1) + '一')))
+        url = 'https://example.com'
+        self.assertIsNotNone(rejection_reason(values('x' * (MAX_WEIGHTED_LENGTH - URL_LENGTH), url)))
+
+    def test_empty_text_is_rejected(self):
+        self.assertEqual(rejection_reason(values('')), 'The tweet text is empty')
+        self.assertEqual(rejection_reason(values('  \t', 'example.com')), 'The tweet text is empty')
+
+    def test_invalid_url_is_rejected(self):
+        self.assertIn('is not valid', rejection_reason(values('Text', 'http://')))
+        self.assertIn('is not valid', rejection_reason(values('Text', 'example .com')))
+
+
+class RejectsReportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_rejects_file_can_be_imported_again(self):
+        rejects_file = os.path.join(self.directory, 'rejects.csv')
+        rows = [values('Fine'), values(''), values('x' * 300, 'example.com'), values('Also fine')]
+        with RejectsReport(rejects_file) as rejects:
+            accepted = [value[2] for value in validated_values(rows, rejects)]
+        self.assertEqual(accepted, ['Fine', 'Also fine'])
+        self.assertEqual(rejects.count, 2)
+
+        with io.open(rejects_file, encoding='utf8', newline='') as csv_file:
+            reimported = list(read_values(csv.reader(csv_file), 'Europe/London'))
+        self.assertEqual([value[:4] for value in reimported], [value[:4] for value in (rows[1], rows[2])])
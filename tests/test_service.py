@@ -0,0 +1,59 @@
+import asyncio
+import json
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import pytz
+
+from schtweet.memory import MemoryTable, MemoryTweetStore
+from schtweet.service import IngestService
+
+
+class SilentlySkippingStore(MemoryTweetStore):
+    """MemoryTweetStore which only schedules the first of the tweets it's
+       given, without reporting the rest as duplicates."""
+
+    def schedule_tweet_values(self, values, chunk_size=None, dedup=False, on_duplicate=None):
+        return super().schedule_tweet_values(list(values)[:1])
+
+
+class IngestServiceTests(unittest.TestCase):
+
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._service = self.create_service(MemoryTweetStore(table=MemoryTable()))
+
+    def create_service(self, store):
+        return IngestService(store, pytz.timezone('Europe/London'), dedup=True, loop=self._loop, writer=self._writer)
+
+    def tearDown(self):
+        self._loop.close()
+        self._writer.shutdown()
+
+    def respond(self, *requests):
+        async def gather():
+            return await asyncio.gather(*[self._service.respond(method, path, json.dumps(body).encode('utf8'))
+                                          for method, path, body in requests])
+        return self._loop.run_until_complete(gather())
+
+    def test_concurrent_requests_are_committed_together(self):
+        tweet = {'date': '01/01/2030 09:00', 'text': 'Hello'}
+        responses = self.respond(('POST', '/tweets', [tweet]), ('POST', '/tweets', [tweet, {'date': '', 'text': 'x'}]))
+        self.assertEqual(responses[0], (200, {'scheduled': 1, 'rejected': [], 'duplicates': 0}))
+        self.assertEqual(responses[1][0], 400)
+        responses = self.respond(('POST', '/tweets', {'tweets': [tweet]}), ('POST', '/tweets', tweet))
+        self.assertEqual([content['duplicates'] for _, content in responses], [1, 1])
+
+    def test_status_is_read_on_the_writer(self):
+        self.respond(('POST', '/tweets', {'date': '01/01/2030 09:00', 'text': 'Hello'}))
+        [(status, content)] = self.respond(('GET', '/status', None))
+        self.assertEqual(status, 200)
+        self.assertEqual(content['next_due'], '2030-01-01T09:00:00+00:00')
+        self.assertEqual(content['pending_writes'], 0)
+
+    def test_requests_are_charged_from_the_tweets_inserted(self):
+        self._service = self.create_service(SilentlySkippingStore(table=MemoryTable()))
+        responses = self.respond(('POST', '/tweets', {'date': '01/01/2030 09:00', 'text': 'First'}),
+                                 ('POST', '/tweets', {'date': '01/01/2030 09:00', 'text': 'Second'}))
+        self.assertEqual([(content['scheduled'], content['duplicates']) for _, content in responses], [(1, 0), (0, 1)])
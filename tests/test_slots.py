@@ -0,0 +1,71 @@
+import calendar
+import unittest
+from datetime import datetime, timedelta
+from itertools import islice
+
+import pytz
+
+from schtweet.slots import SlotAllocator
+
+LONDON = pytz.timezone('Europe/London')
+
+
+def times(*strings):
+    return [datetime.strptime(string, '%H%M') for string in strings]
+
+
+def epoch(string, timezone=LONDON):
+    """UTC epoch seconds of a local 'dd/mm/YYYY HH:MM' time."""
+    date = datetime.strptime(string, '%d/%m/%Y %H:%M')
+    return calendar.timegm(timezone.localize(date).utctimetuple())
+
+
+def slots(allocator, count):
+    return [string for _, string in islice(allocator.slots(), count)]
+
+
+class SlotAllocatorTests(unittest.TestCase):
+
+    def test_occupied_slots_are_skipped(self):
+        allocator = SlotAllocator(datetime(2030, 1, 7), times('0900', '1300'), LONDON,
+                                  occupied=[epoch('07/01/2030 09:00'), epoch('08/01/2030 13:00')])
+        self.assertEqual(slots(allocator, 3), ['07/01/2030 13:00', '08/01/2030 09:00', '09/01/2030 09:00'])
+        self.assertEqual(allocator.skipped_slots, 2)
+
+    def test_max_per_day_counts_occupied_tweets(self):
+        allocator = SlotAllocator(datetime(2030, 1, 7), times('0900', '1300', '2100'), LONDON,
+                                  occupied=[epoch('07/01/2030 12:00')], max_per_day=2)
+        self.assertEqual(slots(allocator, 3), ['07/01/2030 09:00', '08/01/2030 09:00', '08/01/2030 13:00'])
+
+    def test_only_weekdays_are_used(self):
+        # 07/01/2030 is a Monday
+        allocator = SlotAllocator(datetime(2030, 1, 7), times('0900'), LONDON, weekdays={0, 2})
+        self.assertEqual(slots(allocator, 3), ['07/01/2030 09:00', '09/01/2030 09:00', '14/01/2030 09:00'])
+
+    def test_min_spacing_applies_across_midnight(self):
+        allocator = SlotAllocator(datetime(2030, 1, 7), times('0030', '1200'), LONDON,
+                                  occupied=[epoch('06/01/2030 23:45')], min_spacing=timedelta(hours=1))
+        self.assertEqual(slots(allocator, 2), ['07/01/2030 12:00', '08/01/2030 00:30'])
+
+        allocator = SlotAllocator(datetime(2030, 1, 7), times('0015', '2345'), LONDON,
+                                  min_spacing=timedelta(hours=1))
+        self.assertEqual(slots(allocator, 3), ['07/01/2030 00:15', '07/01/2030 23:45', '08/01/2030 23:45'])
+        self.assertEqual(allocator.skipped_slots, 1)
+
+    def test_slots_on_a_dst_change_use_that_days_offset(self):
+        # The clocks went forward at 01:00 on 31/03/2030, so 09:00 was 08:00 UTC
+        occupied = [epoch('31/03/2030 09:00')]
+        self.assertEqual(occupied[0], calendar.timegm(datetime(2030, 3, 31, 8, 0).timetuple()))
+        allocator = SlotAllocator(datetime(2030, 3, 31), times('0900', '1300'), LONDON, occupied=occupied)
+        self.assertEqual(slots(allocator, 2), ['31/03/2030 13:00', '01/04/2030 09:00'])
+
+    def test_max_per_day_on_a_dst_change_counts_the_local_day(self):
+        # 31/03/2030 ran from 00:00 to 23:00 UTC, so 00:30 on the next day,
+        # 23:30 UTC, isn't counted but 00:30 on the day itself is
+        occupied = [epoch('30/03/2030 23:30'), epoch('01/04/2030 00:30')]
+        allocator = SlotAllocator(datetime(2030, 3, 31), times('1200'), LONDON, occupied=occupied, max_per_day=1)
+        self.assertEqual(slots(allocator, 2), ['31/03/2030 12:00', '02/04/2030 12:00'])
+
+        allocator = SlotAllocator(datetime(2030, 3, 31), times('1200'), LONDON,
+                                  occupied=[epoch('31/03/2030 00:30')], max_per_day=1)
+        self.assertEqual(slots(allocator, 1), ['01/04/2030 12:00'])
@@ -0,0 +1,125 @@
+import calendar
+import itertools
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from schtweet.memory import MemoryTable, MemoryTweetStore
+from schtweet.storage import SCHEMA_VERSION, TweetStore, tweet_values
+
+# The tweets table as created before the schema was versioned
+BASELINE_SCHEMA = '''CREATE TABLE tweets (
+                        schedule_id INTEGER PRIMARY KEY,
+                        tweet_on_date TIMESTAMP NOT NULL,
+                        tweet_id TEXT default NULL,
+                        tweeted_date TIMESTAMP default NULL,
+                        tweet_text TEXT NOT NULL,
+                        tweet_url TEXT default NULL)'''
+
+
+class TweetStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._storage_name = os.path.join(self._directory, 'tweets.db')
+        self._date = datetime(2030, 1, 1, 9, 0, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def values(self, text, minutes=0):
+        return tweet_values(self._date + timedelta(minutes=minutes), text)
+
+    def test_duplicates_scheduled_by_another_store_are_reported(self):
+        with TweetStore(self._storage_name) as ours, TweetStore(self._storage_name) as theirs:
+            # Loads our duplicate filter before the other store schedules
+            ours.schedule_tweet_values([self.values('First')], dedup=True)
+            theirs.schedule_tweet_values([self.values('Second')], dedup=True)
+            duplicates = []
+            self.assertEqual(ours.schedule_tweet_values([self.values('Second'), self.values('Third')], dedup=True,
+                                                        on_duplicate=duplicates.append), 1)
+            self.assertEqual(duplicates, [self.values('Second')])
+            self.assertEqual(ours.duplicates_skipped, 1)
+
+    def test_due_tweets_pages_through_tweets_sharing_a_time(self):
+        due = datetime(2020, 1, 1, 9, 0, tzinfo=timezone.utc)
+        # Inserted out of schedule order, so schedule_id alone doesn't sort
+        # them, with three tweets at each time to straddle pages of two
+        minutes = [2, 0, 1, 0, 2, 1, 0, 1, 2]
+        with TweetStore(self._storage_name) as ts:
+            ts.schedule_tweet_values([tweet_values(due + timedelta(minutes=minute), 'Tweet {}'.format(number))
+                                      for number, minute in enumerate(minutes)])
+            expected = sorted(range(len(minutes)), key=lambda number: (minutes[number], number))
+            for page_size in (1, 2, 3, 4, 100):
+                self.assertEqual([tweet.tweet for tweet in ts.due_tweets(page_size=page_size)],
+                                 ['Tweet {}'.format(number) for number in expected])
+
+            # Posting tweets between pages doesn't move the later pages
+            seen = []
+            for tweet in ts.due_tweets(page_size=2):
+                seen.append(tweet.tweet)
+                ts.mark_tweeted(tweet.schedule_id, '1')
+            self.assertEqual(seen, ['Tweet {}'.format(number) for number in expected])
+            self.assertEqual(list(ts.due_tweets(page_size=2)), [])
+
+    def test_baseline_schema_is_migrated_with_its_rows(self):
+        posted = datetime(2020, 1, 1, 9, 0)
+        due = datetime(2020, 1, 2, 9, 0)
+        upcoming = datetime(2099, 1, 1, 9, 0)
+        connection = sqlite3.connect(self._storage_name)
+        connection.execute(BASELINE_SCHEMA)
+        connection.execute('''INSERT INTO tweets (tweet_on_date, tweet_id, tweeted_date, tweet_text)
+                                VALUES (?, '1', ?, 'Posted')''', (str(posted), str(datetime.now())))
+        connection.execute('''INSERT INTO tweets (tweet_on_date, tweet_text, tweet_url) VALUES (?, 'Due', ?)''',
+                           (str(due), 'http://example.com'))
+        connection.execute('''INSERT INTO tweets (tweet_on_date, tweet_text) VALUES (?, 'Upcoming')''',
+                           (str(upcoming),))
+        connection.commit()
+        self.assertEqual(connection.execute('''PRAGMA user_version''').fetchone()[0], 0)
+        connection.close()
+
+        with TweetStore(self._storage_name) as ts:
+            self.assertEqual([(tweet.tweet, tweet.scheduled_epoch) for tweet in ts.due_tweets()],
+                             [('Due http://example.com', calendar.timegm(due.timetuple()))])
+            self.assertEqual([epoch for epoch, _ in ts.upcoming_tweets(10)], [calendar.timegm(upcoming.timetuple())])
+            self.assertEqual(ts.posted_since(datetime.now() - timedelta(hours=1)), 1)
+
+        connection = sqlite3.connect(self._storage_name)
+        self.assertEqual(connection.execute('''PRAGMA user_version''').fetchone()[0], SCHEMA_VERSION)
+        self.assertEqual(connection.execute('''SELECT tweet_text, account, tweet_id FROM tweets
+                                                ORDER BY schedule_id''').fetchall(),
+                         [('Posted', '', '1'), ('Due', '', None), ('Upcoming', '', None)])
+        indexes = dict(connection.execute('''SELECT name, sql FROM sqlite_master WHERE type = 'index'
+                                                AND tbl_name = 'tweets' AND sql IS NOT NULL''').fetchall())
+        self.assertEqual(sorted(indexes), ['tweets_content', 'tweets_pending', 'tweets_posted'])
+        self.assertIn('WHERE tweeted_date IS NULL', indexes['tweets_pending'])
+        self.assertIn('WHERE tweeted_date IS NOT NULL', indexes['tweets_posted'])
+        self.assertIn('WHERE content_hash IS NOT NULL', indexes['tweets_content'])
+        plan = ' '.join(str(row) for row in connection.execute(
+            '''EXPLAIN QUERY PLAN SELECT * FROM tweets
+                   WHERE tweeted_date IS NULL AND account = '' AND tweet_on_epoch <= 0'''))
+        self.assertIn('tweets_pending', plan)
+        self.assertEqual(connection.execute('''SELECT COUNT(*) FROM archived_hashes''').fetchone()[0], 0)
+        connection.close()
+
+    def test_failed_import_schedules_nothing(self):
+        def failing_values():
+            for number in range(5):
+                yield self.values('Tweet {}'.format(number), number)
+            raise ValueError('Bad row')
+
+        with TweetStore(self._storage_name) as ts:
+            stores = [ts, MemoryTweetStore(table=MemoryTable())]
+            for store in stores:
+                for dedup in (False, True):
+                    with self.assertRaises(ValueError):
+                        store.schedule_tweet_values(failing_values(), chunk_size=2, dedup=dedup)
+                    self.assertEqual(store.scheduled_epochs(0), [])
+
+                # The import can be run again once fixed
+                self.assertEqual(store.schedule_tweet_values(itertools.islice(failing_values(), 5), chunk_size=2,
+                                                             dedup=True), 5)
+                self.assertEqual(len(store.scheduled_epochs(0)), 5)